@@ -0,0 +1,118 @@
+import logging
+import shlex
+import subprocess
+import threading
+from os import path
+from typing import List, Optional, Set, Tuple
+
+from .cache import JsonCache
+from .files import FileWriter
+
+log = logging.getLogger(__name__)
+
+
+class HostActions(object):
+    """Commands modules need to run on the host.
+
+    A command can depend on files (triggers) and is dropped when none of
+    them changed since the last flush. Deferred actions are deduplicated and
+    run together by flush() in a single chroot session; otherwise each
+    command runs as soon as it is enqueued.
+    When the commands fail, the files that changed still count as changed
+    by the next flush, also in the next run given a state file.
+    """
+
+    def __init__(
+        self,
+        chroot_path: Optional[str]=None,
+        deferred: bool=False,
+        state_file: Optional[str]=None,
+    ) -> None:
+        self.chroot_path = chroot_path
+        self.deferred = deferred
+        self._cache = JsonCache(state_file) if state_file else None
+        self._changed = set()  # type: Set[str]
+        if self._cache:
+            self._changed.update(self._cache.load().get('changed', []))
+        self._pending = []  # type: List[Tuple[List[str], Optional[List[str]]]]
+        self._lock = threading.Lock()
+        self._writer = FileWriter()
+
+    def mark_changed(self, file_path: str) -> None:
+        with self._lock:
+            self._changed.add(file_path)
+
+    def write_file(self, file_path: str, file_content: str) -> bool:
+        """Write the file unless it has this content, return if it changed.
+
+        Deferred writes are synced to disk by flush().
+        """
+        changed = self._writer.write(file_path, file_content)
+        if changed:
+            self.mark_changed(file_path)
+        if not self.deferred:
+            self._writer.sync()
+        return changed
+
+    def enqueue(
+        self,
+        command: List[str],
+        triggers: Optional[List[str]]=None,
+    ) -> None:
+        """Run the command, only if one of the trigger files changed."""
+        with self._lock:
+            self._pending.append((command, triggers))
+        if not self.deferred:
+            self.flush()
+
+    def _take_commands(self) -> Tuple[List[List[str]], Set[str]]:
+        with self._lock:
+            pending, self._pending = self._pending, []
+            changed, self._changed = self._changed, set()
+        commands = []  # type: List[List[str]]
+        for command, triggers in pending:
+            if triggers is not None and not changed.intersection(triggers):
+                log.info('Skipping %r, nothing changed', command)
+                continue
+            if command in commands:
+                continue
+            commands.append(command)
+        return commands, changed
+
+    def _remember_failed(self, changed: Set[str]) -> None:
+        if not self._cache:
+            return
+        if changed:
+            self._cache.save({'changed': sorted(changed)})
+        elif path.isfile(self._cache.cache_file):
+            self._cache.invalidate()
+
+    def flush(self) -> None:
+        self._writer.sync()
+        commands, changed = self._take_commands()
+        if not commands:
+            self._remember_failed(set())
+            return
+        if len(commands) == 1:
+            host_cmd = commands[0]
+        else:
+            script = ' && '.join(
+                ' '.join(shlex.quote(arg) for arg in command)
+                for command in commands
+            )
+            host_cmd = ['sh', '-c', script]
+        if self.chroot_path:
+            host_cmd = ['chroot', self.chroot_path] + host_cmd
+        log.info('Running %r', host_cmd)
+        try:
+            subprocess.run(
+                host_cmd,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+        except BaseException:
+            with self._lock:
+                self._changed.update(changed)
+            self._remember_failed(changed)
+            raise
+        self._remember_failed(set())
@@ -0,0 +1,51 @@
+import json
+import logging
+from os import fchmod, fdopen, makedirs, path, remove, replace
+from tempfile import mkstemp
+from typing import Any, Dict
+
+log = logging.getLogger(__name__)
+
+
+class JsonCache(object):
+    """A JSON document persisted on disk between runs.
+
+    Saving goes through a temporary file and a rename, so a crash never
+    leaves a truncated cache behind. A missing or unreadable cache loads
+    as an empty document.
+    """
+
+    def __init__(self, cache_file: str, mode: int=0o644) -> None:
+        self.cache_file = cache_file
+        self.mode = mode
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self.cache_file) as _file:
+                data = json.load(_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            log.warning('Ignoring unreadable cache %s', self.cache_file)
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def save(self, data: Dict[str, Any]) -> None:
+        directory_path = path.dirname(self.cache_file)
+        makedirs(directory_path, exist_ok=True)
+        fd, tmp_file = mkstemp(dir=directory_path, suffix='.tmp')
+        try:
+            with fdopen(fd, 'w') as _file:
+                fchmod(_file.fileno(), self.mode)
+                json.dump(data, _file, sort_keys=True)
+            replace(tmp_file, self.cache_file)
+        except BaseException:
+            remove(tmp_file)
+            raise
+
+    def invalidate(self) -> None:
+        if path.isfile(self.cache_file):
+            log.info('Invalidating cache %s', self.cache_file)
+            remove(self.cache_file)
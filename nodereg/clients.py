@@ -0,0 +1,37 @@
+import importlib
+import logging
+import threading
+from typing import Any, Dict, Tuple
+
+log = logging.getLogger(__name__)
+
+# boto modules providing connect_to_region() for each service
+SERVICES = {
+    'ec2': 'boto.ec2',
+    'autoscale': 'boto.ec2.autoscale',
+    'route53': 'boto.route53',
+}
+
+
+class ClientRegistry(object):
+    """AWS connections shared by all the modules of a run.
+
+    Each regional connection is created once, on first use, so credential
+    resolution and the HTTP connection pool are shared between modules.
+    """
+
+    def __init__(self) -> None:
+        self._clients = {}  # type: Dict[Tuple[str, str], Any]
+        self._lock = threading.Lock()
+
+    def get(self, service: str, region: str) -> Any:
+        if service not in SERVICES:
+            raise Exception('Unknown AWS service %s' % service)
+        with self._lock:
+            client = self._clients.get((service, region))
+            if client is None:
+                log.debug('Connecting to %s in %s', service, region)
+                boto_module = importlib.import_module(SERVICES[service])
+                client = boto_module.connect_to_region(region)
+                self._clients[(service, region)] = client
+            return client
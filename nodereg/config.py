@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+from os import path
+from typing import Any, Dict, List, Optional
+
+from .cache import JsonCache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG_FILE = path.abspath(
+    path.join(
+        path.dirname(__file__),
+        'config.yaml',
+    ),
+)
+REQUIRED_BASE_KEYS = ['ami_build_tag', 'chroot_path', 'enabled_modules']
+# bump when the cached format or the merge rules change
+CACHE_VERSION = b'2'
+# where the host root is mounted in the container, the default chroot_path
+HOST_ROOT = '/media/root'
+
+
+def default_cache_dir() -> str:
+    """The config cache directory, on the host when its root is mounted.
+
+    The container of the oneshot deployment starts empty on every boot,
+    its own /var/cache would never hold a cache.
+    """
+    if path.isdir(HOST_ROOT):
+        return path.join(HOST_ROOT, 'var/cache/nodereg')
+    return '/var/cache/nodereg'
+
+
+class ConfigLoader(object):
+    """Reads and merges config files.
+
+    The merged and validated config is cached, keyed by the content hash
+    of all the files, so YAML is only parsed when a file changed. The
+    cache holds the secrets of the config, so only its owner can read it.
+    """
+
+    def __init__(self, cache_dir: Optional[str]=None) -> None:
+        self.cache = None  # type: Optional[JsonCache]
+        if cache_dir:
+            self.cache = JsonCache(path.join(cache_dir, 'config.cache'), 0o600)
+
+    def _digest(self, contents: List[bytes]) -> str:
+        digest = hashlib.sha256(CACHE_VERSION)
+        for content in contents:
+            digest.update(hashlib.sha256(content).digest())
+        return digest.hexdigest()
+
+    def _load_cache(self, digest: str) -> Optional[Dict[str, Any]]:
+        if not self.cache:
+            return None
+        cached = self.cache.load()
+        config = cached.get('config')
+        if cached.get('digest') != digest or not isinstance(config, dict):
+            return None
+        return config
+
+    def _save_cache(self, digest: str, config: Dict[str, Any]) -> None:
+        if not self.cache:
+            return
+        try:
+            # e.g. YAML dates or integer keys do not load back the same
+            if json.loads(json.dumps(config)) != config:
+                log.info('Config has values JSON cannot hold, not caching')
+                return
+            self.cache.save({'digest': digest, 'config': config})
+        except (OSError, TypeError, ValueError):
+            log.warning(
+                'Unable to write config cache %s',
+                self.cache.cache_file,
+            )
+
+    def _parse(self, content: bytes) -> Dict[str, Any]:
+        # yaml is only imported when a config file changed
+        import yaml
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        return yaml.load(content, Loader=loader) or {}
+
+    def _validate(self, config: Dict[str, Any]) -> None:
+        base = config.get('base')
+        if not isinstance(base, dict):
+            raise Exception('Missing config section base')
+        for key in REQUIRED_BASE_KEYS:
+            if key not in base:
+                raise Exception('Missing config option base.%s' % key)
+        for name in base['enabled_modules']:
+            if not isinstance(config.get(name), dict):
+                raise Exception('Missing config section %s' % name)
+
+    def load(self, config_files: List[str]) -> Dict[str, Any]:
+        """Merge the config files, later files override whole sections."""
+        contents = []
+        for config_file in config_files:
+            with open(config_file, 'rb') as _file:
+                contents.append(_file.read())
+        digest = self._digest(contents)
+        config = self._load_cache(digest)
+        if config is not None:
+            log.debug('Using cached config')
+            return config
+        config = {}
+        for content in contents:
+            config.update(self._parse(content))
+        self._validate(config)
+        self._save_cache(digest, config)
+        return config
+
+
+def read_config(
+    custom_config_file: Optional[str]=None,
+    cache_dir: Optional[str]=None,
+) -> Dict[str, Any]:
+    config_files = [DEFAULT_CONFIG_FILE]
+    if custom_config_file:
+        config_files.append(custom_config_file)
+    return ConfigLoader(cache_dir).load(config_files)
@@ -0,0 +1,54 @@
+import threading
+from os import path
+from typing import Any, Dict, List, Optional
+
+from .actions import HostActions
+from .clients import ClientRegistry
+from .tracing import Tracer
+
+
+class RunContext(object):
+    """State shared between the modules of a single run."""
+
+    def __init__(
+        self,
+        state_dir: Optional[str]=None,
+        chroot_path: Optional[str]=None,
+        deferred_actions: bool=False,
+    ) -> None:
+        self.state_dir = state_dir
+        self._values = {}  # type: Dict[str, Any]
+        self._lock = threading.Lock()
+        self.tracer = Tracer()
+        self.clients = ClientRegistry()
+        self.actions = HostActions(
+            chroot_path,
+            deferred_actions,
+            self.state_file('host-actions.json'),
+        )
+        self._background = []  # type: List[threading.Thread]
+
+    def publish(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, key: str, default: Any=None) -> Any:
+        with self._lock:
+            return self._values.get(key, default)
+
+    def add_background(self, thread: threading.Thread) -> None:
+        """Keep track of work a module left running after it returned."""
+        with self._lock:
+            self._background.append(thread)
+
+    def join_background(self) -> None:
+        with self._lock:
+            threads, self._background = self._background, []
+        for thread in threads:
+            thread.join()
+
+    def state_file(self, name: str) -> Optional[str]:
+        """Return the path of a file persisted between runs, if enabled."""
+        if not self.state_dir:
+            return None
+        return path.join(self.state_dir, name)
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+import stat
+import threading
+from os import fchmod, fchown, fdopen, fsync, makedirs, path, remove, replace
+from tempfile import mkstemp
+from typing import Any, Optional, Set
+
+from .journal import hash_file
+
+log = logging.getLogger(__name__)
+
+
+def _get_umask() -> int:
+    # os.umask can only be read by setting it, writers are created before
+    # the threads that create files start
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+class FileWriter(object):
+    """Writes files and symlinks atomically, only when they change.
+
+    Files are compared by content hash. A changed file is written to a
+    temporary file in the same directory and renamed over the old one,
+    symlinks are swapped the same way, so readers never see a partial
+    file. The directories holding renamed files are synced once per
+    batch, by sync() or at the end of a with block.
+
+    New files get the umask permissions, replaced files keep their mode
+    and owner, unless a mode is given.
+    """
+
+    def __init__(self) -> None:
+        self._umask = _get_umask()
+        self._directories = set()  # type: Set[str]
+        self._lock = threading.Lock()
+
+    def _renamed(self, directory_path: str) -> None:
+        with self._lock:
+            self._directories.add(directory_path)
+
+    def _set_metadata(
+        self,
+        fd: int,
+        file_path: str,
+        mode: Optional[int],
+    ) -> None:
+        """Give the temporary file the mode and owner of file_path."""
+        try:
+            file_stat = os.stat(file_path)  # type: Optional[os.stat_result]
+        except FileNotFoundError:
+            file_stat = None
+        if mode is None:
+            if file_stat:
+                mode = stat.S_IMODE(file_stat.st_mode)
+            else:
+                mode = 0o666 & ~self._umask
+        fchmod(fd, mode)
+        if file_stat:
+            try:
+                fchown(fd, file_stat.st_uid, file_stat.st_gid)
+            except PermissionError:
+                log.warning('Unable to keep the owner of %s', file_path)
+
+    def write(
+        self,
+        file_path: str,
+        file_content: str,
+        mode: Optional[int]=None,
+    ) -> bool:
+        """Write the file unless it has this content, return if it changed.
+
+        When given, the mode is also set on a file that has the content.
+        """
+        content = file_content.encode()
+        if hash_file(file_path) == hashlib.sha256(content).hexdigest():
+            log.info('%s is up to date', file_path)
+            if mode is not None:
+                self._chmod(file_path, mode)
+            return False
+        directory_path = path.dirname(file_path) or '.'
+        makedirs(directory_path, exist_ok=True)
+        log.info('Writing file %s', file_path)
+        fd, tmp_file = mkstemp(dir=directory_path, prefix='.', suffix='.tmp')
+        try:
+            with fdopen(fd, 'wb') as _file:
+                self._set_metadata(_file.fileno(), file_path, mode)
+                _file.write(content)
+                _file.flush()
+                fsync(_file.fileno())
+            replace(tmp_file, file_path)
+        except BaseException:
+            remove(tmp_file)
+            raise
+        self._renamed(directory_path)
+        return True
+
+    def _chmod(self, file_path: str, mode: int) -> None:
+        if stat.S_IMODE(os.stat(file_path).st_mode) != mode:
+            log.info('Setting mode %o on %s', mode, file_path)
+            os.chmod(file_path, mode)
+
+    def symlink(self, target: str, link_path: str) -> bool:
+        """Point link_path to target, return if the link changed."""
+        if path.islink(link_path) and os.readlink(link_path) == target:
+            log.info('Symlink %s is up to date', link_path)
+            return False
+        directory_path = path.dirname(link_path) or '.'
+        makedirs(directory_path, exist_ok=True)
+        log.info('Creating symlink %s -> %s', link_path, target)
+        tmp_link = path.join(
+            directory_path,
+            '.%s.%s.tmp' % (path.basename(link_path), os.getpid()),
+        )
+        if path.lexists(tmp_link):
+            remove(tmp_link)
+        os.symlink(target, tmp_link)
+        replace(tmp_link, link_path)
+        self._renamed(directory_path)
+        return True
+
+    def sync(self) -> None:
+        """Make the renames since the last sync durable."""
+        with self._lock:
+            directories, self._directories = self._directories, set()
+        for directory_path in sorted(directories):
+            fd = os.open(directory_path, os.O_RDONLY)
+            try:
+                fsync(fd)
+            finally:
+                os.close(fd)
+
+    def __enter__(self) -> 'FileWriter':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.sync()
@@ -0,0 +1,128 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from .tracing import Tracer
+
+log = logging.getLogger(__name__)
+
+IMDS_URL = 'http://169.254.169.254/latest'
+# seconds before its expiry a token is renewed
+TOKEN_RENEW_MARGIN = 10
+
+
+class InstanceMetadata(object):
+    """Fetches selected keys from the instance metadata service.
+
+    All requests share one keep-alive connection pool and one IMDSv2
+    session token. The token is renewed shortly before it expires and
+    when the service rejects it. If no token can be obtained the service
+    is used without one (IMDSv1) until the token would have expired.
+    Requests retried with a renewed token are counted in `tracer`.
+    """
+
+    def __init__(
+        self,
+        timeout: float=2,
+        token_ttl: int=300,
+        max_workers: int=4,
+        tracer: Optional[Tracer]=None,
+    ) -> None:
+        self.timeout = timeout
+        self.token_ttl = token_ttl
+        self.max_workers = max_workers
+        self.tracer = tracer or Tracer()
+        self.session = requests.Session()
+        # the token headers and when they must be renewed
+        self._token = None  # type: Optional[Tuple[Dict[str, str], float]]
+        self._lock = threading.Lock()
+
+    def _get_headers(
+        self,
+        rejected: Optional[Dict[str, str]]=None,
+    ) -> Dict[str, str]:
+        with self._lock:
+            if (
+                self._token is None or
+                self._token[0] is rejected or
+                monotonic() >= self._token[1]
+            ):
+                requested_at = monotonic()
+                try:
+                    response = self.session.put(
+                        '%s/api/token' % IMDS_URL,
+                        headers={
+                            'X-aws-ec2-metadata-token-ttl-seconds':
+                                str(self.token_ttl),
+                        },
+                        timeout=self.timeout,
+                    )
+                    response.raise_for_status()
+                except requests.exceptions.RequestException:
+                    log.info('No IMDSv2 token available, using IMDSv1')
+                    headers = {}  # type: Dict[str, str]
+                else:
+                    headers = {'X-aws-ec2-metadata-token': response.text}
+                self._token = (
+                    headers,
+                    requested_at + self.token_ttl - TOKEN_RENEW_MARGIN,
+                )
+            return self._token[0]
+
+    def _get(self, url: str) -> requests.Response:
+        headers = self._get_headers()
+        response = self.session.get(
+            url,
+            headers=headers,
+            timeout=self.timeout,
+        )
+        if response.status_code == 401:
+            log.info('IMDSv2 token rejected, renewing it')
+            with self.tracer.span('imds.token_renewal') as span:
+                span.retry()
+                response = self.session.get(
+                    url,
+                    headers=self._get_headers(rejected=headers),
+                    timeout=self.timeout,
+                )
+        return response
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the value under meta-data/, None if it does not exist."""
+        response = self._get('%s/meta-data/%s' % (IMDS_URL, key))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.text
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        self._get_headers()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            values = executor.map(self.tracer.wrap(self.get), keys)
+            return dict(zip(keys, values))
+
+    def get_identity_document(self) -> Dict[str, Any]:
+        response = self._get(
+            '%s/dynamic/instance-identity/document' % IMDS_URL,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def get_tags(self) -> Optional[Dict[str, str]]:
+        """Return the instance tags.
+
+        Returns None if tags are not exposed in the instance metadata.
+        """
+        names = self.get('tags/instance')
+        if names is None:
+            return None
+        keys = ['tags/instance/%s' % name for name in names.splitlines()]
+        values = self.get_many(keys)
+        return {
+            key.split('/', 2)[2]: value or ''
+            for key, value in values.items()
+        }
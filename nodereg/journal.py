@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .cache import JsonCache
+
+log = logging.getLogger(__name__)
+
+
+def hash_file(file_path: str) -> Optional[str]:
+    try:
+        with open(file_path, 'rb') as _file:
+            return hashlib.sha256(_file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def hash_inputs(inputs: Dict[str, Any]) -> str:
+    content = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class Journal(JsonCache):
+    """Records the modules that converged in previous runs.
+
+    For each module it keeps a hash of the module inputs, the hashes of
+    the files the module manages and the module result. A module whose
+    inputs and files did not change since then is converged and its
+    recorded result can be used instead of running it.
+    Without a cache file the journal only lives as long as the process.
+    """
+
+    def __init__(self, cache_file: Optional[str]) -> None:
+        super().__init__(cache_file or '')
+        self._entries = self.load() if cache_file else {}
+        self._lock = threading.Lock()
+
+    def _save(self) -> None:
+        if self.cache_file:
+            self.save(self._entries)
+
+    def _outputs_unchanged(self, entry: Dict[str, Any]) -> bool:
+        return all(
+            hash_file(file_path) == file_hash
+            for file_path, file_hash in entry['outputs'].items()
+        )
+
+    def lookup(
+        self,
+        name: str,
+        inputs: Dict[str, Any],
+    ) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(name)
+        if not entry or entry['inputs'] != hash_inputs(inputs):
+            return False, None
+        if not self._outputs_unchanged(entry):
+            log.info('Files managed by module %s changed', name)
+            return False, None
+        return True, entry['result']
+
+    def has_converged(self, name: str) -> bool:
+        """Tell if the files of the last converged run are unchanged."""
+        with self._lock:
+            entry = self._entries.get(name)
+        if not entry:
+            return False
+        return self._outputs_unchanged(entry)
+
+    def record(
+        self,
+        name: str,
+        inputs: Dict[str, Any],
+        outputs: List[str],
+        result: Any,
+    ) -> None:
+        entry = {
+            'inputs': hash_inputs(inputs),
+            'outputs': {
+                file_path: hash_file(file_path)
+                for file_path in outputs
+            },
+            'result': result,
+        }
+        with self._lock:
+            self._entries[name] = entry
+            self._save()
+
+    def forget(self, name: str) -> None:
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._save()
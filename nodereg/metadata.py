@@ -0,0 +1,64 @@
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from .cache import JsonCache
+
+log = logging.getLogger(__name__)
+
+# on Nitro instances the DMI asset tag holds the instance id
+ASSET_TAG_FILE = '/sys/devices/virtual/dmi/id/board_asset_tag'
+# the instance metadata the modules use
+METADATA_KEYS = ['instance-id', 'local-ipv4']
+
+
+def get_local_instance_id() -> Optional[str]:
+    """Return the instance id without asking the metadata service."""
+    try:
+        with open(ASSET_TAG_FILE) as _file:
+            asset_tag = _file.read().strip()
+    except OSError:
+        return None
+    if asset_tag.startswith('i-'):
+        return asset_tag
+    return None
+
+
+class MetadataCache(JsonCache):
+    """Node metadata cached between runs of the same instance.
+
+    Instance metadata and region never change for an instance id, so they
+    are reused until the cache is invalidated. Tags can change and expire
+    after `ttl` seconds.
+    """
+
+    def __init__(self, cache_file: str, ttl: int) -> None:
+        super().__init__(cache_file)
+        self.ttl = ttl
+
+    def get(self, instance_id: str) -> Dict[str, Any]:
+        cached = self.load()
+        if cached.get('instance_id') != instance_id:
+            return {}
+        node = {
+            'metadata': cached['metadata'],
+            'region': cached['region'],
+        }
+        tags_age = time.time() - cached.get('tags_updated_at', 0)
+        if 'tags' in cached and tags_age < self.ttl:
+            node['tags'] = cached['tags']
+        else:
+            log.info('Cached instance tags expired')
+        return node
+
+    def put(self, node: Dict[str, Any]) -> None:
+        self.save({
+            'instance_id': node['metadata']['instance-id'],
+            'metadata': {
+                key: node['metadata'][key]
+                for key in METADATA_KEYS
+            },
+            'region': node['region'],
+            'tags': node['tags'],
+            'tags_updated_at': time.time(),
+        })
@@ -1,4 +1,21 @@
-from .etcd import Etcd  # noqa
-from .hosted_zone import HostedZone  # noqa
-from .hostname import Hostname  # noqa
-from .tinycert import TinyCert  # noqa
+import importlib
+from typing import Type
+
+from .interfaces import AbstractModule
+
+# module name -> (python module, class); python modules are only imported
+# when enabled, so their dependencies (boto, requests, tinycert) are too
+MODULES = {
+    'hostname': ('.hostname', 'Hostname'),
+    'hosted_zone': ('.hosted_zone', 'HostedZone'),
+    'tinycert': ('.tinycert', 'TinyCert'),
+    'etcd': ('.etcd', 'Etcd'),
+}
+
+
+def get_module(name: str) -> Type[AbstractModule]:
+    if name not in MODULES:
+        raise Exception('Unknown module %s' % name)
+    module_name, class_name = MODULES[name]
+    module = importlib.import_module(module_name, __name__)
+    return getattr(module, class_name)
@@ -1,10 +1,7 @@
 import logging
-import subprocess
 from typing import Any, Dict, List, Optional
 
 import requests
-from boto import ec2  # type: ignore
-from boto.ec2 import autoscale  # type: ignore
 
 from .interfaces import AbstractModule
 
@@ -13,6 +10,13 @@ log = logging.getLogger(__name__)
 
 class Etcd(AbstractModule):
 
+    def fingerprint(self, *args: Any) -> Optional[Dict[str, Any]]:
+        return {
+            'config': self.config,
+            'name': self.node['metadata']['instance-id'],
+            'ip_address': self.node['metadata']['local-ipv4'],
+        }
+
     def _member_from_node(self) -> Dict[str, Any]:
         return {
             'id': None,
@@ -33,7 +37,11 @@ class Etcd(AbstractModule):
         self,
         instance_ids: List[str],
     ) -> List[Dict[str, Any]]:
-        ec2_conn = ec2.connect_to_region(self.node['region'])
+        ec2_conn = self.context.clients.get('ec2', self.node['region'])
+        with self.span('ec2.get_all_instances'):
+            reservations = ec2_conn.get_all_instances(
+                instance_ids=instance_ids,
+            )
         members = [
             {
                 'id': None,
@@ -49,7 +57,7 @@ class Etcd(AbstractModule):
                     self.config['peer_port'],
                 ),
             }
-            for r in ec2_conn.get_all_instances(instance_ids=instance_ids)
+            for r in reservations
             for instance in r.instances
         ]
         return members
@@ -73,12 +81,17 @@ class Etcd(AbstractModule):
         return members
 
     def _get_asg_instances(self) -> List[str]:
-        asg_conn = autoscale.connect_to_region(self.node['region'])
-        asg_name = asg_conn.get_all_autoscaling_instances(
-            [self.node['metadata']['instance-id']],
-        )[0].group_name
+        asg_conn = self.context.clients.get(
+            'autoscale',
+            self.node['region'],
+        )
+        with self.span('autoscale.get_all_autoscaling_instances'):
+            asg_name = asg_conn.get_all_autoscaling_instances(
+                [self.node['metadata']['instance-id']],
+            )[0].group_name
         log.info('Instance is part of ASG %s', asg_name)
-        asg = asg_conn.get_all_groups([asg_name])[0]
+        with self.span('autoscale.get_all_groups'):
+            asg = asg_conn.get_all_groups([asg_name])[0]
         instance_ids = [
             instance.instance_id
             for instance in asg.instances
@@ -98,8 +111,9 @@ class Etcd(AbstractModule):
         for member in members:
             url = '%s/health' % member['client_url']
             try:
-                response = requests.get(url, timeout=5)
-                response.raise_for_status()
+                with self.span('etcd.health'):
+                    response = requests.get(url, timeout=5)
+                    response.raise_for_status()
             except requests.exceptions.RequestException:
                 continue
             else:
@@ -113,8 +127,9 @@ class Etcd(AbstractModule):
         healthy_member: Dict[str, Any],
     ) -> List[Dict[str, Any]]:
         url = '%s/v2/members' % healthy_member['client_url']
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
+        with self.span('etcd.members.list'):
+            response = requests.get(url, timeout=5)
+            response.raise_for_status()
         etcd_members = response.json()['members']
         members = self._members_from_etcd_members(etcd_members)
         return members
@@ -136,7 +151,8 @@ class Etcd(AbstractModule):
             log.info('Removing bad member %r', member)
             url = '%s/%s' % (base_url, member['id'])
             try:
-                requests.delete(url, timeout=5)
+                with self.span('etcd.members.remove'):
+                    requests.delete(url, timeout=5)
             except requests.exceptions.RequestException:
                 log.exception('Error while removing member %r', member)
 
@@ -160,8 +176,9 @@ class Etcd(AbstractModule):
             'peerURLs': [member_to_add['peer_url']],
         }
         log.info('Adding member %r to cluster at %s', member_to_add, url)
-        response = requests.post(url, json=post_data, timeout=5)
-        response.raise_for_status()
+        with self.span('etcd.members.add'):
+            response = requests.post(url, json=post_data, timeout=5)
+            response.raise_for_status()
 
     def _create_systemd_dropin(self, initial_cluster: str, state: str) -> None:
         file_content = '\n'.join([
@@ -169,20 +186,31 @@ class Etcd(AbstractModule):
             'Environment=ETCD_INITIAL_CLUSTER=%s' % initial_cluster,
             'Environment=ETCD_INITIAL_CLUSTER_STATE=%s' % state,
         ])
-        with open(self.config['drop_in_file'], 'w') as _file:
-            _file.write(file_content)
-        daemon_reload_cmd = ['systemctl', 'daemon-reload']
-        if self.chroot_path:
-            daemon_reload_cmd = [
-                'chroot',
-                self.chroot_path,
-            ] + daemon_reload_cmd
-        subprocess.run(
-            daemon_reload_cmd,
-            stdout=subprocess.PIPE,
-            check=True,
+        drop_in_file = self.config['drop_in_file']
+        self.outputs = [drop_in_file]
+        self.context.actions.write_file(drop_in_file, file_content)
+        # only reload systemd if the drop-in changed
+        self.context.actions.enqueue(
+            ['systemctl', 'daemon-reload'],
+            triggers=[drop_in_file],
         )
 
+    def reconcile(self, result: Any, *args: Any) -> Any:
+        expected_members = self._get_expected_members()
+        healthy_member = self._find_healthy_member(expected_members)
+        if not healthy_member:
+            # most likely a network issue, a new cluster must not be
+            # bootstrapped over a live one
+            log.warning('No healthy etcd member reachable, not reconciling')
+            return result
+        existing_members = self._get_existing_members(healthy_member)
+        expected_names = {member['name'] for member in expected_members}
+        existing_names = {member['name'] for member in existing_members}
+        if expected_names == existing_names:
+            return result
+        log.warning('Etcd membership drifted, reconciling cluster')
+        return self.run()
+
     def run(self) -> None:
         expected_members = self._get_expected_members()
         healthy_member = self._find_healthy_member(expected_members)
@@ -1,71 +1,575 @@
 import logging
-from time import sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_address as parse_ip_address, ip_network
+from itertools import islice
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from boto import route53  # type: ignore
+from boto.route53.exception import DNSServerError  # type: ignore
+from boto.route53.status import Status  # type: ignore
 
+from ..cache import JsonCache
+from ..propagation import ChangeTracker
 from .interfaces import AbstractModule
 
 log = logging.getLogger(__name__)
 
+# TXT records named after an IP address hold the FQDN using it and the
+# region of the node, as 'nodereg-region=<region>'
+INDEX_PREFIX = '_nodereg-ip-'
+REGION_PREFIX = 'nodereg-region='
+DEFAULT_SCAN_LIMIT = 1000
+# records listed per request when looking up a name
+RECORDS_PAGE_SIZE = 10
+# the IP addresses of the A records garbage collection may delete
+DEFAULT_GC_NETWORKS = ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16']
+# Route53 accepts up to 1000 changes per batch
+GC_BATCH_SIZE = 100
+# options of the module that are not zone options
+MODULE_OPTIONS = ['name', 'id', 'zones']
+
 
 class HostedZone(AbstractModule):
 
-    def _get_zone(self) -> route53.zone.Zone:
-        r53_connection = route53.connect_to_region(self.node['region'])
-        zone = r53_connection.get_zone(self.config['name'])
+    dependencies = ['hostname']
+    # zones registered concurrently share the zone ID cache
+    _zone_cache_lock = threading.Lock()
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._zone = None  # type: Optional[route53.zone.Zone]
+        self._zone_modules = None  # type: Optional[List[HostedZone]]
+
+    def _get_zone_modules(self) -> List['HostedZone']:
+        """Return a module per zone in `zones`, the first is the primary.
+
+        Zones inherit the options they do not set. Without `zones` the
+        module handles the zone configured by `name` and `id` itself.
+        """
+        if self._zone_modules is not None:
+            return self._zone_modules
+        zones = self.config.get('zones')
+        if not zones:
+            self._zone_modules = [self]
+            return self._zone_modules
+        options = {
+            key: value
+            for key, value in self.config.items()
+            if key not in MODULE_OPTIONS
+        }
+        self._zone_modules = [
+            HostedZone(
+                self.node,
+                dict(options, **zone),
+                self.chroot_path,
+                self.context,
+            )
+            for zone in zones
+        ]
+        return self._zone_modules
+
+    def _get_zone_by_id(
+        self,
+        r53_connection: route53.connection.Route53Connection,
+        zone_id: str,
+    ) -> Optional[route53.zone.Zone]:
+        try:
+            with self.span('route53.get_hosted_zone'):
+                response = r53_connection.get_hosted_zone(
+                    zone_id.replace('/hostedzone/', ''),
+                )
+        except DNSServerError as error:
+            # 400 for malformed IDs, 404 for unknown ones
+            if error.status in (400, 404):
+                return None
+            raise
+        return route53.zone.Zone(
+            r53_connection,
+            response['GetHostedZoneResponse']['HostedZone'],
+        )
+
+    def _zone_cache(self) -> Optional[JsonCache]:
+        cache_file = self.context.state_file('hosted_zones.json')
+        if not cache_file:
+            return None
+        return JsonCache(cache_file)
+
+    def _lookup_zone(
+        self,
+        r53_connection: route53.connection.Route53Connection,
+    ) -> route53.zone.Zone:
+        """Find the zone by name, using the ID it had in previous runs."""
+        zone_name = self.config['name'].lower()
+        if not zone_name.endswith('.'):
+            zone_name += '.'
+        cache = self._zone_cache()
+        with self._zone_cache_lock:
+            zone_ids = cache.load() if cache else {}
+        if zone_name in zone_ids:
+            zone = self._get_zone_by_id(r53_connection, zone_ids[zone_name])
+            if zone and zone.name.lower() == zone_name:
+                return zone
+            log.info('Cached ID of Hosted Zone %s is stale', zone_name)
+        with self.span('route53.get_zone'):
+            zone = r53_connection.get_zone(self.config['name'])
         if not zone:
             raise Exception('Hosted Zone %s not found' % self.config['name'])
+        if cache:
+            with self._zone_cache_lock:
+                zone_ids = cache.load()
+                zone_ids[zone_name] = zone.id
+                cache.save(zone_ids)
+        return zone
+
+    def _get_zone(self) -> route53.zone.Zone:
+        if self._zone:
+            return self._zone
+        r53_connection = self.context.clients.get(
+            'route53',
+            self.node['region'],
+        )
+        zone_id = self.config.get('id')
+        if zone_id:
+            zone = self._get_zone_by_id(r53_connection, zone_id)
+            if not zone:
+                raise Exception('Hosted Zone %s not found' % zone_id)
+        else:
+            zone = self._lookup_zone(r53_connection)
+        self._zone = zone
         return zone
 
+    def _get_records(
+        self,
+        zone: route53.zone.Zone,
+        name: str,
+        record_type: str,
+    ) -> List[route53.record.Record]:
+        """Return the records with this exact name and type.
+
+        The listing starts at the name, so a single page of records is
+        fetched unless more records than a page share the name and type.
+        """
+        records = []  # type: List[route53.record.Record]
+        identifier = None  # type: Optional[str]
+        while True:
+            with self.span('route53.list_records'):
+                listing = zone.route53connection.get_all_rrsets(
+                    zone.id,
+                    type=record_type,
+                    name=name,
+                    identifier=identifier,
+                    maxitems=RECORDS_PAGE_SIZE,
+                )
+            # iterating over the listing would fetch the next pages
+            for record in listing[:]:
+                if record.name != name or record.type != record_type:
+                    return records
+                records.append(record)
+            if not (
+                getattr(listing, 'is_truncated', False) and
+                getattr(listing, 'next_record_name', None) == name and
+                getattr(listing, 'next_record_type', None) == record_type
+            ):
+                return records
+            identifier = getattr(listing, 'next_record_identifier', None)
+
+    def _index_name(self, zone: route53.zone.Zone, ip_address: str) -> str:
+        return self._build_fqdn(
+            INDEX_PREFIX + ip_address.replace('.', '-'),
+            zone.name,
+        )
+
+    def _index_values(self, fqdn: str) -> List[str]:
+        """The values of the index record of the node."""
+        return [fqdn, REGION_PREFIX + self.node['region']]
+
+    def _scan_records(
+        self,
+        zone: route53.zone.Zone,
+    ) -> List[route53.record.Record]:
+        scan_limit = self.config.get('scan_limit', DEFAULT_SCAN_LIMIT)
+        if not scan_limit:
+            return []
+        log.info('No index record, scanning %s records', scan_limit)
+        with self.span('route53.get_records'):
+            return list(islice(zone.get_records(), scan_limit))
+
+    def _find_records(
+        self,
+        zone: route53.zone.Zone,
+        fqdn: str,
+        ip_address: str,
+    ) -> Tuple[List[route53.record.Record], Optional[List[str]]]:
+        """Return the records that may hold the node IP address.
+
+        Besides the record of the FQDN, these are the records named by the
+        index record of the IP address. Without an index record (e.g. it
+        was created by an older version) the first `scan_limit` records
+        of the zone are searched instead.
+        Also returns the values currently in the index record, None when
+        the index is not used.
+        """
+        if self.config.get('lookup', 'scan') == 'scan':
+            with self.span('route53.get_records'):
+                return [r for r in zone.get_records()], None
+        records = self._get_records(zone, fqdn, 'A')
+        index_records = self._get_records(
+            zone,
+            self._index_name(zone, ip_address),
+            'TXT',
+        )
+        if not index_records:
+            return records + self._scan_records(zone), []
+        indexed_values = [
+            value.strip('"')
+            for value in index_records[0].resource_records
+        ]
+        for name in indexed_values:
+            if name != fqdn and not name.startswith(REGION_PREFIX):
+                records += self._get_records(zone, name, 'A')
+        return records, indexed_values
+
+    def _remove_ip_addresses(
+        self,
+        changes: route53.record.ResourceRecordSets,
+        record: route53.record.Record,
+        ip_addresses: Set[str],
+    ) -> None:
+        """Add the changes removing the IP addresses from a record."""
+        values = [
+            v for v in record.resource_records
+            if v not in ip_addresses
+        ]
+        if not values:
+            log.warning('Removing record %s', str(record))
+            changes.add_change_record('DELETE', record)
+            return
+        log.warning(
+            'Removing %s from record %s',
+            ', '.join(sorted(ip_addresses)),
+            str(record),
+        )
+        change = changes.add_change(
+            'UPSERT',
+            record.name,
+            record.type,
+            ttl=record.ttl,
+            identifier=record.identifier,
+            weight=record.weight,
+            region=record.region,
+            health_check=record.health_check,
+            failover=record.failover,
+        )
+        for value in values:
+            change.add_value(value)
+
+    def _track_change(self, status: Status) -> None:
+        tracker = ChangeTracker(
+            status,
+            timeout=self.config.get('sync_timeout', 300),
+            tracer=self.context.tracer,
+        )
+        if self.config.get('wait_for_sync', True):
+            tracker.track()
+        else:
+            # the modules depending on this one do not wait for it
+            self.context.add_background(tracker.start())
+
     def _update_zone(
         self,
         zone: route53.zone.Zone,
         fqdn: str,
     ) -> None:
+        """Register the node in a single change batch.
+
+        The batch removes the node IP address from records with other
+        names, upserts the A record of the node and its index record.
+        """
         ip_address = self.node['metadata']['local-ipv4']
-        all_records = [r for r in zone.get_records()]
+        all_records, indexed_values = self._find_records(
+            zone,
+            fqdn,
+            ip_address,
+        )
+        changes = route53.record.ResourceRecordSets(
+            zone.route53connection,
+            zone.id,
+            'nodereg: %s' % fqdn,
+        )
         record_exists = False
+        seen = set()  # type: Set[Tuple[str, str, Optional[str]]]
         for record in all_records:
-            if ip_address in record.resource_records:
-                log.info(
-                    'Found record %s containing node IP address %s',
-                    str(record),
-                    ip_address,
-                )
-                if record.name != fqdn:
-                    log.warning(
-                        'Record %s with node IP address %s has wrong name',
-                        str(record),
-                        ip_address,
-                    )
-                    log.warning('Removing record %s', str(record))
-                    # FIXME: handle records with multiple values
-                    delete_request = zone.delete_record(
-                        record,
-                        'nodereg: stale name',
-                    )
-                    while delete_request.status != 'INSYNC':
-                        log.info('Waiting for comfirmation...')
-                        sleep(1)
-                        delete_request.update()
-                else:
-                    record_exists = True
-                    log.info(
-                        'Record %s is up to date',
-                        str(record),
-                    )
-        if not record_exists:
-            zone.add_a(fqdn, ip_address, ttl=60)
+            key = (record.name, record.type, record.identifier)
+            if key in seen or ip_address not in record.resource_records:
+                continue
+            seen.add(key)
             log.info(
-                'Added A record (%s -> %s) to zone %s',
-                fqdn, ip_address, zone.name,
+                'Found record %s containing node IP address %s',
+                str(record),
+                ip_address,
             )
+            if record.name == fqdn and record.type == 'A':
+                record_exists = record.resource_records == [ip_address]
+                continue
+            log.warning(
+                'Record %s with node IP address %s has wrong name',
+                str(record),
+                ip_address,
+            )
+            self._remove_ip_addresses(changes, record, {ip_address})
+        if record_exists:
+            log.info('Record %s is up to date', fqdn)
+        else:
+            change = changes.add_change('UPSERT', fqdn, 'A', ttl=60)
+            change.add_value(ip_address)
+        if (
+            indexed_values is not None and
+            indexed_values != self._index_values(fqdn)
+        ):
+            change = changes.add_change(
+                'UPSERT',
+                self._index_name(zone, ip_address),
+                'TXT',
+                ttl=60,
+            )
+            for value in self._index_values(fqdn):
+                change.add_value('"%s"' % value)
+        if not changes.changes:
+            return
+        with self.span('route53.change_records'):
+            response = changes.commit()
+        status = Status(
+            zone.route53connection,
+            response['ChangeResourceRecordSetsResponse']['ChangeInfo'],
+        )
+        log.info(
+            'Updated zone %s (%s -> %s) with %s changes',
+            zone.name, fqdn, ip_address, len(changes.changes),
+        )
+        self._track_change(status)
 
-    def run(  # type: ignore # pylint: disable=arguments-differ
+    def _index_ip_addresses(
         self,
-        hostname: str,
-    ) -> str:
+        zone: route53.zone.Zone,
+    ) -> Dict[str, List[route53.record.Record]]:
+        """Map the IP addresses nodereg manages in the zone to their records.
+
+        An IP address is managed when its index record names the region of
+        the node, so the records of hosts nodereg did not register (peered
+        VPCs, on-premises) or registered from other regions are never
+        considered. Only IP addresses in gc_networks are considered.
+        """
+        networks = [
+            ip_network(network)
+            for network in self.config.get('gc_networks', DEFAULT_GC_NETWORKS)
+        ]
+        index = {}  # type: Dict[str, List[route53.record.Record]]
+        managed = set()  # type: Set[str]
+        region_value = '"%s%s"' % (REGION_PREFIX, self.node['region'])
+        with self.span('route53.get_records'):
+            for record in zone.get_records():
+                if record.type == 'A':
+                    values = record.resource_records
+                elif (
+                    record.type == 'TXT' and
+                    record.name.startswith(INDEX_PREFIX)
+                ):
+                    label = record.name.split('.')[0]
+                    values = [label[len(INDEX_PREFIX):].replace('-', '.')]
+                    if region_value in record.resource_records:
+                        managed.update(values)
+                else:
+                    continue
+                for value in values:
+                    try:
+                        address = parse_ip_address(value)
+                    except ValueError:
+                        continue
+                    if any(address in network for network in networks):
+                        index.setdefault(value, []).append(record)
+        return {
+            ip_address: records
+            for ip_address, records in index.items()
+            if ip_address in managed
+        }
+
+    def _get_live_ip_addresses(self) -> Set[str]:
+        """Return the private IP addresses of all the network interfaces."""
+        ec2_connection = self.context.clients.get('ec2', self.node['region'])
+        with self.span('ec2.get_all_network_interfaces'):
+            interfaces = ec2_connection.get_all_network_interfaces()
+        ip_addresses = set()  # type: Set[str]
+        for interface in interfaces:
+            ip_addresses.add(interface.private_ip_address)
+            for address in interface.private_ip_addresses:
+                ip_addresses.add(address.private_ip_address)
+        return ip_addresses
+
+    def _find_orphans(
+        self,
+        index: Dict[str, List[route53.record.Record]],
+        live_ip_addresses: Set[str],
+    ) -> List[Tuple[route53.record.Record, Set[str]]]:
+        """Return the records with the unused IP addresses they hold."""
+        orphans = {}  # type: Dict[Tuple[str, str, Optional[str]], Any]
+        for ip_address, records in index.items():
+            if ip_address in live_ip_addresses:
+                continue
+            for record in records:
+                key = (record.name, record.type, record.identifier)
+                orphans.setdefault(key, (record, set()))[1].add(ip_address)
+        return [orphans[key] for key in sorted(orphans)]
+
+    def _commit_gc_batch(
+        self,
+        zone: route53.zone.Zone,
+        batch: List[Tuple[route53.record.Record, Set[str]]],
+    ) -> Optional[ChangeTracker]:
+        """Remove the IP addresses of a batch, return the change tracker.
+
+        Returns None when Route53 refused the changes.
+        """
+        changes = route53.record.ResourceRecordSets(
+            zone.route53connection,
+            zone.id,
+            'nodereg: garbage collection',
+        )
+        for record, ip_addresses in batch:
+            if record.type == 'TXT':
+                changes.add_change_record('DELETE', record)
+            else:
+                self._remove_ip_addresses(changes, record, ip_addresses)
+        try:
+            with self.span('route53.change_records'):
+                response = changes.commit()
+        except DNSServerError as error:
+            # e.g. a record changed since it was listed
+            log.warning('Unable to apply changes: %s', error)
+            return None
+        return ChangeTracker(
+            Status(
+                zone.route53connection,
+                response['ChangeResourceRecordSetsResponse']['ChangeInfo'],
+            ),
+            timeout=self.config.get('sync_timeout', 300),
+            tracer=self.context.tracer,
+        )
+
+    def collect_garbage(self) -> List[str]:
+        """Collect garbage in every zone, return the records that changed."""
+        changed = []  # type: List[str]
+        for zone_module in self._get_zone_modules():
+            changed += zone_module.collect_zone_garbage()
+        return changed
+
+    def collect_zone_garbage(self) -> List[str]:
+        """Remove the IP addresses no network interface uses anymore.
+
+        Only the IP addresses with an index record of the node region are
+        removed, from their A records, with their index records. A records
+        left without IP address are deleted. Changes are sent in batches of
+        GC_BATCH_SIZE.
+        Returns the names of the records that changed.
+        """
         zone = self._get_zone()
-        fqdn = '.'.join([hostname.lower(), zone.name.lower()])
+        index = self._index_ip_addresses(zone)
+        # list interfaces after the records, so records of nodes started
+        # in between always find their interface
+        live_ip_addresses = self._get_live_ip_addresses()
+        if self.node['metadata']['local-ipv4'] not in live_ip_addresses:
+            raise Exception(
+                'Node IP address not found in %s' % self.node['region'],
+            )
+        records = self._find_orphans(index, live_ip_addresses)
+        log.info('Found %s records with unused IP addresses', len(records))
+        changed = []  # type: List[str]
+        trackers = []  # type: List[ChangeTracker]
+        for start in range(0, len(records), GC_BATCH_SIZE):
+            batch = records[start:start + GC_BATCH_SIZE]
+            tracker = self._commit_gc_batch(zone, batch)
+            if tracker:
+                changed += [record.name for record, _ in batch]
+                trackers.append(tracker)
+        for tracker in trackers:
+            tracker.track()
+        return changed
+
+    def _build_fqdn(self, hostname: str, zone_name: str) -> str:
+        if not zone_name.endswith('.'):
+            zone_name += '.'
+        return '.'.join([hostname.lower(), zone_name.lower()])
+
+    def fingerprint(self, *args: Any) -> Optional[Dict[str, Any]]:
+        hostname, = args
+        return {
+            'config': self.config,
+            'hostname': hostname,
+            'ip_address': self.node['metadata']['local-ipv4'],
+        }
+
+    def is_registered(self, hostname: str) -> bool:
+        """Tell if the zone of this module has the node record."""
+        zone = self._get_zone()
+        fqdn = self._build_fqdn(hostname, zone.name)
+        with self.span('route53.get_a'):
+            record = zone.get_a(fqdn)
+        ip_address = self.node['metadata']['local-ipv4']
+        if record and record.resource_records == [ip_address]:
+            return True
+        log.warning('Record %s drifted, updating zone', fqdn)
+        return False
+
+    def reconcile(self, result: Any, *args: Any) -> Any:
+        hostname, = args
+        if all(
+            zone_module.is_registered(hostname)
+            for zone_module in self._get_zone_modules()
+        ):
+            return result
+        return self.run(hostname)
+
+    def known_zone_name(self) -> Optional[str]:
+        """The zone name, None when only Route53 can tell it.
+
+        The name of a zone configured by ID is only known once the zone
+        was looked up, the configured name may not be its own.
+        """
+        if self._zone:
+            return self._zone.name
+        if self.config.get('id'):
+            return None
+        return self.config.get('name') or None
+
+    def publish(self) -> None:
+        """Publish the FQDN in the primary zone, when its name is known."""
+        hostname = self.context.get('hostname')
+        zone_name = self._get_zone_modules()[0].known_zone_name()
+        if hostname and zone_name:
+            self.context.publish('fqdn', self._build_fqdn(hostname, zone_name))
+
+    def register(self, hostname: str) -> str:
+        """Register the node in the zone of this module, return the FQDN."""
+        zone = self._get_zone()
+        fqdn = self._build_fqdn(hostname, zone.name)
         self._update_zone(zone, fqdn)
         return fqdn
+
+    def run(  # type: ignore # pylint: disable=arguments-differ
+        self,
+        hostname: str,
+    ) -> str:
+        """Register the node in every zone, return the primary FQDN."""
+        zone_modules = self._get_zone_modules()
+        if len(zone_modules) == 1:
+            return zone_modules[0].register(hostname)
+        with ThreadPoolExecutor(max_workers=len(zone_modules)) as executor:
+            futures = [
+                executor.submit(
+                    self.context.tracer.wrap(zone_module.register),
+                    hostname,
+                )
+                for zone_module in zone_modules
+            ]
+        fqdns = [future.result() for future in futures]
+        return fqdns[0]
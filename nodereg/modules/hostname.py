@@ -1,5 +1,7 @@
 import logging
-import subprocess
+import socket
+from os import path, readlink
+from typing import Any, Dict, List, Optional
 
 from .interfaces import AbstractModule
 
@@ -27,15 +29,75 @@ class Hostname(AbstractModule):
         glue = self.config['glue']
         return glue.join(values)
 
+    def _hostname_file(self) -> str:
+        return path.join(self.chroot_path or '/', 'etc/hostname')
+
+    def fingerprint(self, *args: Any) -> Optional[Dict[str, Any]]:
+        return {'hostname': self._build_hostname()}
+
+    def publish(self) -> None:
+        self.context.publish('hostname', self._build_hostname())
+
+    def _read_hostname_file(self) -> Optional[str]:
+        try:
+            with open(self._hostname_file()) as _file:
+                return _file.read().strip()
+        except OSError:
+            return None
+
+    def _shares_host_uts(self) -> bool:
+        """Tell if this process has the kernel hostname of the host.
+
+        A container with its own UTS namespace has its own hostname, so
+        sethostname() would not rename the host. The namespace of the
+        host's PID 1 is read from the /proc of the chroot, the host's.
+        """
+        host_uts = path.join(self.chroot_path or '/', 'proc/1/ns/uts')
+        try:
+            return readlink('/proc/self/ns/uts') == readlink(host_uts)
+        except OSError:
+            return False
+
+    def _set_hostname_native(self, hostname: str) -> None:
+        if self._read_hostname_file() != hostname:
+            with self.span('hostname.write_file'):
+                self.context.actions.write_file(
+                    self._hostname_file(),
+                    '%s\n' % hostname,
+                )
+        if not self._shares_host_uts():
+            log.info('Not in the UTS namespace of the host, using hostnamectl')
+            # the kernel hostname can't be read, trust the hostname file
+            self._set_hostname_hostnamectl(
+                hostname,
+                triggers=[self._hostname_file()],
+            )
+            return
+        if socket.gethostname() == hostname:
+            return
+        try:
+            with self.span('hostname.sethostname'):
+                socket.sethostname(hostname)
+        except PermissionError:
+            log.info('Not allowed to set the hostname, using hostnamectl')
+            self._set_hostname_hostnamectl(hostname)
+
+    def _set_hostname_hostnamectl(
+        self,
+        hostname: str,
+        triggers: Optional[List[str]]=None,
+    ) -> None:
+        self.context.actions.enqueue(
+            ['hostnamectl', 'set-hostname', hostname],
+            triggers=triggers,
+        )
+
     def run(self) -> str:  # type: ignore
         hostname = self._build_hostname()
+        self.outputs = [self._hostname_file()]
         log.info('Setting hostname: %s', hostname)
-        hostname_cmd = ['hostnamectl', 'set-hostname', hostname]
-        if self.chroot_path:
-            hostname_cmd = ['chroot', self.chroot_path] + hostname_cmd
-        subprocess.run(
-            hostname_cmd,
-            stdout=subprocess.PIPE,
-            check=True,
-        )
+        if self.config.get('backend', 'native') == 'native':
+            self._set_hostname_native(hostname)
+        else:
+            self._set_hostname_hostnamectl(hostname)
         return hostname
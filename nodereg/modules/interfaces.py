@@ -1,18 +1,64 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional
+from typing import Any, ContextManager, Dict, List, Optional
+
+from ..context import RunContext
+from ..tracing import Span
 
 
 class AbstractModule(ABC):
 
+    # names of the modules whose results are passed to run()
+    dependencies = []  # type: List[str]
+
     def __init__(
         self,
         node: Dict[str, Any],
         config: Dict[str, Any],
         chroot_path: Optional[str]=None,
+        context: Optional[RunContext]=None,
     ) -> None:
         self.node = node
         self.config = config
         self.chroot_path = chroot_path
+        self.context = context or RunContext(chroot_path=chroot_path)
+        # files managed by the module, checked by the journal
+        self.outputs = []  # type: List[str]
+
+    def span(self, name: str) -> ContextManager[Span]:
+        return self.context.tracer.span(name)
+
+    def fingerprint(self, *args: Any) -> Optional[Dict[str, Any]]:
+        """Describe everything run() depends on, given the same arguments.
+
+        If neither the fingerprint nor the files in `outputs` changed since
+        the last run, the module is considered converged and is skipped.
+        Return None if the module must always run.
+        """
+        return None
+
+    def reconcile(self, result: Any, *args: Any) -> Any:
+        """Repair drift of a module that already converged.
+
+        Called in daemon mode instead of skipping a converged module, with
+        the result of its last run. Local state is already verified by the
+        journal, so only modules managing remote state need to check it.
+        """
+        return result
+
+    def publish(self) -> None:
+        """Publish values other modules can use before this module runs.
+
+        Called in dependency order before any module runs, so it must not
+        make remote calls.
+        """
+        pass
+
+    def prefetch(self) -> None:
+        """Start work that does not depend on other modules' results.
+
+        Called concurrently with the other modules in pipelined mode.
+        """
+        pass
 
     @abstractmethod
     def run(self) -> None:
@@ -1,37 +1,342 @@
 import logging
-import subprocess
-from os import makedirs, path, remove, symlink
-from typing import Any, Dict, Optional
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime, timedelta, timezone
+from itertools import count, islice
+from os import path as os_path, readlink
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+import requests
 from tinycert import Session
 
+from .. import pki
+from ..cache import JsonCache
+from ..files import FileWriter
+from ..tracing import Tracer
 from .interfaces import AbstractModule
 
 log = logging.getLogger(__name__)
 
+# certificate details fetched at the same time
+DEFAULT_CONCURRENCY = 4
+# seconds a certificate on disk must still be valid to be used offline
+DEFAULT_MIN_VALIDITY = 7 * 24 * 3600
+# permissions of the private keys
+KEY_MODE = 0o600
+# HTTP statuses of the requests made with an expired session token
+REJECTED_TOKEN_STATUSES = (401, 403)
+
+
+class CertIndex(JsonCache):
+    """The SANs of the certificates of each CA, kept between runs.
+
+    Certificates are indexed when their details are fetched, so only the
+    certificates that appeared since the last run need to be fetched.
+    Without a cache file the index only lives as long as the process.
+    """
+
+    def __init__(self, cache_file: Optional[str]) -> None:
+        super().__init__(cache_file or '')
+        self._cas = self.load() if cache_file else {}
+        self._lock = threading.Lock()
+
+    def _save(self) -> None:
+        if self.cache_file:
+            self.save(self._cas)
+
+    def is_indexed(self, ca_id: int, cert_id: int) -> bool:
+        with self._lock:
+            return str(cert_id) in self._cas.get(str(ca_id), {})
+
+    def find(self, ca_id: int, san: Dict[str, str]) -> Optional[int]:
+        """The newest indexed certificate with the SAN."""
+        with self._lock:
+            certs = self._cas.get(str(ca_id), {})
+            for cert_id in sorted(certs, key=int, reverse=True):
+                if san in certs[cert_id]:
+                    return int(cert_id)
+        return None
+
+    def sans(self, ca_id: int, cert_id: int) -> List[Dict[str, str]]:
+        with self._lock:
+            return self._cas.get(str(ca_id), {}).get(str(cert_id), [])
+
+    def update(
+        self,
+        ca_id: int,
+        cert_sans: Dict[int, List[Dict[str, str]]],
+    ) -> None:
+        if not cert_sans:
+            return
+        with self._lock:
+            certs = self._cas.setdefault(str(ca_id), {})
+            for cert_id, sans in cert_sans.items():
+                certs[str(cert_id)] = sans
+            self._save()
+
+    def prune(self, ca_id: int, cert_ids: Iterable[int]) -> None:
+        """Forget the certificates of the CA not in cert_ids."""
+        listed = {str(cert_id) for cert_id in cert_ids}
+        with self._lock:
+            certs = self._cas.get(str(ca_id), {})
+            removed = set(certs) - listed
+            for cert_id in removed:
+                del certs[cert_id]
+            if removed:
+                self._save()
+
+
+class CachedSession(Session):
+    """A TinyCert session whose token is kept between runs.
+
+    The token is saved with 0600 permissions and reused by the next
+    connect() with the same account, until TinyCert rejects it. Then the
+    session logs in again and the request is retried, which is counted in
+    `tracer`. The session can be used from several threads, only one of
+    them logs in again.
+    Without a cache file the token only lives as long as the session.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        cache_file: Optional[str]=None,
+        tracer: Optional[Tracer]=None,
+    ) -> None:
+        super().__init__(api_key)
+        self.tracer = tracer or Tracer()
+        self._cache = JsonCache(cache_file, 0o600) if cache_file else None
+        self._credentials = None  # type: Optional[Tuple[str, str]]
+        self._lock = threading.Lock()
+
+    @property
+    def persistent(self) -> bool:
+        return self._cache is not None
+
+    def _login(self) -> None:
+        if self._credentials is None:
+            raise Exception('TinyCert session is not connected')
+        account, passphrase = self._credentials
+        login_session = Session(self._api_key)
+        login_session.connect(account, passphrase)
+        # pylint: disable=protected-access
+        self._session_token = login_session._session_token
+        if self._cache:
+            self._cache.save({
+                'email': account,
+                'token': self._session_token,
+            })
+
+    def connect(self, account: str, passphrase: str) -> None:
+        """Log in, unless the token of a previous run can be reused."""
+        with self._lock:
+            self._credentials = (account, passphrase)
+            cached = self._cache.load() if self._cache else {}
+            if cached.get('email') == account and cached.get('token'):
+                log.info('Reusing the TinyCert session of a previous run')
+                self._session_token = cached['token']
+                return
+            self._login()
+
+    def request(
+        self,
+        path: str,
+        params: Optional[Dict[str, Any]]=None,
+    ) -> Any:
+        token = self._session_token
+        try:
+            return super().request(path, params)
+        except requests.HTTPError as exc:
+            status = getattr(exc.response, 'status_code', None)
+            if (
+                status not in REJECTED_TOKEN_STATUSES or
+                path in ('connect', 'disconnect') or
+                self._credentials is None
+            ):
+                raise
+        with self.tracer.span('tinycert.relogin') as span:
+            span.retry()
+            with self._lock:
+                # another thread may have logged in again already
+                if self._session_token == token:
+                    log.info('TinyCert rejected the session token, logging in')
+                    self._login()
+            return super().request(path, params)
+
+    def disconnect(self) -> None:
+        super().disconnect()
+        if self._cache:
+            self._cache.invalidate()
+
 
 class TinyCert(AbstractModule):
 
+    dependencies = ['hosted_zone']
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._prefetched = {}  # type: Dict[str, Any]
+        self._cert_index = None  # type: Optional[CertIndex]
+        self._files = None  # type: Optional[Dict[str, Any]]
+        self._writer = FileWriter()
+
+    def _get_cert_index(self) -> CertIndex:
+        if self._cert_index is None:
+            self._cert_index = CertIndex(
+                self.context.state_file('tinycert-index.json'),
+            )
+        return self._cert_index
+
+    def _get_files(self) -> Dict[str, Any]:
+        """The files written for the CAs and certificates by id."""
+        if self._files is None:
+            cache_file = self.context.state_file('tinycert-files.json')
+            self._files = JsonCache(cache_file).load() if cache_file else {}
+        return self._files
+
+    def _save_files(self) -> None:
+        cache_file = self.context.state_file('tinycert-files.json')
+        if cache_file and self._files is not None:
+            JsonCache(cache_file).save(self._files)
+
+    def _is_up_to_date(self, fqdn: Optional[str]) -> bool:
+        """Tell if the CA and certificates on disk can be used as they are.
+
+        The certificates must be valid for min_validity seconds and match
+        their keys, the node certificate must also have the node FQDN,
+        hostname and IP address as SANs. Only needs TinyCert when the
+        files of a CA or certificate are not known from previous runs.
+        """
+        if not pki.is_available():
+            return False
+        files = self._get_files()
+        outputs = []  # type: List[str]
+        for ca_id in self._ca_ids():
+            ca_file = files.get('cas', {}).get(str(ca_id))
+            if not ca_file or not pki.check_certificate(ca_file):
+                return False
+            outputs.append(ca_file)
+        if self.config.get('node_certificate'):
+            node_outputs = self._check_node_certificate(fqdn)
+            if node_outputs is None:
+                return False
+            outputs += node_outputs
+        for cert_id in self.config['certificates']:
+            cert_files = files.get('certs', {}).get(str(cert_id))
+            if not cert_files or not self._check_certificate(*cert_files):
+                return False
+            outputs += cert_files
+        self.outputs = outputs
+        return True
+
+    def _check_node_certificate(
+        self,
+        fqdn: Optional[str],
+    ) -> Optional[List[str]]:
+        """Return the node certificate files if they are up to date."""
+        if not fqdn:
+            return None
+        cert_file = os_path.join(self.config['certificates_path'], 'node.pem')
+        key_file = os_path.join(self.config['certificates_path'], 'node-key.pem')
+        if not self._check_certificate(cert_file, key_file, fqdn):
+            return None
+        links = [
+            os_path.join(self.config['certificates_path'], 'host.pem'),
+            os_path.join(self.config['certificates_path'], 'host-key.pem'),
+        ]
+        if not all(os_path.isfile(link) for link in links):
+            return None
+        return [cert_file, key_file] + links
+
+    def _min_validity(self, cert_file: str) -> int:
+        """min_validity, at most half the lifetime of the certificate.
+
+        Otherwise a CA issuing certificates for less than min_validity
+        would get a new certificate requested on every run.
+        """
+        min_validity = self.config.get('min_validity', DEFAULT_MIN_VALIDITY)
+        lifetime = pki.lifetime(cert_file)
+        if lifetime is None:
+            return min_validity
+        return min(min_validity, int(lifetime.total_seconds()) // 2)
+
+    def _check_certificate(
+        self,
+        cert_file: str,
+        key_file: str,
+        fqdn: Optional[str]=None,
+    ) -> bool:
+        """Tell if a certificate on disk is valid for min_validity seconds.
+
+        The node certificate, when given the node FQDN, must also have the
+        node SANs.
+        """
+        min_validity = self._min_validity(cert_file)
+        if not fqdn:
+            return pki.check_certificate(cert_file, key_file, min_validity)
+        return pki.check_certificate(
+            cert_file,
+            key_file,
+            min_validity,
+            dns_names=[fqdn, fqdn.split('.')[0]],
+            ip_addresses=[self.node['metadata']['local-ipv4']],
+        )
+
+    def _renewal_times(self) -> Optional[List[datetime]]:
+        """When the certificates on disk must be renewed, None if unknown."""
+        files = self._get_files()
+        cert_files = [
+            files.get('certs', {}).get(str(cert_id), [''])[0]
+            for cert_id in self.config['certificates']
+        ]
+        if self.config.get('node_certificate'):
+            cert_files.append(
+                os_path.join(self.config['certificates_path'], 'node.pem'),
+            )
+        renewal_times = []  # type: List[datetime]
+        for cert_file in cert_files:
+            expires_at = pki.not_valid_after(cert_file) if cert_file else None
+            if expires_at is None:
+                return None
+            renewal_times.append(
+                expires_at - timedelta(seconds=self._min_validity(cert_file)),
+            )
+        return renewal_times
+
     def _write_file(
         self,
         file_path: str,
         file_content: str,
+        mode: Optional[int]=None,
     ) -> None:
-        directory_path = path.dirname(file_path)
-        makedirs(directory_path, exist_ok=True)
-        log.info('Writing file %s', file_path)
-        with open(file_path, 'w') as _file:
-            _file.write(file_content)
+        if self._writer.write(file_path, file_content, mode):
+            self.context.actions.mark_changed(file_path)
 
     def _create_symlink(
         self,
         src_file: str,
         link_file: str,
     ) -> None:
-        if path.isfile(link_file):
-            remove(link_file)
-        log.info('Creating symlink %s -> %s', link_file, src_file)
-        symlink(src_file, link_file)
+        if self._writer.symlink(src_file, link_file):
+            self.context.actions.mark_changed(link_file)
+
+    def _has_san(
+        self,
+        session: Session,
+        cert: Dict[str, Any],
+        san: Dict[str, str],
+        fetched: Dict[int, List[Dict[str, str]]],
+    ) -> bool:
+        with self.span('tinycert.cert.details'):
+            cert_details = session.cert.details(cert['id'])
+        fetched[cert['id']] = cert_details['Alt']
+        return san in cert_details['Alt']
 
     def _find_cert_by_san(
         self,
@@ -44,145 +349,471 @@ class TinyCert(AbstractModule):
             san,
             ca_id,
         )
-        all_certs = session.cert.list(ca_id)
+        with self.span('tinycert.cert.list'):
+            all_certs = session.cert.list(ca_id)
+        cert_index = self._get_cert_index()
+        cert_index.prune(ca_id, [cert['id'] for cert in all_certs])
+        cert_id = cert_index.find(ca_id, san)
         for cert in all_certs:
-            cert_details = session.cert.details(cert['id'])
-            if san in cert_details['Alt']:
-                log.info('Found certificate %r', cert)
+            if cert['id'] == cert_id:
+                log.info('Found indexed certificate %r', cert)
                 return cert
-        log.info(
-            'No certificate found with SAN %r generated by CA %s',
-            san,
-            ca_id,
+        # only fetch the details of certificates not indexed yet.
+        # Certificates named after the SAN, like the node certificates
+        # generated here, are the most likely to match
+        all_certs = sorted(
+            (
+                cert for cert in all_certs
+                if not cert_index.is_indexed(ca_id, cert['id'])
+            ),
+            key=lambda cert: cert.get('name') not in san.values(),
         )
+        fetched = {}  # type: Dict[int, List[Dict[str, str]]]
+        try:
+            cert = self._search_certs(session, all_certs, san, fetched)
+        finally:
+            cert_index.update(ca_id, fetched)
+        if not cert:
+            log.info(
+                'No certificate found with SAN %r generated by CA %s',
+                san,
+                ca_id,
+            )
+        return cert
+
+    def _search_certs(
+        self,
+        session: Session,
+        all_certs: List[Dict[str, Any]],
+        san: Dict[str, str],
+        fetched: Dict[int, List[Dict[str, str]]],
+    ) -> Optional[Dict[str, Any]]:
+        concurrency = self.config.get('concurrency', DEFAULT_CONCURRENCY)
+        remaining_certs = iter(all_certs)
+        has_san = self.context.tracer.wrap(self._has_san)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {
+                executor.submit(
+                    has_san,
+                    session,
+                    cert,
+                    san,
+                    fetched,
+                ): cert
+                for cert in islice(remaining_certs, concurrency)
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cert = pending.pop(future)
+                    if future.result():
+                        for other_future in pending:
+                            other_future.cancel()
+                        log.info('Found certificate %r', cert)
+                        return cert
+                    for next_cert in islice(remaining_certs, 1):
+                        future = executor.submit(
+                            has_san,
+                            session,
+                            next_cert,
+                            san,
+                            fetched,
+                        )
+                        pending[future] = next_cert
         return None
 
+    def _node_sans(self, fqdn: str) -> List[Dict[str, str]]:
+        return [
+            {'DNS': fqdn},
+            {'DNS': fqdn.split('.')[0]},
+            {'IP': self.node['metadata']['local-ipv4']},
+        ]
+
+    def _is_usable(
+        self,
+        ca_id: int,
+        cert: Dict[str, Any],
+        fqdn: str,
+    ) -> bool:
+        """Tell if a TinyCert certificate can be the node certificate.
+
+        It must be valid for min_validity seconds and have the node SANs,
+        downloading it again would not help otherwise. The lifetime of the
+        node certificate on disk, issued by the same CA, caps min_validity.
+        """
+        min_validity = self._min_validity(
+            os_path.join(self.config['certificates_path'], 'node.pem'),
+        )
+        expires = cert.get('expires')
+        if (
+            cert.get('status', 'good') != 'good' or
+            expires is not None and expires < time.time() + min_validity
+        ):
+            log.info('Certificate %r expires within min_validity', cert)
+            return False
+        sans = self._get_cert_index().sans(ca_id, cert['id'])
+        missing_sans = [
+            san for san in self._node_sans(fqdn)
+            if san not in sans
+        ]
+        if missing_sans:
+            log.info('Certificate %r misses SANs %r', cert, missing_sans)
+            return False
+        return True
+
     def _generate_certificate(
         self,
         session: Session,
         ca_details: Dict[str, Any],
         fqdn: str,
     ) -> Dict[str, Any]:
-        hostname = fqdn.split('.')[0]
-        ip_address = self.node['metadata']['local-ipv4']
         csr = {
             'CN': fqdn,
-            'SANs': [
-                {'DNS': fqdn},
-                {'DNS': hostname},
-                {'IP': ip_address},
-            ],
+            'SANs': self._node_sans(fqdn),
         }
         for field in ['C', 'L', 'O', 'OU', 'ST']:
             value = ca_details.get(field)
             if value:
                 csr[field] = value
         log.info('Generating certificate with %r', csr)
-        csr_out = session.cert.create(ca_details['id'], csr)
-        cert_details = session.cert.details(csr_out['cert_id'])
+        with self.span('tinycert.cert.create'):
+            csr_out = session.cert.create(ca_details['id'], csr)
+        with self.span('tinycert.cert.details'):
+            cert_details = session.cert.details(csr_out['cert_id'])
         log.info('Certificate generated %r', cert_details)
+        self._get_cert_index().update(
+            ca_details['id'],
+            {cert_details['id']: cert_details['Alt']},
+        )
         return cert_details
 
-    def _ensure_ca(self, session: Session) -> Dict[str, Any]:
-        ca_details = session.ca.details(self.config['ca_id'])
-        log.info('Ensuring CA certificate %r is present', ca_details)
-        ca_name = ca_details['CN'].lower().replace(' ', '-')
-        ca_file = path.join(
-            self.config['ca_path'],
-            ca_name + '.pem',
-        )
-        if not path.isfile(ca_file):
-            ca_pem = session.ca.get(self.config['ca_id'])['pem']
-            self._write_file(ca_file, ca_pem)
-            update_certs_cmd = ['update-ca-certificates']
-            if self.chroot_path:
-                update_certs_cmd = ['chroot', self.chroot_path] + update_certs_cmd
-            subprocess.run(
-                update_certs_cmd,
-                stdout=subprocess.PIPE,
-                check=True,
+    def _ca_ids(self) -> List[int]:
+        """The CA issuing the certificates, then the other trusted CAs."""
+        ca_ids = [self.config['ca_id']]
+        for ca_id in self.config.get('ca_ids') or []:
+            if ca_id not in ca_ids:
+                ca_ids.append(ca_id)
+        return ca_ids
+
+    def _link_subject_hash(self, ca_file: str, subject_hash: str) -> None:
+        ca_name = os_path.basename(ca_file)
+        for index in count():
+            link_file = os_path.join(
+                os_path.dirname(ca_file),
+                '%s.%d' % (subject_hash, index),
             )
-        else:
-            log.info('CA cert %s already present', ca_file)
-        return ca_details
+            if not os_path.lexists(link_file):
+                break
+            if os_path.islink(link_file) and readlink(link_file) == ca_name:
+                log.info('CA cert %s already linked', ca_file)
+                return
+        self._create_symlink(ca_name, link_file)
 
-    def _ensure_certificate(
+    def _install_cas(
+        self,
+        ca_bundle: str,
+        cas: List[Tuple[str, str]],
+    ) -> bool:
+        """Append the CA certificates to the bundle and link their hashes.
+
+        Returns False when a subject hash cannot be computed.
+        """
+        subject_hashes = []  # type: List[str]
+        for _, ca_pem in cas:
+            subject_hash = pki.subject_hash(ca_pem.encode())
+            if not subject_hash:
+                return False
+            subject_hashes.append(subject_hash)
+        with open(ca_bundle) as _file:
+            bundle = _file.read()
+        for _, ca_pem in cas:
+            if ca_pem.strip() in bundle:
+                continue
+            if bundle and not bundle.endswith('\n'):
+                bundle += '\n'
+            bundle += ca_pem.strip() + '\n'
+        with self._writer:
+            self._write_file(ca_bundle, bundle)
+            for (ca_file, _), subject_hash in zip(cas, subject_hashes):
+                self._link_subject_hash(ca_file, subject_hash)
+        return True
+
+    def _trust_cas(self, cas: List[Tuple[str, str]]) -> None:
+        """Add new CA certificates to the system trust store.
+
+        With a ca_bundle only the new CAs are installed, as
+        update-ca-certificates would do it. The whole trust store is
+        rebuilt when there is no bundle, the bundle is a symlink that
+        must not be replaced by a file, or the CAs cannot be hashed.
+        """
+        ca_bundle = self.config.get('ca_bundle')
+        if ca_bundle and os_path.islink(ca_bundle):
+            log.info('%s is a symlink, rebuilding the trust store', ca_bundle)
+        elif ca_bundle and os_path.isfile(ca_bundle):
+            with self.span('tinycert.ca.install'):
+                if self._install_cas(ca_bundle, cas):
+                    return
+            log.info('Unable to hash the CA certs, rebuilding the trust store')
+        self.context.actions.enqueue(
+            ['update-ca-certificates'],
+            triggers=[ca_file for ca_file, _ in cas],
+        )
+
+    def _ensure_ca(self, session: Session) -> Dict[str, Any]:
+        """Make sure the CA certificates are present and trusted.
+
+        Returns the details of the CA issuing the certificates.
+        """
+        ca_files = self._get_files().setdefault('cas', {})
+        new_cas = []  # type: List[Tuple[str, str]]
+        cas_details = []  # type: List[Dict[str, Any]]
+        with self._writer:
+            for ca_id in self._ca_ids():
+                with self.span('tinycert.ca.details'):
+                    ca_details = session.ca.details(ca_id)
+                cas_details.append(ca_details)
+                log.info('Ensuring CA certificate %r is present', ca_details)
+                ca_name = ca_details['CN'].lower().replace(' ', '-')
+                ca_file = os_path.join(
+                    self.config['ca_path'],
+                    ca_name + '.pem',
+                )
+                self.outputs.append(ca_file)
+                ca_files[str(ca_id)] = ca_file
+                if os_path.isfile(ca_file):
+                    log.info('CA cert %s already present', ca_file)
+                    continue
+                with self.span('tinycert.ca.get'):
+                    ca_pem = session.ca.get(ca_id)['pem']
+                self._write_file(ca_file, ca_pem)
+                new_cas.append((ca_file, ca_pem))
+        if new_cas:
+            self._trust_cas(new_cas)
+        return cas_details[0]
+
+    def _get_pem(self, session: Session, cert_id: int, what: str) -> str:
+        with self.span('tinycert.cert.get'):
+            return session.cert.get(cert_id, what)['pem']
+
+    def _plan_certificate(
         self,
         session: Session,
         cert_id: int,
-        node_certificate: bool=False,
-    ) -> None:
-        cert_details = session.cert.details(cert_id)
-        log.info('Ensuring certificate %r is present', cert_details)
+        node_certificate: bool,
+        fqdn: Optional[str]=None,
+    ) -> Dict[str, Any]:
+        """Return the files of a certificate and whether to download them.
+
+        Files on disk that are not up to date are downloaded again.
+        """
         if node_certificate:
             cert_name = 'node'
         else:
+            with self.span('tinycert.cert.details'):
+                cert_details = session.cert.details(cert_id)
+            log.info('Ensuring certificate %r is present', cert_details)
             cert_name = cert_details['CN'].lower().replace(' ', '-')
-
-        # certificate file
-        cert_file = path.join(
+        cert_file = os_path.join(
             self.config['certificates_path'],
             cert_name + '.pem',
         )
-        if not path.isfile(cert_file):
-            cert_pem = session.cert.get(cert_id, 'cert')['pem']
-            self._write_file(cert_file, cert_pem)
-        else:
-            log.info('%s already present', cert_file)
-
-        # certificate key file
-        key_file = path.join(
+        key_file = os_path.join(
             self.config['certificates_path'],
             cert_name + '-key.pem',
         )
-        if not path.isfile(key_file):
-            key_pem = session.cert.get(cert_id, 'key.dec')['pem']
-            self._write_file(key_file, key_pem)
-        else:
-            log.info('%s already present', key_file)
+        if not node_certificate:
+            cert_files = self._get_files().setdefault('certs', {})
+            cert_files[str(cert_id)] = [cert_file, key_file]
+        refresh = (
+            pki.is_available() and
+            os_path.isfile(cert_file) and
+            not self._check_certificate(
+                cert_file,
+                key_file,
+                fqdn if node_certificate else None,
+            )
+        )
+        return {
+            'cert_id': cert_id,
+            'node_certificate': node_certificate,
+            'files': [
+                (cert_file, 'cert', refresh or not os_path.isfile(cert_file)),
+                (key_file, 'key.dec', refresh or not os_path.isfile(key_file)),
+            ],
+        }
 
-        if node_certificate:
-            cert_link = path.join(
-                self.config['certificates_path'],
-                'host.pem',
+    def _ensure_certificates(
+        self,
+        session: Session,
+        certificates: List[Tuple[int, bool]],
+        fqdn: Optional[str]=None,
+    ) -> None:
+        """Make sure the certificates and their keys are present.
+
+        Details and PEMs are fetched concurrently, up to `concurrency`
+        requests at a time. Files are only written once all the downloads
+        succeeded, in the order of `certificates`, and synced to disk
+        together.
+        """
+        self._get_files()
+        concurrency = self.config.get('concurrency', DEFAULT_CONCURRENCY)
+        tracer = self.context.tracer
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            plan_futures = [
+                executor.submit(
+                    tracer.wrap(self._plan_certificate),
+                    session,
+                    cert_id,
+                    node_certificate,
+                    fqdn,
+                )
+                for cert_id, node_certificate in certificates
+            ]
+            plans = [future.result() for future in plan_futures]
+            downloads = {}  # type: Dict[str, Future]
+            for plan in plans:
+                for file_path, what, missing in plan['files']:
+                    if missing:
+                        downloads[file_path] = executor.submit(
+                            tracer.wrap(self._get_pem),
+                            session,
+                            plan['cert_id'],
+                            what,
+                        )
+            pems = {
+                file_path: future.result()
+                for file_path, future in downloads.items()
+            }
+
+        with self._writer:
+            for plan in plans:
+                for file_path, what, _ in plan['files']:
+                    self.outputs.append(file_path)
+                    if file_path in pems:
+                        self._write_file(
+                            file_path,
+                            pems[file_path],
+                            KEY_MODE if what == 'key.dec' else None,
+                        )
+                    else:
+                        log.info('%s already present', file_path)
+                if plan['node_certificate']:
+                    (cert_file, _, _), (key_file, _, _) = plan['files']
+                    cert_link = os_path.join(
+                        self.config['certificates_path'],
+                        'host.pem',
+                    )
+                    self._create_symlink(cert_file, cert_link)
+                    self.outputs.append(cert_link)
+                    key_link = os_path.join(
+                        self.config['certificates_path'],
+                        'host-key.pem',
+                    )
+                    self._create_symlink(key_file, key_link)
+                    self.outputs.append(key_link)
+
+    def _connect(self) -> Session:
+        session = CachedSession(
+            self.config['api_key'],
+            self.context.state_file('tinycert-session.json'),
+            self.context.tracer,
+        )
+        with self.span('tinycert.connect'):
+            session.connect(
+                self.config['email'],
+                self.config['passphrase'],
             )
-            self._create_symlink(cert_file, cert_link)
-            key_link = path.join(
-                self.config['certificates_path'],
-                'host-key.pem',
+        return session
+
+    def fingerprint(self, *args: Any) -> Optional[Dict[str, Any]]:
+        """Also changes when a certificate gets within min_validity."""
+        fqdn, = args
+        fingerprint = {
+            'config': self.config,
+            'fqdn': fqdn,
+            'ip_address': self.node['metadata']['local-ipv4'],
+        }
+        if not pki.is_available():
+            return fingerprint
+        renewal_times = self._renewal_times()
+        if renewal_times is None:
+            return None
+        if renewal_times:
+            renew_at = min(renewal_times)
+            if renew_at < datetime.now(timezone.utc):
+                return None
+            fingerprint['renew_at'] = renew_at.isoformat()
+        return fingerprint
+
+    def prefetch(self) -> None:
+        self._prefetched = {}
+        self.outputs = []
+        if self._is_up_to_date(self.context.get('fqdn')):
+            return
+        session = self._connect()
+        ca_details = self._ensure_ca(session)
+        prefetched = {
+            'session': session,
+            'ca_details': ca_details,
+        }
+        fqdn = self.context.get('fqdn')
+        if fqdn and self.config.get('node_certificate'):
+            prefetched['fqdn'] = fqdn
+            prefetched['node_cert'] = self._find_cert_by_san(
+                session,
+                ca_details['id'],
+                {'DNS': fqdn},
             )
-            self._create_symlink(key_file, key_link)
+        self._prefetched = prefetched
 
     def run(  # type: ignore # pylint: disable=arguments-differ
         self,
         fqdn: str,
     ) -> None:
-        session = Session(self.config['api_key'])
-        session.connect(
-            self.config['email'],
-            self.config['passphrase'],
-        )
-        ca_details = self._ensure_ca(session)
+        # the prefetched session only serves the run of the same cycle
+        prefetched, self._prefetched = self._prefetched, {}
+        if not prefetched:
+            # a prefetch already listed the CA files of this run
+            self.outputs = []
+        if not prefetched and self._is_up_to_date(fqdn):
+            log.info('Certificates on disk are up to date')
+            return
+        if prefetched:
+            log.info('Using prefetched TinyCert session and CA')
+            session = prefetched['session']
+            ca_details = prefetched['ca_details']
+        else:
+            session = self._connect()
+            ca_details = self._ensure_ca(session)
 
+        certificates = []  # type: List[Tuple[int, bool]]
         if self.config.get('node_certificate'):
-            san = {'DNS': fqdn}
-            cert_details = self._find_cert_by_san(
-                session,
+            if prefetched.get('fqdn') == fqdn:
+                cert_details = prefetched['node_cert']
+            else:
+                san = {'DNS': fqdn}
+                cert_details = self._find_cert_by_san(
+                    session,
+                    ca_details['id'],
+                    san,
+                )
+            if cert_details and not self._is_usable(
                 ca_details['id'],
-                san,
-            )
+                cert_details,
+                fqdn,
+            ):
+                cert_details = None
             if not cert_details:
                 cert_details = self._generate_certificate(
                     session,
                     ca_details,
                     fqdn,
                 )
-            self._ensure_certificate(
-                session,
-                cert_details['id'],
-                node_certificate=True,
-            )
-
+            certificates.append((cert_details['id'], True))
         for cert_id in self.config['certificates']:
-            self._ensure_certificate(session, cert_id)
-        session.disconnect()
+            certificates.append((cert_id, False))
+        self._ensure_certificates(session, certificates, fqdn)
+        if not session.persistent:
+            with self.span('tinycert.disconnect'):
+                session.disconnect()
+        self._save_files()
@@ -0,0 +1,244 @@
+import hashlib
+import logging
+import re
+import subprocess
+from datetime import datetime, timedelta, timezone
+from ipaddress import ip_address
+from typing import Any, Iterable, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+
+def _load_backend() -> Any:
+    """Return the cryptography modules, None if it is not installed."""
+    try:
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+    except ImportError:
+        return None
+    return x509, default_backend(), serialization
+
+
+def is_available() -> bool:
+    return _load_backend() is not None
+
+
+def _read(pem_file: str) -> Optional[bytes]:
+    try:
+        with open(pem_file, 'rb') as _file:
+            return _file.read()
+    except OSError:
+        return None
+
+
+def _public_key_bytes(key: Any, serialization: Any) -> bytes:
+    return key.public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+
+
+def _validity(cert: Any) -> Tuple[datetime, datetime]:
+    """The not_valid_before and not_valid_after dates, aware of UTC."""
+    valid_from = getattr(cert, 'not_valid_before_utc', None)
+    valid_until = getattr(cert, 'not_valid_after_utc', None)
+    if valid_from is None or valid_until is None:
+        valid_from = cert.not_valid_before.replace(tzinfo=timezone.utc)
+        valid_until = cert.not_valid_after.replace(tzinfo=timezone.utc)
+    return valid_from, valid_until
+
+
+def _load_certificate(cert_file: str) -> Any:
+    """Parse a PEM certificate on disk, None if it can't be."""
+    backend = _load_backend()
+    if backend is None:
+        return None
+    x509, default_backend, _ = backend
+    cert_pem = _read(cert_file)
+    if cert_pem is None:
+        return None
+    try:
+        return x509.load_pem_x509_certificate(cert_pem, default_backend)
+    except ValueError:
+        log.warning('Unable to parse certificate %s', cert_file)
+        return None
+
+
+def _has_sans(
+    cert: Any,
+    cert_file: str,
+    dns_names: Iterable[str],
+    ip_addresses: Iterable[str],
+) -> bool:
+    x509, _, _ = _load_backend()
+    wanted_dns_names = {name.rstrip('.').lower() for name in dns_names}
+    wanted_ips = {ip_address(address) for address in ip_addresses}
+    if not wanted_dns_names and not wanted_ips:
+        return True
+    try:
+        sans = cert.extensions.get_extension_for_class(
+            x509.SubjectAlternativeName,
+        ).value
+    except x509.ExtensionNotFound:
+        log.info('Certificate %s has no SANs', cert_file)
+        return False
+    cert_dns_names = [
+        name.rstrip('.').lower()
+        for name in sans.get_values_for_type(x509.DNSName)
+    ]
+    cert_ips = sans.get_values_for_type(x509.IPAddress)
+    missing_sans = wanted_dns_names.difference(cert_dns_names)
+    missing_sans.update(str(ip) for ip in wanted_ips.difference(cert_ips))
+    if missing_sans:
+        log.info('Certificate %s misses SANs %s', cert_file, missing_sans)
+        return False
+    return True
+
+
+def _matches_key(cert: Any, cert_file: str, key_file: str) -> bool:
+    _, default_backend, serialization = _load_backend()
+    key_pem = _read(key_file)
+    if key_pem is None:
+        return False
+    try:
+        key = serialization.load_pem_private_key(
+            key_pem,
+            None,
+            default_backend,
+        )
+    except (TypeError, ValueError):
+        log.warning('Unable to parse private key %s', key_file)
+        return False
+    cert_public_key = _public_key_bytes(cert.public_key(), serialization)
+    key_public_key = _public_key_bytes(key.public_key(), serialization)
+    if key_public_key != cert_public_key:
+        log.warning('Key %s does not match %s', key_file, cert_file)
+        return False
+    return True
+
+
+def not_valid_after(cert_file: str) -> Optional[datetime]:
+    """When a PEM certificate on disk expires, None if it can't be told."""
+    cert = _load_certificate(cert_file)
+    if cert is None:
+        return None
+    return _validity(cert)[1]
+
+
+def lifetime(cert_file: str) -> Optional[timedelta]:
+    """How long a PEM certificate on disk is valid for in total."""
+    cert = _load_certificate(cert_file)
+    if cert is None:
+        return None
+    valid_from, valid_until = _validity(cert)
+    return valid_until - valid_from
+
+
+def check_certificate(
+    cert_file: str,
+    key_file: Optional[str]=None,
+    min_validity: int=0,
+    dns_names: Iterable[str]=(),
+    ip_addresses: Iterable[str]=(),
+) -> bool:
+    """Tell if a PEM certificate on disk can be used as it is.
+
+    The certificate must be valid for at least `min_validity` seconds,
+    have all the DNS names and IP addresses as SANs and match the
+    private key in `key_file`, when given.
+    """
+    cert = _load_certificate(cert_file)
+    if cert is None:
+        return False
+    expires_at = _validity(cert)[1]
+    now = datetime.now(timezone.utc)
+    if expires_at < now + timedelta(seconds=min_validity):
+        log.info('Certificate %s expires at %s', cert_file, expires_at)
+        return False
+    if not _has_sans(cert, cert_file, dns_names, ip_addresses):
+        return False
+    return not key_file or _matches_key(cert, cert_file, key_file)
+
+
+def _der(tag: int, content: bytes) -> bytes:
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(length_bytes)]) + length_bytes + content
+
+
+def _der_oid(dotted_string: str) -> bytes:
+    arcs = [int(arc) for arc in dotted_string.split('.')]
+    content = bytearray([40 * arcs[0] + arcs[1]])
+    for arc in arcs[2:]:
+        encoded = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            encoded.insert(0, 0x80 | (arc & 0x7f))
+            arc >>= 7
+        content.extend(encoded)
+    return _der(0x06, bytes(content))
+
+
+def _canonical_value(value: str) -> bytes:
+    """Canonicalize a name value the way OpenSSL does before hashing.
+
+    Whitespace is trimmed and collapsed, ASCII letters are lowercased.
+    """
+    value = re.sub(r'[ \t\n\v\f\r]+', ' ', value).strip(' ')
+    value = ''.join(
+        char.lower() if char < '\x80' else char
+        for char in value
+    )
+    return _der(0x0c, value.encode())
+
+
+def _subject_hash_python(cert_pem: bytes) -> Optional[str]:
+    backend = _load_backend()
+    if backend is None:
+        return None
+    x509, default_backend, _ = backend
+    try:
+        cert = x509.load_pem_x509_certificate(cert_pem, default_backend)
+    except ValueError:
+        log.warning('Unable to parse certificate')
+        return None
+    canonical_name = b''
+    for rdn in cert.subject.rdns:
+        attributes = sorted(
+            _der(
+                0x30,
+                _der_oid(attribute.oid.dotted_string) +
+                _canonical_value(attribute.value),
+            )
+            for attribute in rdn
+        )
+        canonical_name += _der(0x31, b''.join(attributes))
+    digest = hashlib.sha1(canonical_name).digest()
+    return '%08x' % int.from_bytes(digest[:4], 'little')
+
+
+def _subject_hash_openssl(cert_pem: bytes) -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ['openssl', 'x509', '-noout', '-subject_hash'],
+            input=cert_pem,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        log.warning('Unable to compute the subject hash with openssl')
+        return None
+    return result.stdout.decode().strip() or None
+
+
+def subject_hash(cert_pem: bytes) -> Optional[str]:
+    """The OpenSSL subject hash of a certificate, as in `<hash>.0` links.
+
+    Computed with the cryptography package when it is installed, with the
+    openssl command otherwise. None when neither can compute it.
+    """
+    return _subject_hash_python(cert_pem) or _subject_hash_openssl(cert_pem)
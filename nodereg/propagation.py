@@ -0,0 +1,91 @@
+import logging
+import threading
+from time import monotonic, sleep
+from typing import Any, Optional
+
+from .tracing import Tracer
+
+log = logging.getLogger(__name__)
+
+
+class ChangeTracker(object):
+    """Follows a Route53 change until it is INSYNC.
+
+    The change status is polled with an exponential backoff, from `delay`
+    up to `max_delay` seconds, until `timeout` seconds after the change
+    was submitted. The time the change took to propagate is kept in
+    `latency`.
+    """
+
+    def __init__(
+        self,
+        status: Any,
+        timeout: float=300,
+        delay: float=1,
+        max_delay: float=16,
+        tracer: Optional[Tracer]=None,
+    ) -> None:
+        self.status = status
+        self.delay = delay
+        self.max_delay = max_delay
+        self.tracer = tracer or Tracer()
+        self.submitted_at = monotonic()
+        self.deadline = self.submitted_at + timeout
+        self.latency = None  # type: Optional[float]
+        self._done = threading.Event()
+
+    @property
+    def in_sync(self) -> bool:
+        return self.latency is not None
+
+    def _poll(self) -> None:
+        delay = self.delay
+        with self.tracer.span('route53.wait_insync') as span:
+            while self.status.status != 'INSYNC':
+                remaining = self.deadline - monotonic()
+                if remaining <= 0:
+                    log.warning(
+                        'Change %s is not in sync, giving up',
+                        self.status.id,
+                    )
+                    return
+                log.info('Waiting for change %s...', self.status.id)
+                sleep(min(delay, remaining))
+                delay = min(delay * 2, self.max_delay)
+                span.retry()
+                self.status.update()
+        self.latency = monotonic() - self.submitted_at
+        log.info(
+            'Change %s in sync after %.1fs',
+            self.status.id,
+            self.latency,
+        )
+
+    def track(self) -> bool:
+        """Poll until the change is in sync or the deadline passed."""
+        try:
+            self._poll()
+        finally:
+            self._done.set()
+        return self.in_sync
+
+    def start(self) -> threading.Thread:
+        """Poll in a background thread, under the current span."""
+        thread = threading.Thread(
+            target=self.tracer.wrap(self._track_quietly),
+            name='route53-%s' % self.status.id,
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def _track_quietly(self) -> None:
+        try:
+            self.track()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Unable to track change %s', self.status.id)
+
+    def wait(self, timeout: Optional[float]=None) -> bool:
+        """Wait for the tracking to end, return if the change is in sync."""
+        self._done.wait(timeout)
+        return self.in_sync
@@ -1,15 +1,23 @@
 import argparse
 import logging
+import signal
 import sys
+import threading
 from os import path
-from time import sleep
-from typing import Any, Dict, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, cast
 
-import yaml
-from boto import ec2
-from boto.utils import get_instance_identity, get_instance_metadata
+from .config import default_cache_dir, read_config
+from .context import RunContext
+from .journal import Journal
+from .metadata import METADATA_KEYS, MetadataCache, get_local_instance_id
+from .modules import get_module
+from .modules.interfaces import AbstractModule
+from .scheduler import Scheduler
+from .tracing import Tracer
 
-from .modules import Etcd, HostedZone, Hostname, TinyCert
+if TYPE_CHECKING:
+    # only for mypy, the module imports boto
+    from .modules.hosted_zone import HostedZone  # noqa: F401
 
 log = logging.getLogger(__name__)
 
@@ -19,82 +27,274 @@ class Registrator(object):
     def __init__(
         self,
         custom_config_file: Optional[str]=None,
+        refresh_metadata: bool=False,
+        config_cache_dir: Optional[str]=None,
     ) -> None:
-        default_config_file = path.abspath(
-            path.join(
-                path.dirname(__file__),
-                'config.yaml',
-            ),
+        self.config = read_config(custom_config_file, config_cache_dir)
+        self.context = RunContext(
+            self._get_state_dir(),
+            self.config['base']['chroot_path'],
+            deferred_actions=True,
         )
-        self.config = self._read_config(default_config_file)
-        if custom_config_file:
-            custom_config = self._read_config(custom_config_file)
-            self.config.update(custom_config)
-        self.node = self._get_node_metadata()
-
-    def _read_config(self, config_file: str) -> Dict[str, Any]:
-        with open(config_file) as _file:
-            return yaml.load(_file)
-
-    def _get_node_metadata(self) -> Dict[str, Any]:
-        node = {
-            'metadata': get_instance_metadata(),
-            'region': get_instance_identity()['document']['region'],
-        }
-        ec2_connection = ec2.connect_to_region(node['region'])
-        instance_id = node['metadata']['instance-id']
-        instance_tags = ec2_connection.get_all_tags(
-            filters={'resource-id': instance_id},
-        )
-        node['tags'] = {
-            tag.name: tag.value
-            for tag in instance_tags
-        }
+        self._imds = None  # type: Any
+        self._journal = None  # type: Optional[Journal]
+        self._modules = {}  # type: Dict[str, AbstractModule]
+        self._wakeup = threading.Event()
+        self._stopping = False
+        with self.context.tracer.span('metadata'):
+            self.node = self._get_node_metadata(refresh_metadata)
+
+    def _get_state_dir(self) -> Optional[str]:
+        state_dir = self.config['base'].get('state_dir')
+        chroot_path = self.config['base']['chroot_path']
+        if state_dir and chroot_path:
+            state_dir = path.join(chroot_path, state_dir.lstrip('/'))
+        return state_dir
+
+    def _get_imds(self) -> Any:
+        if self._imds is None:
+            # requests is only imported when the metadata is not cached
+            from .imds import InstanceMetadata
+            self._imds = InstanceMetadata()
+        # the daemon starts a new tracer every cycle
+        self._imds.tracer = self.context.tracer
+        return self._imds
+
+    def _get_node_metadata(self, refresh: bool=False) -> Dict[str, Any]:
+        tracer = self.context.tracer
+        cache_file = self.context.state_file('metadata.json')
+        cache = None
+        node = {}  # type: Dict[str, Any]
+        if cache_file:
+            cache = MetadataCache(
+                cache_file,
+                self.config['base'].get('metadata_ttl', 3600),
+            )
+            if refresh:
+                cache.invalidate()
+            instance_id = get_local_instance_id()
+            if not instance_id:
+                with tracer.span('imds.instance_id'):
+                    instance_id = self._get_imds().get('instance-id')
+            node = cache.get(instance_id)
+            if 'tags' in node:
+                log.info('Using cached metadata for instance %s', instance_id)
+                return node
+
+        imds = self._get_imds()
+        if 'metadata' not in node:
+            with tracer.span('imds.metadata'):
+                metadata = imds.get_many(METADATA_KEYS + ['placement/region'])
+            region = metadata.pop('placement/region')
+            if not region:
+                with tracer.span('imds.identity_document'):
+                    region = imds.get_identity_document()['region']
+            node['metadata'] = metadata
+            node['region'] = region
+        with tracer.span('imds.tags'):
+            tags = imds.get_tags()
+        if tags is None:
+            log.info('Instance tags not in instance metadata, using EC2 API')
+            ec2_connection = self.context.clients.get('ec2', node['region'])
+            instance_id = node['metadata']['instance-id']
+            with tracer.span('ec2.get_all_tags'):
+                instance_tags = ec2_connection.get_all_tags(
+                    filters={'resource-id': instance_id},
+                )
+            tags = {
+                tag.name: tag.value
+                for tag in instance_tags
+            }
+        node['tags'] = tags
+        if cache:
+            cache.put(node)
         return node
 
-    def run(self) -> None:
-        is_ami_build = self.node['tags'].get(
+    def _traced(
+        self,
+        span_name: str,
+        func: Callable[..., Any],
+    ) -> Callable[..., Any]:
+        tracer = self.context.tracer
+
+        def traced(*args: Any) -> Any:
+            with tracer.span(span_name):
+                return func(*args)
+        return tracer.wrap(traced)
+
+    def _get_journal(self, daemon: bool=False) -> Optional[Journal]:
+        if self._journal is None:
+            journal_file = self.context.state_file('journal.json')
+            if not self.config['base'].get('journal'):
+                journal_file = None
+            if journal_file or daemon:
+                # the daemon needs at least an in-memory journal to know
+                # what converged in the previous cycles
+                self._journal = Journal(journal_file)
+        return self._journal
+
+    def _get_modules(self) -> Dict[str, AbstractModule]:
+        if not self._modules:
+            for name in self.config['base']['enabled_modules']:
+                self._modules[name] = get_module(name)(
+                    self.node,
+                    self.config[name],
+                    self.config['base']['chroot_path'],
+                    self.context,
+                )
+        return self._modules
+
+    def _converging(
+        self,
+        name: str,
+        module: AbstractModule,
+        journal: Optional[Journal],
+        reconcile: bool,
+        ran: List[str],
+    ) -> Callable[..., Any]:
+        def converge(*args: Any) -> Any:
+            inputs = module.fingerprint(*args) if journal else None
+            if journal and inputs is not None:
+                converged, result = journal.lookup(name, inputs)
+                if converged and reconcile:
+                    log.info('Module %s converged, reconciling', name)
+                    ran.append(name)
+                    return module.reconcile(result, *args)
+                if converged:
+                    log.info('Module %s already converged, skipping', name)
+                    return result
+            ran.append(name)
+            try:
+                result = module.run(*args)
+            except Exception:
+                if journal:
+                    journal.forget(name)
+                raise
+            if journal and inputs is not None:
+                journal.record(name, inputs, module.outputs, result)
+            return result
+        return converge
+
+    def _is_ami_build(self) -> bool:
+        return bool(self.node['tags'].get(
             self.config['base']['ami_build_tag'],
-        )
-        if is_ami_build:
-            log.info('AMI build detected. Sleeping forever')
-            while True:
-                sleep(3600)
+        ))
 
-        chroot_path = self.config['base']['chroot_path']
-        hostname = None
-        fqdn = None
-        if 'hostname' in self.config['base']['enabled_modules']:
-            hostname_module = Hostname(
-                self.node,
-                self.config['hostname'],
-                chroot_path,
-            )
-            hostname = hostname_module.run()
-        if 'hosted_zone' in self.config['base']['enabled_modules']:
-            if not hostname:
-                raise Exception('Dependency module hostname is not enabled')
-            hosted_zone_module = HostedZone(
-                self.node,
-                self.config['hosted_zone'],
-            )
-            fqdn = hosted_zone_module.run(hostname)
-        if 'tinycert' in self.config['base']['enabled_modules']:
-            if not fqdn:
-                raise Exception('Dependency module hosted_zone is not enabled')
-            tinycert_module = TinyCert(
-                self.node,
-                self.config['tinycert'],
-                chroot_path,
-            )
-            tinycert_module.run(fqdn)
-        if 'etcd' in self.config['base']['enabled_modules']:
-            etcd_module = Etcd(
-                self.node,
-                self.config['etcd'],
-                chroot_path,
+    def _handle_signals(self) -> None:
+        def stop(signum: int, frame: Any) -> None:
+            log.info('Received signal %d, stopping', signum)
+            self._stopping = True
+            self._wakeup.set()
+
+        def wakeup(signum: int, frame: Any) -> None:
+            log.info('Received signal %d, reconciling now', signum)
+            self._wakeup.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, wakeup)
+
+    def _wait_forever(self) -> None:
+        self._handle_signals()
+        while not self._stopping:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+    def _run_modules(self, force: bool, reconcile: bool) -> None:
+        pipelined = self.config['base'].get('pipelined', False)
+        scheduler = Scheduler(self.config['base'].get('max_workers', 4))
+        journal = self._get_journal(daemon=reconcile)
+        modules = self._get_modules()
+        if journal and force:
+            # run every module, the journal still records what they
+            # converge to
+            for name in modules:
+                journal.forget(name)
+        # modules that may have queued host actions
+        ran = []  # type: List[str]
+        for name, module in modules.items():
+            # a converged module most likely skips run(), so do not
+            # prefetch for it
+            if pipelined and not (journal and journal.has_converged(name)):
+                prefetch = self._traced('prefetch.%s' % name, module.prefetch)
+            else:
+                prefetch = None
+            scheduler.add(
+                name,
+                self._traced(
+                    'module.%s' % name,
+                    self._converging(name, module, journal, reconcile, ran),
+                ),
+                module.dependencies,
+                prefetch=prefetch,
             )
-            etcd_module.run()
+        if pipelined:
+            for name in scheduler.order():
+                modules[name].publish()
+        try:
+            scheduler.run()
+        finally:
+            # commands queued by the modules that ran
+            try:
+                with self.context.tracer.span('exec.host_actions'):
+                    self.context.actions.flush()
+            except Exception:
+                # run the modules again next time, so that their
+                # commands are retried
+                if journal:
+                    for name in ran:
+                        journal.forget(name)
+                raise
+            finally:
+                self.context.join_background()
+
+    def run(self, force: bool=False) -> None:
+        if self._is_ami_build():
+            log.info('AMI build detected. Sleeping forever')
+            self._wait_forever()
+            return
+        self._run_modules(force, reconcile=False)
+
+    def collect_garbage(self) -> List[str]:
+        """Remove the records of terminated nodes from the hosted zone."""
+        modules = self._get_modules()
+        if 'hosted_zone' not in modules:
+            raise Exception('Module hosted_zone is not enabled')
+        hosted_zone = cast('HostedZone', modules['hosted_zone'])
+        with self.context.tracer.span('gc.hosted_zone'):
+            return hosted_zone.collect_garbage()
+
+    def daemon(
+        self,
+        force: bool=False,
+        report_file: Optional[str]=None,
+    ) -> None:
+        """Reconcile the node every daemon_interval seconds or on SIGHUP.
+
+        Config, AWS connections, caches and module instances are kept
+        between cycles. Modules that converged only check for drift.
+        """
+        interval = self.config['base'].get('daemon_interval', 300)
+        self._handle_signals()
+        first_cycle = True
+        while not self._stopping:
+            if not first_cycle:
+                self.context.tracer = Tracer()
+            try:
+                if not first_cycle:
+                    with self.context.tracer.span('metadata'):
+                        self.node.update(self._get_node_metadata())
+                if self._is_ami_build():
+                    log.info('AMI build detected. Not reconciling')
+                else:
+                    self._run_modules(force and first_cycle, reconcile=True)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Reconcile cycle failed')
+            if report_file:
+                self.context.tracer.write_report(report_file)
+            first_cycle = False
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
 
 
 def _get_args() -> argparse.Namespace:
@@ -106,16 +306,93 @@ def _get_args() -> argparse.Namespace:
         action='store',
         help='Path to config file',
     )
+    arg_parser.add_argument(
+        '--config-cache-dir',
+        dest='config_cache_dir',
+        action='store',
+        help=(
+            'Cache the merged config here, set it empty to disable. '
+            'Defaults to /media/root/var/cache/nodereg when the host root '
+            'is mounted there, /var/cache/nodereg otherwise'
+        ),
+    )
+    arg_parser.add_argument(
+        '--print-config',
+        dest='print_config',
+        action='store_true',
+        help='Print the merged config and exit',
+    )
+    arg_parser.add_argument(
+        '--refresh-metadata',
+        dest='refresh_metadata',
+        action='store_true',
+        help='Ignore the cached node metadata',
+    )
+    arg_parser.add_argument(
+        '-f',
+        '--force',
+        dest='force',
+        action='store_true',
+        help='Run all modules, even the ones that already converged',
+    )
+    arg_parser.add_argument(
+        '-d',
+        '--daemon',
+        dest='daemon',
+        action='store_true',
+        help='Keep running and reconcile the node periodically',
+    )
+    arg_parser.add_argument(
+        '--gc',
+        dest='gc',
+        action='store_true',
+        help='Remove the DNS records of terminated nodes and exit',
+    )
+    arg_parser.add_argument(
+        '-r',
+        '--report',
+        dest='report',
+        action='store',
+        help='Write a JSON report with the timing of the run to this path',
+    )
     args = arg_parser.parse_args()
+    if args.config_cache_dir is None:
+        args.config_cache_dir = default_cache_dir()
     return args
 
 
-def main() -> None:
-    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+def main(gc: bool=False) -> None:
     args = _get_args()
+    # keep the printed config clean of log lines
+    log_stream = sys.stderr if args.print_config else sys.stdout
+    logging.basicConfig(stream=log_stream, level=logging.DEBUG)
     custom_config_file = args.config
-    registrator = Registrator(custom_config_file)
-    registrator.run()
+    if args.print_config:
+        import yaml
+        config = read_config(custom_config_file, args.config_cache_dir)
+        sys.stdout.write(yaml.safe_dump(config, default_flow_style=False))
+        return
+    registrator = Registrator(
+        custom_config_file,
+        args.refresh_metadata,
+        args.config_cache_dir,
+    )
+    report_file = args.report or registrator.config['base'].get('report_file')
+    if args.daemon:
+        registrator.daemon(args.force, report_file)
+        return
+    try:
+        if gc or args.gc:
+            registrator.collect_garbage()
+        else:
+            registrator.run(args.force)
+    finally:
+        if report_file:
+            registrator.context.tracer.write_report(report_file)
+
+
+def gc_main() -> None:
+    main(gc=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Set
+
+log = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+
+    def __init__(self, max_workers: int=4) -> None:
+        self.max_workers = max_workers
+        self.tasks = {}  # type: Dict[str, Callable[..., Any]]
+        self.dependencies = {}  # type: Dict[str, List[str]]
+        self.prefetches = {}  # type: Dict[str, Callable[[], None]]
+
+    def add(
+        self,
+        name: str,
+        task: Callable[..., Any],
+        dependencies: List[str],
+        prefetch: Optional[Callable[[], None]]=None,
+    ) -> None:
+        self.tasks[name] = task
+        self.dependencies[name] = list(dependencies)
+        if prefetch:
+            self.prefetches[name] = prefetch
+
+    def _validate(self) -> None:
+        for name, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                if dependency not in self.tasks:
+                    raise Exception(
+                        'Dependency module %s is not enabled' % dependency,
+                    )
+        visited = set()  # type: Set[str]
+        for name in self.tasks:
+            path = []  # type: List[str]
+            self._check_cycle(name, path, visited)
+
+    def _check_cycle(
+        self,
+        name: str,
+        path: List[str],
+        visited: Set[str],
+    ) -> None:
+        if name in path:
+            raise Exception(
+                'Dependency cycle detected: %s' % ' -> '.join(path + [name]),
+            )
+        if name in visited:
+            return
+        path.append(name)
+        for dependency in self.dependencies[name]:
+            self._check_cycle(dependency, path, visited)
+        path.pop()
+        visited.add(name)
+
+    def order(self) -> List[str]:
+        """Return the task names so that dependencies come first."""
+        self._validate()
+        ordered = []  # type: List[str]
+        while len(ordered) < len(self.tasks):
+            ordered.extend(self._ready(set(ordered), set(ordered)))
+        return ordered
+
+    def _ready(self, done: Set[str], started: Set[str]) -> List[str]:
+        return [
+            name
+            for name in self.tasks
+            if name not in started
+            and all(dep in done for dep in self.dependencies[name])
+        ]
+
+    def _prefetch(self, name: str) -> None:
+        try:
+            self.prefetches[name]()
+        except Exception:  # pylint: disable=broad-except
+            # prefetching is speculative, the task does the work itself
+            log.warning('Prefetch for module %s failed', name, exc_info=True)
+
+    def _run_task(
+        self,
+        name: str,
+        prefetch: Optional[Future],
+        args: List[Any],
+    ) -> Any:
+        if prefetch:
+            prefetch.result()
+        return self.tasks[name](*args)
+
+    def run(self) -> Dict[str, Any]:
+        """Run all tasks, each one as soon as its dependencies finished.
+
+        A task is called with the results of its dependencies as positional
+        arguments, in the order the dependencies were declared.
+        Prefetches start right away and a task waits for its own prefetch
+        before running.
+        """
+        self._validate()
+        results = {}  # type: Dict[str, Any]
+        started = set()  # type: Set[str]
+        running = {}  # type: Dict[Future, str]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            prefetches = {
+                name: executor.submit(self._prefetch, name)
+                for name in self.prefetches
+            }
+            while len(results) < len(self.tasks):
+                for name in self._ready(set(results), started):
+                    args = [results[dep] for dep in self.dependencies[name]]
+                    log.debug('Starting module %s', name)
+                    future = executor.submit(
+                        self._run_task,
+                        name,
+                        prefetches.get(name),
+                        args,
+                    )
+                    running[future] = name
+                    started.add(name)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error:
+                        for pending in running:
+                            pending.cancel()
+                        raise error
+                    log.debug('Module %s finished', name)
+                    results[name] = future.result()
+        return results
@@ -0,0 +1,132 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from os import makedirs, path
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class Span(object):
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self.duration = None  # type: Optional[float]
+        self.retries = 0
+        self.error = None  # type: Optional[str]
+        self.children = []  # type: List[Span]
+
+    def retry(self) -> None:
+        self.retries += 1
+
+    def finish(self) -> None:
+        self.duration = time.monotonic() - self._start
+
+    def to_dict(self) -> Dict[str, Any]:
+        span = {
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'retries': self.retries,
+            'children': [child.to_dict() for child in self.children],
+        }  # type: Dict[str, Any]
+        if self.error:
+            span['error'] = self.error
+        return span
+
+
+class Tracer(object):
+    """Collects nested timing spans of a run.
+
+    Spans nest per thread; spans opened in a thread without an open span
+    are attached to the root span of the run, unless the thread runs a
+    function bound to a span with wrap().
+    """
+
+    def __init__(self) -> None:
+        self.root = Span('run')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = [self.root]
+        return self._local.stack
+
+    def current(self) -> Span:
+        """The innermost span open in this thread."""
+        return self._stack()[-1]
+
+    @contextmanager
+    def attach(self, parent: Span) -> Iterator[None]:
+        """Nest the spans this thread opens under parent."""
+        stack = self._stack()
+        stack.append(parent)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def wrap(self, func: Callable[..., T]) -> Callable[..., T]:
+        """Bind func to the current span, to call it in another thread."""
+        parent = self.current()
+
+        def attached(*args: Any, **kwargs: Any) -> T:
+            with self.attach(parent):
+                return func(*args, **kwargs)
+        return attached
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        stack = self._stack()
+        span = Span(name)
+        with self._lock:
+            stack[-1].children.append(span)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.error = repr(error)
+            raise
+        finally:
+            span.finish()
+            stack.pop()
+            log.debug('%s took %.3fs', name, span.duration)
+
+    def _summarize(
+        self,
+        span: Span,
+        calls: Dict[str, Dict[str, Any]],
+    ) -> None:
+        for child in span.children:
+            call = calls.setdefault(
+                child.name,
+                {'count': 0, 'duration': 0.0, 'retries': 0, 'errors': 0},
+            )
+            call['count'] += 1
+            call['duration'] += child.duration or 0.0
+            call['retries'] += child.retries
+            call['errors'] += 1 if child.error else 0
+            self._summarize(child, calls)
+
+    def report(self) -> Dict[str, Any]:
+        if self.root.duration is None:
+            self.root.finish()
+        calls = {}  # type: Dict[str, Dict[str, Any]]
+        self._summarize(self.root, calls)
+        return {
+            'span': self.root.to_dict(),
+            'calls': calls,
+        }
+
+    def write_report(self, report_file: str) -> None:
+        makedirs(path.dirname(path.abspath(report_file)), exist_ok=True)
+        with open(report_file, 'w') as _file:
+            json.dump(self.report(), _file, indent=2, sort_keys=True)
+        log.info('Boot report written to %s', report_file)
@@ -28,8 +28,12 @@ setup(
     install_requires=[
         'boto',
         'PyYAML',
+        'requests',
         'tinycert>=0.2.0',
     ],
+    extras_require={
+        'pki': ['cryptography'],
+    },
     setup_requires=[
         'pytest-runner',
     ],
@@ -41,6 +45,7 @@ setup(
     entry_points={
         'console_scripts': [
             'nodereg = nodereg.run:main',
+            'nodereg-gc = nodereg.run:gc_main',
         ],
     },
 )
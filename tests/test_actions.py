@@ -0,0 +1,97 @@
+import subprocess
+from unittest import mock
+
+import pytest
+
+from nodereg.actions import HostActions
+
+
+@mock.patch('subprocess.run')
+def test_immediate(subprocess_run):
+    actions = HostActions()
+    actions.enqueue(['hostnamectl', 'set-hostname', 'node'])
+    subprocess_run.assert_called_once_with(
+        ['hostnamectl', 'set-hostname', 'node'],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+
+
+@mock.patch('subprocess.run')
+def test_deferred(subprocess_run):
+    actions = HostActions('/mnt', deferred=True)
+    actions.mark_changed('/etc/a')
+    actions.enqueue(['systemctl', 'daemon-reload'], triggers=['/etc/a'])
+    actions.enqueue(['hostnamectl', 'set-hostname', 'my node'])
+    actions.enqueue(['systemctl', 'daemon-reload'], triggers=['/etc/a'])
+    subprocess_run.assert_not_called()
+    actions.flush()
+    subprocess_run.assert_called_once_with(
+        [
+            'chroot',
+            '/mnt',
+            'sh',
+            '-c',
+            "systemctl daemon-reload && hostnamectl set-hostname 'my node'",
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    actions.flush()
+    assert subprocess_run.call_count == 1
+
+
+@mock.patch('subprocess.run')
+def test_unchanged_triggers(subprocess_run):
+    actions = HostActions(deferred=True)
+    actions.mark_changed('/etc/b')
+    actions.enqueue(['update-ca-certificates'], triggers=['/etc/a'])
+    actions.flush()
+    subprocess_run.assert_not_called()
+
+
+@mock.patch('subprocess.run')
+def test_write_file(subprocess_run, tmpdir):
+    file_path = str(tmpdir.join('conf.d', 'file'))
+    actions = HostActions(deferred=True)
+    assert actions.write_file(file_path, 'content')
+    assert open(file_path).read() == 'content'
+    actions = HostActions(deferred=True)
+    assert not actions.write_file(file_path, 'content')
+    actions.enqueue(['systemctl', 'daemon-reload'], triggers=[file_path])
+    actions.flush()
+    subprocess_run.assert_not_called()
+
+
+@mock.patch('subprocess.run')
+def test_changes_reset_on_flush(subprocess_run):
+    actions = HostActions(deferred=True)
+    actions.mark_changed('/etc/a')
+    actions.enqueue(['systemctl', 'daemon-reload'], triggers=['/etc/a'])
+    actions.flush()
+    actions.enqueue(['systemctl', 'daemon-reload'], triggers=['/etc/a'])
+    actions.flush()
+    assert subprocess_run.call_count == 1
+
+
+@mock.patch('subprocess.run')
+def test_failed_triggers_kept(subprocess_run, tmpdir):
+    state_file = str(tmpdir.join('host-actions.json'))
+    actions = HostActions(deferred=True, state_file=state_file)
+    actions.mark_changed('/etc/hostname')
+    actions.enqueue(['hostnamectl'], triggers=['/etc/hostname'])
+    subprocess_run.side_effect = subprocess.CalledProcessError(1, 'cmd')
+    with pytest.raises(subprocess.CalledProcessError):
+        actions.flush()
+
+    # the next run still sees the file as changed
+    subprocess_run.side_effect = None
+    actions = HostActions(deferred=True, state_file=state_file)
+    actions.enqueue(['hostnamectl'], triggers=['/etc/hostname'])
+    actions.flush()
+    subprocess_run.assert_called_with(
+        ['hostnamectl'],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    assert not tmpdir.join('host-actions.json').check()
@@ -0,0 +1,33 @@
+import os
+import stat
+
+from nodereg.cache import JsonCache
+
+
+def test_missing_cache(tmpdir):
+    cache = JsonCache(str(tmpdir.join('missing.json')))
+    assert cache.load() == {}
+
+
+def test_save_and_load(tmpdir):
+    cache_file = str(tmpdir.join('state', 'cache.json'))
+    cache = JsonCache(cache_file, mode=0o600)
+    cache.save({'a': 1})
+    assert JsonCache(cache_file).load() == {'a': 1}
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+    assert os.listdir(str(tmpdir.join('state'))) == ['cache.json']
+
+
+def test_corrupt_cache(tmpdir):
+    cache_file = tmpdir.join('cache.json')
+    cache_file.write('{not json')
+    assert JsonCache(str(cache_file)).load() == {}
+
+
+def test_invalidate(tmpdir):
+    cache_file = str(tmpdir.join('cache.json'))
+    cache = JsonCache(cache_file)
+    cache.save({'a': 1})
+    cache.invalidate()
+    assert not os.path.exists(cache_file)
+    cache.invalidate()
@@ -0,0 +1,37 @@
+from unittest import mock
+
+import pytest
+
+from nodereg.clients import ClientRegistry
+
+
+@mock.patch('boto.ec2.connect_to_region')
+def test_client_reused(connect_to_region):
+    clients = ClientRegistry()
+    first = clients.get('ec2', 'eu-west-1')
+    second = clients.get('ec2', 'eu-west-1')
+    assert first is second
+    connect_to_region.assert_called_once_with('eu-west-1')
+
+
+@mock.patch('boto.ec2.connect_to_region')
+def test_client_per_region(connect_to_region):
+    clients = ClientRegistry()
+    clients.get('ec2', 'eu-west-1')
+    clients.get('ec2', 'us-east-1')
+    assert connect_to_region.call_count == 2
+
+
+@mock.patch('boto.route53.connect_to_region')
+@mock.patch('boto.ec2.autoscale.connect_to_region')
+def test_services(asg_connect_to_region, r53_connect_to_region):
+    clients = ClientRegistry()
+    assert clients.get('autoscale', 'eu-west-1') is \
+        asg_connect_to_region.return_value
+    assert clients.get('route53', 'eu-west-1') is \
+        r53_connect_to_region.return_value
+
+
+def test_unknown_service():
+    with pytest.raises(Exception):
+        ClientRegistry().get('s3', 'eu-west-1')
@@ -0,0 +1,116 @@
+import json
+import os
+import stat
+from unittest import mock
+
+import pytest
+
+from nodereg.config import (
+    DEFAULT_CONFIG_FILE,
+    ConfigLoader,
+    default_cache_dir,
+    read_config,
+)
+
+
+def write_config(tmpdir, content):
+    config_file = tmpdir.join('custom.yaml')
+    config_file.write(content)
+    return str(config_file)
+
+
+def test_default_config():
+    config = read_config()
+    assert config['base']['enabled_modules'] == [
+        'hostname',
+        'hosted_zone',
+        'tinycert',
+        'etcd',
+    ]
+
+
+def test_custom_config_overrides_sections(tmpdir):
+    custom_config_file = write_config(tmpdir, '\n'.join([
+        'hosted_zone:',
+        '  name: example.com.',
+    ]))
+    config = read_config(custom_config_file)
+    assert config['hosted_zone'] == {'name': 'example.com.'}
+    assert config['hostname']['tag_name'] == 'Role'
+
+
+def test_invalid_config(tmpdir):
+    custom_config_file = write_config(tmpdir, '\n'.join([
+        'base:',
+        '  chroot_path: false',
+    ]))
+    with pytest.raises(Exception) as e_info:
+        read_config(custom_config_file)
+    assert 'base.ami_build_tag' in str(e_info.value)
+
+
+def test_missing_module_section(tmpdir):
+    custom_config_file = write_config(tmpdir, '\n'.join([
+        'base:',
+        '  ami_build_tag: is_ami_build',
+        '  chroot_path: false',
+        '  enabled_modules: [dns]',
+    ]))
+    with pytest.raises(Exception) as e_info:
+        read_config(custom_config_file)
+    assert str(e_info.value) == 'Missing config section dns'
+
+
+def test_cached_config(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    custom_config_file = write_config(tmpdir, 'etcd:\n  client_port: 1\n')
+    config = read_config(custom_config_file, cache_dir)
+    assert config['etcd'] == {'client_port': 1}
+
+    loader = ConfigLoader(cache_dir)
+    with mock.patch.object(loader, '_parse') as parse:
+        cached_config = loader.load([DEFAULT_CONFIG_FILE, custom_config_file])
+    parse.assert_not_called()
+    assert cached_config == config
+    cache_file = os.path.join(cache_dir, 'config.cache')
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+    assert os.listdir(cache_dir) == ['config.cache']
+
+
+def test_cache_invalidated_on_change(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    custom_config_file = write_config(tmpdir, 'etcd:\n  client_port: 1\n')
+    read_config(custom_config_file, cache_dir)
+    write_config(tmpdir, 'etcd:\n  client_port: 2\n')
+    config = read_config(custom_config_file, cache_dir)
+    assert config['etcd'] == {'client_port': 2}
+
+
+def test_unwritable_cache_dir(tmpdir):
+    cache_dir = tmpdir.join('cache')
+    cache_dir.write('not a directory')
+    config = read_config(cache_dir=str(cache_dir))
+    assert 'base' in config
+
+
+def test_uncacheable_config(tmpdir):
+    cache_dir = tmpdir.join('cache')
+    custom_config_file = write_config(tmpdir, 'etcd:\n  since: 2020-01-01\n')
+    config = read_config(custom_config_file, str(cache_dir))
+    assert str(config['etcd']['since']) == '2020-01-01'
+    assert not cache_dir.join('config.cache').check()
+
+
+def test_unreadable_cache(tmpdir):
+    cache_dir = tmpdir.join('cache')
+    cache_dir.join('config.cache').write_binary(b'\x80\x04K\x01.', ensure=True)
+    config = read_config(cache_dir=str(cache_dir))
+    assert 'base' in config
+    assert json.loads(cache_dir.join('config.cache').read())['config'] == config
+
+
+def test_default_cache_dir(tmpdir):
+    with mock.patch('nodereg.config.HOST_ROOT', str(tmpdir)):
+        assert default_cache_dir() == str(tmpdir.join('var/cache/nodereg'))
+    with mock.patch('nodereg.config.HOST_ROOT', str(tmpdir.join('missing'))):
+        assert default_cache_dir() == '/var/cache/nodereg'
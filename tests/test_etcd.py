@@ -6,7 +6,7 @@ from boto import ec2
 from boto.ec2 import autoscale
 from moto import mock_autoscaling, mock_ec2
 
-from nodereg.modules import Etcd
+from nodereg.modules.etcd import Etcd
 
 
 def get_node(instance_id='i-123', ip_address='10.0.0.123'):
@@ -116,13 +116,13 @@ def get_file_content(initial_cluster, state):
 
 @mock_ec2
 @mock_autoscaling
-@mock.patch('builtins.open', new_callable=mock.mock_open)
+@mock.patch('nodereg.files.FileWriter.write', return_value=True)
 @mock.patch('subprocess.run')
 @mock.patch('requests.get')
 def test_new_cluster(
     requests_get,
     subprocess_run,
-    builtins_open,
+    file_writer_write,
 ):
     node = get_node()
     instance_ids = get_asg_instance_ids(node['region'])
@@ -140,8 +140,8 @@ def test_new_cluster(
     etcd_module = Etcd(node, config, False)
     etcd_module.run()
 
-    builtins_open.assert_called_once_with(config['drop_in_file'], 'w')
-    builtins_open().write.assert_called_once_with(
+    file_writer_write.assert_called_once_with(
+        config['drop_in_file'],
         get_file_content(initial_cluster, 'new'),
     )
     subprocess_run.assert_called_once_with(
@@ -153,7 +153,7 @@ def test_new_cluster(
 
 @mock_ec2
 @mock_autoscaling
-@mock.patch('builtins.open', new_callable=mock.mock_open)
+@mock.patch('nodereg.files.FileWriter.write', return_value=True)
 @mock.patch('subprocess.run')
 @mock.patch('requests.get')
 @mock.patch('requests.post')
@@ -163,7 +163,7 @@ def test_new_member_existing_cluster(
     requests_post,
     requests_get,
     subprocess_run,
-    builtins_open,
+    file_writer_write,
 ):
     node = get_node()
     instance_ids = get_asg_instance_ids(node['region'])
@@ -222,8 +222,8 @@ def test_new_member_existing_cluster(
         json=post_data,
         timeout=5,
     )
-    builtins_open.assert_called_once_with(config['drop_in_file'], 'w')
-    builtins_open().write.assert_called_once_with(
+    file_writer_write.assert_called_once_with(
+        config['drop_in_file'],
         get_file_content(initial_cluster, 'existing'),
     )
     subprocess_run.assert_called_once_with(
@@ -231,3 +231,16 @@ def test_new_member_existing_cluster(
         check=True,
         stdout=-1,
     )
+
+
+def test_reconcile_without_healthy_member():
+    etcd_module = Etcd(get_node(), get_config(), False)
+    with mock.patch.object(etcd_module, '_get_expected_members'), \
+            mock.patch.object(
+                etcd_module,
+                '_find_healthy_member',
+                return_value=None,
+            ), \
+            mock.patch.object(etcd_module, 'run') as run:
+        assert etcd_module.reconcile('result') == 'result'
+    run.assert_not_called()
@@ -0,0 +1,91 @@
+import os
+import stat
+from unittest import mock
+
+import pytest
+
+from nodereg.files import FileWriter
+
+
+def test_write(tmpdir):
+    file_path = str(tmpdir.join('etc', 'node.conf'))
+    with mock.patch('nodereg.files.os.umask', return_value=0o027):
+        writer = FileWriter()
+    assert writer.write(file_path, 'content\n')
+    assert tmpdir.join('etc', 'node.conf').read() == 'content\n'
+    assert stat.S_IMODE(os.stat(file_path).st_mode) == 0o640
+    assert tmpdir.join('etc').listdir() == [tmpdir.join('etc', 'node.conf')]
+
+
+def test_write_mode(tmpdir):
+    file_path = str(tmpdir.join('node-key.pem'))
+    writer = FileWriter()
+    assert writer.write(file_path, 'key\n', 0o600)
+    assert stat.S_IMODE(os.stat(file_path).st_mode) == 0o600
+    os.chmod(file_path, 0o644)
+    assert not writer.write(file_path, 'key\n', 0o600)
+    assert stat.S_IMODE(os.stat(file_path).st_mode) == 0o600
+
+
+def test_write_keeps_mode(tmpdir):
+    tmpdir.join('node.conf').write('old\n')
+    file_path = str(tmpdir.join('node.conf'))
+    os.chmod(file_path, 0o640)
+    with mock.patch('nodereg.files.fchown') as fchown:
+        assert FileWriter().write(file_path, 'new\n')
+    assert stat.S_IMODE(os.stat(file_path).st_mode) == 0o640
+    file_stat = os.stat(file_path)
+    fchown.assert_called_once_with(
+        mock.ANY,
+        file_stat.st_uid,
+        file_stat.st_gid,
+    )
+
+
+def test_write_unchanged(tmpdir):
+    tmpdir.join('node.conf').write('content\n')
+    file_path = str(tmpdir.join('node.conf'))
+    writer = FileWriter()
+    with mock.patch('nodereg.files.replace') as replace:
+        assert not writer.write(file_path, 'content\n')
+    replace.assert_not_called()
+
+
+def test_write_failure(tmpdir):
+    tmpdir.join('node.conf').write('old\n')
+    writer = FileWriter()
+    with mock.patch('nodereg.files.replace', side_effect=OSError):
+        with pytest.raises(OSError):
+            writer.write(str(tmpdir.join('node.conf')), 'new\n')
+    assert tmpdir.join('node.conf').read() == 'old\n'
+    assert tmpdir.listdir() == [tmpdir.join('node.conf')]
+
+
+def test_symlink(tmpdir):
+    link_path = str(tmpdir.join('host.pem'))
+    writer = FileWriter()
+    assert writer.symlink('a.pem', link_path)
+    assert os.readlink(link_path) == 'a.pem'
+    assert not writer.symlink('a.pem', link_path)
+    assert writer.symlink('b.pem', link_path)
+    assert os.readlink(link_path) == 'b.pem'
+    assert tmpdir.listdir() == [tmpdir.join('host.pem')]
+
+
+def test_symlink_replaces_file(tmpdir):
+    tmpdir.join('host.pem').write('content')
+    link_path = str(tmpdir.join('host.pem'))
+    assert FileWriter().symlink('a.pem', link_path)
+    assert os.readlink(link_path) == 'a.pem'
+
+
+@mock.patch('nodereg.files.fsync')
+def test_sync_once_per_directory(fsync, tmpdir):
+    with FileWriter() as writer:
+        writer.write(str(tmpdir.join('a.pem')), 'a')
+        writer.write(str(tmpdir.join('b.pem')), 'b')
+        writer.symlink('a.pem', str(tmpdir.join('host.pem')))
+        file_syncs = fsync.call_count
+    assert fsync.call_count == file_syncs + 1
+    writer.sync()
+    assert fsync.call_count == file_syncs + 1
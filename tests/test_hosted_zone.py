@@ -1,8 +1,12 @@
+from unittest import mock
+
 import pytest
 from boto import route53
+from boto.route53.exception import DNSServerError
 from moto import mock_route53
 
-from nodereg.modules import HostedZone
+from nodereg.context import RunContext
+from nodereg.modules.hosted_zone import HostedZone
 
 
 def get_node():
@@ -75,6 +79,32 @@ def test_stale_record():
     assert record.resource_records == [node['metadata']['local-ipv4']]
 
 
+@mock_route53
+def test_multi_value_stale_record():
+    node = get_node()
+    config = get_config()
+
+    r53 = route53.connect_to_region(node['region'])
+    zone = r53.create_zone(
+        config['name'],
+        private_zone=True,
+        vpc_id='1',
+        vpc_region=node['region'],
+    )
+    stale_fqdn = '.'.join(['workers', zone.name.lower()])
+    zone.add_record(
+        'A',
+        stale_fqdn,
+        ['10.0.0.1', node['metadata']['local-ipv4']],
+    )
+
+    hosted_zone_module = HostedZone(node, config)
+    fqdn = hosted_zone_module.run('master0-123')
+    assert zone.get_a(stale_fqdn).resource_records == ['10.0.0.1']
+    record = zone.get_a(fqdn)
+    assert record.resource_records == [node['metadata']['local-ipv4']]
+
+
 @mock_route53
 def test_present_record():
     node = get_node()
@@ -97,3 +127,363 @@ def test_present_record():
     record = zone.get_a(fqdn)
     assert fqdn == expected_fqdn
     assert record.resource_records == expected_record.resource_records
+
+
+@mock_route53
+def test_indexed_stale_record():
+    node = get_node()
+    config = get_config()
+    config['lookup'] = 'targeted'
+    config['scan_limit'] = 0
+
+    r53 = route53.connect_to_region(node['region'])
+    zone = r53.create_zone(
+        config['name'],
+        private_zone=True,
+        vpc_id='1',
+        vpc_region=node['region'],
+    )
+    stale_fqdn = '.'.join(['worker', zone.name.lower()])
+    zone.add_a(stale_fqdn, node['metadata']['local-ipv4'], ttl=60)
+    index_name = '.'.join(['_nodereg-ip-10-0-0-123', zone.name.lower()])
+    zone.add_record('TXT', index_name, '"%s"' % stale_fqdn)
+
+    hosted_zone_module = HostedZone(node, config)
+    hostname = 'master0-123'
+    fqdn = hosted_zone_module.run(hostname)
+    assert zone.get_a(stale_fqdn) == None
+    record = zone.get_a(fqdn)
+    assert record.resource_records == [node['metadata']['local-ipv4']]
+    index = zone.find_records(index_name, 'TXT')
+    assert index.resource_records == [
+        '"%s"' % fqdn,
+        '"nodereg-region=%s"' % node['region'],
+    ]
+
+
+def get_r53_connection():
+    r53_connection = mock.Mock()
+    r53_connection.get_zone.return_value = route53.zone.Zone(
+        r53_connection,
+        {'Id': '/hostedzone/Z123', 'Name': 'k8s.com.'},
+    )
+    r53_connection.get_hosted_zone.return_value = {
+        'GetHostedZoneResponse': {
+            'HostedZone': {'Id': '/hostedzone/Z123', 'Name': 'k8s.com.'},
+        },
+    }
+    return r53_connection
+
+
+def test_zone_id():
+    node = get_node()
+    config = get_config()
+    config['id'] = 'Z123'
+    context = RunContext()
+    r53_connection = get_r53_connection()
+    with mock.patch.object(context.clients, 'get') as clients_get:
+        clients_get.return_value = r53_connection
+        zone = HostedZone(node, config, None, context)._get_zone()
+    assert zone.id == 'Z123'
+    r53_connection.get_hosted_zone.assert_called_once_with('Z123')
+    r53_connection.get_zone.assert_not_called()
+
+
+def test_missing_zone_id():
+    node = get_node()
+    config = get_config()
+    config['id'] = 'Z404'
+    context = RunContext()
+    r53_connection = get_r53_connection()
+    r53_connection.get_hosted_zone.side_effect = DNSServerError(
+        404,
+        'Not Found',
+    )
+    with mock.patch.object(context.clients, 'get') as clients_get:
+        clients_get.return_value = r53_connection
+        with pytest.raises(Exception) as e_info:
+            HostedZone(node, config, None, context)._get_zone()
+    assert str(e_info.value) == 'Hosted Zone Z404 not found'
+
+
+def test_cached_zone_id(tmpdir):
+    node = get_node()
+    config = get_config()
+    context = RunContext(str(tmpdir))
+    r53_connection = get_r53_connection()
+    with mock.patch.object(context.clients, 'get') as clients_get:
+        clients_get.return_value = r53_connection
+        assert HostedZone(node, config, None, context)._get_zone().id == 'Z123'
+        r53_connection.get_hosted_zone.assert_not_called()
+        assert HostedZone(node, config, None, context)._get_zone().id == 'Z123'
+        r53_connection.get_hosted_zone.assert_called_once_with('Z123')
+        assert r53_connection.get_zone.call_count == 1
+
+        # the zone was recreated with another ID
+        r53_connection.get_hosted_zone.side_effect = DNSServerError(
+            404,
+            'Not Found',
+        )
+        assert HostedZone(node, config, None, context)._get_zone().id == 'Z123'
+        assert r53_connection.get_zone.call_count == 2
+
+
+def test_collect_garbage():
+    node = get_node()
+    config = get_config()
+    config['id'] = 'Z123'
+    context = RunContext()
+    r53_connection = get_r53_connection()
+    r53_connection.get_all_rrsets.return_value = [
+        route53.record.Record('k8s.com.', 'NS', resource_records=['ns']),
+        route53.record.Record(
+            'master0-123.k8s.com.',
+            'A',
+            resource_records=['10.0.0.123'],
+        ),
+        route53.record.Record(
+            'master0-124.k8s.com.',
+            'A',
+            resource_records=['10.0.0.124'],
+        ),
+        route53.record.Record(
+            '_nodereg-ip-10-0-0-124.k8s.com.',
+            'TXT',
+            resource_records=[
+                '"master0-124.k8s.com."',
+                '"nodereg-region=eu-west-1"',
+            ],
+        ),
+        # registered from another region, its interface is not listed
+        route53.record.Record(
+            'master1-5.k8s.com.',
+            'A',
+            resource_records=['10.2.0.5'],
+        ),
+        route53.record.Record(
+            '_nodereg-ip-10-2-0-5.k8s.com.',
+            'TXT',
+            resource_records=[
+                '"master1-5.k8s.com."',
+                '"nodereg-region=us-east-1"',
+            ],
+        ),
+        route53.record.Record(
+            'masters.k8s.com.',
+            'A',
+            resource_records=['10.0.0.123', '10.0.0.124'],
+        ),
+        route53.record.Record(
+            'public.k8s.com.',
+            'A',
+            resource_records=['52.0.0.1'],
+        ),
+        # not registered by nodereg, e.g. a host of a peered VPC
+        route53.record.Record(
+            'peer.k8s.com.',
+            'A',
+            resource_records=['10.1.0.5'],
+        ),
+    ]
+    r53_connection.change_rrsets.return_value = {
+        'ChangeResourceRecordSetsResponse': {
+            'ChangeInfo': {'Id': '/change/C123', 'Status': 'INSYNC'},
+        },
+    }
+    ec2_connection = mock.Mock()
+    ec2_connection.get_all_network_interfaces.return_value = [
+        mock.Mock(
+            private_ip_address='10.0.0.123',
+            private_ip_addresses=[mock.Mock(private_ip_address='10.0.0.123')],
+        ),
+    ]
+    with mock.patch.object(context.clients, 'get') as clients_get:
+        clients_get.side_effect = lambda service, region: {
+            'ec2': ec2_connection,
+            'route53': r53_connection,
+        }[service]
+        hosted_zone_module = HostedZone(node, config, None, context)
+        assert hosted_zone_module.collect_garbage() == [
+            '_nodereg-ip-10-0-0-124.k8s.com.',
+            'master0-124.k8s.com.',
+            'masters.k8s.com.',
+        ]
+    r53_connection.change_rrsets.assert_called_once()
+    changes = r53_connection.change_rrsets.call_args[0][1]
+    assert changes.count('<Action>DELETE</Action>') == 2
+    assert changes.count('<Action>UPSERT</Action>') == 1
+    assert '52.0.0.1' not in changes
+    assert '10.1.0.5' not in changes
+    assert '10.2.0.5' not in changes
+
+
+def test_multiple_zones():
+    node = get_node()
+    config = get_config()
+    config['zones'] = [
+        {'name': 'k8s.com.', 'id': 'Z123'},
+        {'name': 'example.com.', 'id': 'Z456'},
+    ]
+    context = RunContext()
+    r53_connection = mock.Mock()
+    r53_connection.get_hosted_zone.side_effect = lambda zone_id: {
+        'GetHostedZoneResponse': {
+            'HostedZone': {
+                'Id': '/hostedzone/%s' % zone_id,
+                'Name': {'Z123': 'k8s.com.', 'Z456': 'example.com.'}[zone_id],
+            },
+        },
+    }
+    r53_connection.get_all_rrsets.return_value = []
+    r53_connection.change_rrsets.return_value = {
+        'ChangeResourceRecordSetsResponse': {
+            'ChangeInfo': {'Id': '/change/C123', 'Status': 'INSYNC'},
+        },
+    }
+    with mock.patch.object(context.clients, 'get') as clients_get:
+        clients_get.return_value = r53_connection
+        hosted_zone_module = HostedZone(node, config, None, context)
+        assert hosted_zone_module.run('master0-123') == 'master0-123.k8s.com.'
+    changes = {
+        call[0][0]: call[0][1]
+        for call in r53_connection.change_rrsets.call_args_list
+    }
+    assert sorted(changes) == ['Z123', 'Z456']
+    assert 'master0-123.example.com.' in changes['Z456']
+
+
+def test_collect_garbage_multiple_zones():
+    config = get_config()
+    config['zones'] = [
+        {'name': 'k8s.com.', 'id': 'Z123'},
+        {'name': 'example.com.', 'id': 'Z456'},
+    ]
+    hosted_zone_module = HostedZone(get_node(), config, None, RunContext())
+    zone_names = []
+
+    def collect_zone_garbage(zone_module):
+        zone_names.append(zone_module.config['name'])
+        return ['master0-124.%s' % zone_module.config['name']]
+
+    with mock.patch.object(
+        HostedZone,
+        'collect_zone_garbage',
+        autospec=True,
+        side_effect=collect_zone_garbage,
+    ):
+        assert hosted_zone_module.collect_garbage() == [
+            'master0-124.k8s.com.',
+            'master0-124.example.com.',
+        ]
+    assert zone_names == ['k8s.com.', 'example.com.']
+
+
+def test_publish_fqdn():
+    node = get_node()
+    config = get_config()
+    context = RunContext()
+    context.publish('hostname', 'Master0-123')
+    hosted_zone_module = HostedZone(node, config, None, context)
+    hosted_zone_module.publish()
+    assert context.get('fqdn') == 'master0-123.k8s.com.'
+    config['zones'] = [{'name': 'example.com.'}, {'name': 'k8s.com.'}]
+    HostedZone(node, config, None, context).publish()
+    assert context.get('fqdn') == 'master0-123.example.com.'
+
+
+def test_publish_fqdn_zone_id():
+    node = get_node()
+    config = get_config()
+    context = RunContext()
+    context.publish('hostname', 'master0-123')
+    config['zones'] = [{'id': 'Z123'}]
+    HostedZone(node, config, None, context).publish()
+    assert context.get('fqdn') is None
+    # the placeholder name may not be the name of the zone
+    config = dict(get_config(), id='Z123')
+    hosted_zone_module = HostedZone(node, config, None, context)
+    hosted_zone_module.publish()
+    assert context.get('fqdn') is None
+
+    hosted_zone_module._zone = route53.zone.Zone(
+        mock.Mock(),
+        {'Id': '/hostedzone/Z123', 'Name': 'example.com.'},
+    )
+    hosted_zone_module.publish()
+    assert context.get('fqdn') == 'master0-123.example.com.'
+
+
+@mock_route53
+def test_reconcile_drifted_record():
+    node = get_node()
+    config = get_config()
+
+    r53 = route53.connect_to_region(node['region'])
+    zone = r53.create_zone(
+        config['name'],
+        private_zone=True,
+        vpc_id='1',
+        vpc_region=node['region'],
+    )
+    hostname = 'master0-123'
+    fqdn = '.'.join([hostname, zone.name.lower()])
+
+    hosted_zone_module = HostedZone(node, config)
+    assert hosted_zone_module.reconcile(fqdn, hostname) == fqdn
+    record = zone.get_a(fqdn)
+    assert record.resource_records == [node['metadata']['local-ipv4']]
+
+
+def get_rrsets_page(records, next_record=None):
+    listing = route53.record.ResourceRecordSets()
+    listing.extend(records)
+    if next_record:
+        listing.is_truncated = True
+        (
+            listing.next_record_name,
+            listing.next_record_type,
+            listing.next_record_identifier,
+        ) = next_record
+    return listing
+
+
+def test_get_records():
+    r53_connection = mock.Mock()
+    zone = route53.zone.Zone(
+        r53_connection,
+        {'Id': '/hostedzone/Z123', 'Name': 'k8s.com.'},
+    )
+    weighted = [
+        route53.record.Record(
+            'master0-123.k8s.com.',
+            'A',
+            resource_records=['10.0.0.%s' % i],
+            identifier=str(i),
+        )
+        for i in range(3)
+    ]
+    other = route53.record.Record(
+        'master0-124.k8s.com.',
+        'A',
+        resource_records=['10.0.0.124'],
+    )
+    r53_connection.get_all_rrsets.side_effect = [
+        get_rrsets_page(
+            weighted[:2],
+            ('master0-123.k8s.com.', 'A', '2'),
+        ),
+        get_rrsets_page(
+            [weighted[2], other],
+            ('master0-125.k8s.com.', 'A', None),
+        ),
+    ]
+    hosted_zone_module = HostedZone(get_node(), get_config())
+    records = hosted_zone_module._get_records(
+        zone,
+        'master0-123.k8s.com.',
+        'A',
+    )
+    assert records == weighted
+    # the second page is only fetched for the records of the same name
+    assert r53_connection.get_all_rrsets.call_count == 2
+    assert r53_connection.get_all_rrsets.call_args[1]['identifier'] == '2'
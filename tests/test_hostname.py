@@ -1,6 +1,7 @@
+import os
 from unittest import mock
 
-from nodereg.modules import Hostname
+from nodereg.modules.hostname import Hostname
 
 
 def get_node():
@@ -23,6 +24,7 @@ def get_config():
             'glue': '-',
         },
         'glue': '',
+        'backend': 'hostnamectl',
     }
 
 
@@ -62,3 +64,100 @@ def test_chroot(subprocess_run):
         check=True,
         stdout=-1,
     )
+
+
+def share_host_uts(tmpdir):
+    tmpdir.join('proc', '1', 'ns').ensure(dir=True)
+    os.symlink(
+        os.readlink('/proc/self/ns/uts'),
+        str(tmpdir.join('proc', '1', 'ns', 'uts')),
+    )
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.hostname.socket')
+def test_native(socket, subprocess_run, tmpdir):
+    share_host_uts(tmpdir)
+    socket.gethostname.return_value = 'localhost'
+    config = get_config()
+    config['backend'] = 'native'
+    hostname_module = Hostname(get_node(), config, str(tmpdir))
+    assert hostname_module.run() == 'master0-123'
+    assert tmpdir.join('etc', 'hostname').read() == 'master0-123\n'
+    socket.sethostname.assert_called_once_with('master0-123')
+    subprocess_run.assert_not_called()
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.hostname.socket')
+def test_native_up_to_date(socket, subprocess_run, tmpdir):
+    share_host_uts(tmpdir)
+    socket.gethostname.return_value = 'master0-123'
+    tmpdir.join('etc', 'hostname').write('master0-123\n', ensure=True)
+    config = get_config()
+    config['backend'] = 'native'
+    hostname_module = Hostname(get_node(), config, str(tmpdir))
+    with mock.patch('nodereg.files.replace') as replace:
+        assert hostname_module.run() == 'master0-123'
+    replace.assert_not_called()
+    socket.sethostname.assert_not_called()
+    subprocess_run.assert_not_called()
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.hostname.socket')
+def test_native_not_permitted(socket, subprocess_run, tmpdir):
+    share_host_uts(tmpdir)
+    socket.gethostname.return_value = 'localhost'
+    socket.sethostname.side_effect = PermissionError
+    config = get_config()
+    config['backend'] = 'native'
+    hostname_module = Hostname(get_node(), config, str(tmpdir))
+    assert hostname_module.run() == 'master0-123'
+    subprocess_run.assert_called_once_with(
+        [
+            'chroot',
+            str(tmpdir),
+            'hostnamectl',
+            'set-hostname',
+            'master0-123',
+        ],
+        check=True,
+        stdout=-1,
+    )
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.hostname.socket')
+def test_native_own_uts_namespace(socket, subprocess_run, tmpdir):
+    socket.gethostname.return_value = 'localhost'
+    config = get_config()
+    config['backend'] = 'native'
+    hostname_module = Hostname(get_node(), config, str(tmpdir))
+    assert hostname_module.run() == 'master0-123'
+    assert tmpdir.join('etc', 'hostname').read() == 'master0-123\n'
+    socket.sethostname.assert_not_called()
+    subprocess_run.assert_called_once_with(
+        [
+            'chroot',
+            str(tmpdir),
+            'hostnamectl',
+            'set-hostname',
+            'master0-123',
+        ],
+        check=True,
+        stdout=-1,
+    )
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.hostname.socket')
+def test_native_own_uts_namespace_up_to_date(socket, subprocess_run, tmpdir):
+    socket.gethostname.return_value = 'localhost'
+    tmpdir.join('etc', 'hostname').write('master0-123\n', ensure=True)
+    config = get_config()
+    config['backend'] = 'native'
+    hostname_module = Hostname(get_node(), config, str(tmpdir))
+    assert hostname_module.run() == 'master0-123'
+    socket.sethostname.assert_not_called()
+    subprocess_run.assert_not_called()
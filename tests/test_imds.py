@@ -0,0 +1,106 @@
+from unittest import mock
+
+import requests
+
+from nodereg.imds import InstanceMetadata
+
+
+class MockIMDS:
+
+    def __init__(self, values, token='token'):
+        self.values = values
+        self.token = token
+
+    def response(self, status_code, text=''):
+        response = mock.MagicMock()
+        response.status_code = status_code
+        response.text = text
+        if status_code >= 400:
+            response.raise_for_status.side_effect = requests.HTTPError()
+        return response
+
+    def put(self, url, headers, timeout):
+        if self.token is None:
+            raise requests.exceptions.ConnectTimeout()
+        return self.response(200, self.token)
+
+    def get(self, url, headers, timeout):
+        if self.token is not None:
+            if headers != {'X-aws-ec2-metadata-token': self.token}:
+                return self.response(401)
+        key = url.split('/meta-data/', 1)[1]
+        if key not in self.values:
+            return self.response(404)
+        return self.response(200, self.values[key])
+
+
+def get_imds(mock_imds):
+    imds = InstanceMetadata()
+    imds.session = mock.MagicMock()
+    imds.session.put.side_effect = mock_imds.put
+    imds.session.get.side_effect = mock_imds.get
+    return imds
+
+
+def test_get_many():
+    mock_imds = MockIMDS({
+        'instance-id': 'i-123',
+        'local-ipv4': '10.0.0.123',
+    })
+    imds = get_imds(mock_imds)
+    assert imds.get_many(['instance-id', 'local-ipv4', 'missing']) == {
+        'instance-id': 'i-123',
+        'local-ipv4': '10.0.0.123',
+        'missing': None,
+    }
+    # one token for all requests
+    assert imds.session.put.call_count == 1
+    assert imds.session.get.call_count == 3
+
+
+def test_imdsv1_fallback():
+    imds = get_imds(MockIMDS({'instance-id': 'i-123'}, token=None))
+    assert imds.get('instance-id') == 'i-123'
+    imds.session.get.assert_called_once_with(
+        'http://169.254.169.254/latest/meta-data/instance-id',
+        headers={},
+        timeout=2,
+    )
+
+
+def test_get_tags():
+    imds = get_imds(MockIMDS({
+        'tags/instance': 'Role\nis_ami_build',
+        'tags/instance/Role': 'master',
+        'tags/instance/is_ami_build': '',
+    }))
+    assert imds.get_tags() == {'Role': 'master', 'is_ami_build': ''}
+
+
+def test_tags_not_exposed():
+    imds = get_imds(MockIMDS({}))
+    assert imds.get_tags() is None
+
+
+def test_expired_token():
+    mock_imds = MockIMDS({'instance-id': 'i-123'})
+    imds = get_imds(mock_imds)
+    with mock.patch('nodereg.imds.monotonic', return_value=1000):
+        assert imds.get('instance-id') == 'i-123'
+    mock_imds.token = 'token2'
+    with mock.patch('nodereg.imds.monotonic', return_value=1295):
+        assert imds.get('instance-id') == 'i-123'
+    assert imds.session.put.call_count == 2
+    assert imds.session.get.call_count == 2
+
+
+def test_rejected_token():
+    mock_imds = MockIMDS({'instance-id': 'i-123'})
+    imds = get_imds(mock_imds)
+    assert imds.get('instance-id') == 'i-123'
+    mock_imds.token = 'token2'
+    assert imds.get('instance-id') == 'i-123'
+    assert imds.session.put.call_count == 2
+    assert imds.session.get.call_count == 3
+    calls = imds.tracer.report()['calls']
+    assert calls['imds.token_renewal']['retries'] == 1
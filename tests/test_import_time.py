@@ -0,0 +1,66 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# heavy dependencies only needed by modules or on a config change
+HEAVY_MODULES = ['boto', 'requests', 'tinycert', 'yaml']
+# cumulative import time budget for nodereg.run, in seconds
+IMPORT_TIME_BUDGET = 0.5
+
+
+def run_python(code, *options):
+    output = subprocess.check_output(
+        [sys.executable] + list(options) + ['-c', code],
+        stderr=subprocess.STDOUT,
+    )
+    return output.decode()
+
+
+def test_no_heavy_imports():
+    code = '\n'.join([
+        'import json, sys',
+        'import nodereg.run',
+        'print(json.dumps(sorted(sys.modules)))',
+    ])
+    imported = json.loads(run_python(code).splitlines()[-1])
+    heavy = [
+        name
+        for name in imported
+        if name.split('.')[0] in HEAVY_MODULES
+    ]
+    assert heavy == []
+
+
+def test_module_imported_on_demand():
+    code = '\n'.join([
+        'import json, sys',
+        'from nodereg.modules import get_module',
+        'get_module("hostname")',
+        'print(json.dumps(sorted(sys.modules)))',
+    ])
+    imported = json.loads(run_python(code).splitlines()[-1])
+    assert 'nodereg.modules.hostname' in imported
+    assert 'nodereg.modules.etcd' not in imported
+    assert 'nodereg.modules.tinycert' not in imported
+
+
+def import_time():
+    output = run_python('import nodereg.run', '-X', 'importtime')
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'nodereg.run':
+            return int(fields[1]) / 1000000.0
+    raise AssertionError('nodereg.run import time not found')
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 7),
+    reason='-X importtime needs Python 3.7',
+)
+def test_import_time():
+    # best of several runs, to ignore a cold disk cache
+    best = min(import_time() for _ in range(3))
+    assert best < IMPORT_TIME_BUDGET
@@ -0,0 +1,57 @@
+from nodereg.journal import Journal
+
+
+def get_inputs():
+    return {
+        'config': {'name': 'k8s.com.'},
+        'hostname': 'master0-123',
+    }
+
+
+def test_converged(tmpdir):
+    journal_file = str(tmpdir.join('journal.json'))
+    output = tmpdir.join('node.pem')
+    output.write('CERT')
+    Journal(journal_file).record(
+        'tinycert',
+        get_inputs(),
+        [str(output)],
+        'master0-123.k8s.com.',
+    )
+    journal = Journal(journal_file)
+    assert journal.lookup('tinycert', get_inputs()) == (
+        True,
+        'master0-123.k8s.com.',
+    )
+    assert journal.has_converged('tinycert')
+
+
+def test_inputs_changed(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.json')))
+    journal.record('hosted_zone', get_inputs(), [], 'fqdn')
+    inputs = get_inputs()
+    inputs['hostname'] = 'master0-124'
+    assert journal.lookup('hosted_zone', inputs) == (False, None)
+
+
+def test_output_changed(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.json')))
+    output = tmpdir.join('70-initial-cluster.conf')
+    output.write('[Service]')
+    journal.record('etcd', get_inputs(), [str(output)], None)
+    output.write('[Service]\n')
+    assert journal.lookup('etcd', get_inputs()) == (False, None)
+    output.remove()
+    assert not journal.has_converged('etcd')
+
+
+def test_forget(tmpdir):
+    journal_file = str(tmpdir.join('journal.json'))
+    journal = Journal(journal_file)
+    journal.record('hostname', get_inputs(), [], 'master0-123')
+    journal.forget('hostname')
+    assert Journal(journal_file).lookup('hostname', get_inputs()) == (
+        False,
+        None,
+    )
+    assert not journal.has_converged('unknown')
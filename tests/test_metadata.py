@@ -0,0 +1,67 @@
+import time
+from unittest import mock
+
+from nodereg.metadata import MetadataCache, get_local_instance_id
+
+
+def get_node():
+    return {
+        'metadata': {
+            'instance-id': 'i-123',
+            'local-ipv4': '10.0.0.123',
+            'ami-id': 'ami-123',
+        },
+        'region': 'eu-west-1',
+        'tags': {
+            'Role': 'master',
+        },
+    }
+
+
+def test_cache_hit(tmpdir):
+    cache = MetadataCache(str(tmpdir.join('metadata.json')), ttl=60)
+    node = get_node()
+    cache.put(node)
+    cached_node = cache.get('i-123')
+    assert cached_node == {
+        'metadata': {
+            'instance-id': 'i-123',
+            'local-ipv4': '10.0.0.123',
+        },
+        'region': 'eu-west-1',
+        'tags': {
+            'Role': 'master',
+        },
+    }
+
+
+def test_cache_other_instance(tmpdir):
+    cache = MetadataCache(str(tmpdir.join('metadata.json')), ttl=60)
+    cache.put(get_node())
+    assert cache.get('i-456') == {}
+
+
+def test_cache_expired_tags(tmpdir):
+    cache = MetadataCache(str(tmpdir.join('metadata.json')), ttl=60)
+    cache.put(get_node())
+    with mock.patch('time.time', return_value=time.time() + 61):
+        cached_node = cache.get('i-123')
+    assert 'tags' not in cached_node
+    assert cached_node['region'] == 'eu-west-1'
+
+
+def test_instance_id_from_asset_tag(tmpdir):
+    asset_tag = tmpdir.join('board_asset_tag')
+    asset_tag.write('i-0abc\n')
+    with mock.patch('nodereg.metadata.ASSET_TAG_FILE', str(asset_tag)):
+        assert get_local_instance_id() == 'i-0abc'
+
+
+def test_instance_id_not_in_asset_tag(tmpdir):
+    asset_tag = tmpdir.join('board_asset_tag')
+    asset_tag.write('\n')
+    with mock.patch('nodereg.metadata.ASSET_TAG_FILE', str(asset_tag)):
+        assert get_local_instance_id() is None
+    missing = str(tmpdir.join('missing'))
+    with mock.patch('nodereg.metadata.ASSET_TAG_FILE', missing):
+        assert get_local_instance_id() is None
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone
+from ipaddress import ip_address
+
+import pytest
+
+from nodereg import pki
+
+x509 = pytest.importorskip('cryptography.x509')
+hashes = pytest.importorskip('cryptography.hazmat.primitives.hashes')
+rsa = pytest.importorskip('cryptography.hazmat.primitives.asymmetric.rsa')
+serialization = pytest.importorskip(
+    'cryptography.hazmat.primitives.serialization',
+)
+default_backend = pytest.importorskip(
+    'cryptography.hazmat.backends',
+).default_backend
+
+
+def generate_key():
+    return rsa.generate_private_key(65537, 2048, default_backend())
+
+
+def write_certificate(tmpdir, key, days=30):
+    name = x509.Name([
+        x509.NameAttribute(x509.NameOID.COMMON_NAME, 'abc.acme.com'),
+    ])
+    now = datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(
+        name,
+    ).issuer_name(
+        name,
+    ).public_key(
+        key.public_key(),
+    ).serial_number(
+        1000,
+    ).not_valid_before(
+        now - timedelta(days=1),
+    ).not_valid_after(
+        now + timedelta(days=days),
+    ).add_extension(
+        x509.SubjectAlternativeName([
+            x509.DNSName('abc.acme.com'),
+            x509.DNSName('abc'),
+            x509.IPAddress(ip_address('10.0.0.123')),
+        ]),
+        critical=False,
+    ).sign(key, hashes.SHA256(), default_backend())
+    cert_file = tmpdir.join('node.pem')
+    cert_file.write_binary(cert.public_bytes(serialization.Encoding.PEM))
+    return str(cert_file)
+
+
+def write_key(tmpdir, key):
+    key_file = tmpdir.join('node-key.pem')
+    key_file.write_binary(key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    ))
+    return str(key_file)
+
+
+def test_valid_certificate(tmpdir):
+    key = generate_key()
+    cert_file = write_certificate(tmpdir, key)
+    key_file = write_key(tmpdir, key)
+    assert pki.check_certificate(
+        cert_file,
+        key_file,
+        min_validity=7 * 24 * 3600,
+        dns_names=['abc.acme.com.', 'abc'],
+        ip_addresses=['10.0.0.123'],
+    )
+
+
+def test_expiring_certificate(tmpdir):
+    key = generate_key()
+    cert_file = write_certificate(tmpdir, key, days=3)
+    assert pki.check_certificate(cert_file)
+    assert not pki.check_certificate(cert_file, min_validity=7 * 24 * 3600)
+
+
+def test_not_valid_after(tmpdir):
+    cert_file = write_certificate(tmpdir, generate_key(), days=3)
+    expires_in = pki.not_valid_after(cert_file) - datetime.now(timezone.utc)
+    assert timedelta(days=2) < expires_in <= timedelta(days=3)
+    assert pki.not_valid_after(str(tmpdir.join('missing.pem'))) is None
+    assert pki.lifetime(cert_file) == timedelta(days=4)
+
+
+def test_other_sans(tmpdir):
+    cert_file = write_certificate(tmpdir, generate_key())
+    assert not pki.check_certificate(cert_file, dns_names=['xyz.acme.com'])
+    assert not pki.check_certificate(cert_file, ip_addresses=['10.0.0.124'])
+
+
+def test_key_mismatch(tmpdir):
+    cert_file = write_certificate(tmpdir, generate_key())
+    key_file = write_key(tmpdir, generate_key())
+    assert not pki.check_certificate(cert_file, key_file)
+
+
+def test_missing_or_corrupt(tmpdir):
+    assert not pki.check_certificate(str(tmpdir.join('missing.pem')))
+    corrupt_file = tmpdir.join('corrupt.pem')
+    corrupt_file.write('not a certificate')
+    assert not pki.check_certificate(str(corrupt_file))
+
+
+def test_subject_hash(tmpdir):
+    with open(write_certificate(tmpdir, generate_key()), 'rb') as _file:
+        cert_pem = _file.read()
+    subject_hash = pki.subject_hash(cert_pem)
+    assert len(subject_hash) == 8
+    openssl_hash = pki._subject_hash_openssl(cert_pem)
+    if openssl_hash is None:
+        pytest.skip('openssl is not installed')
+    assert subject_hash == openssl_hash
+
+
+def test_subject_hash_canonical_names():
+    assert pki._canonical_value(' Acme \t Inc. ') == pki._canonical_value(
+        'acme inc.',
+    )
+    assert pki._canonical_value('ÄCME') != pki._canonical_value('äcme')
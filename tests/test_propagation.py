@@ -0,0 +1,62 @@
+from unittest import mock
+
+from nodereg.propagation import ChangeTracker
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+def get_status(statuses):
+    status = mock.Mock()
+    status.id = 'C123'
+    status.status = 'PENDING'
+
+    def update():
+        status.status = statuses.pop(0)
+        return status.status
+
+    status.update.side_effect = update
+    return status
+
+
+def test_backoff():
+    clock = Clock()
+    status = get_status(['PENDING', 'PENDING', 'PENDING', 'INSYNC'])
+    with mock.patch('nodereg.propagation.monotonic', clock.monotonic), \
+            mock.patch('nodereg.propagation.sleep', clock.sleep):
+        tracker = ChangeTracker(status, timeout=60, max_delay=4)
+        assert tracker.track()
+    assert clock.sleeps == [1, 2, 4, 4]
+    assert tracker.latency == 11
+    report = tracker.tracer.report()
+    assert report['calls']['route53.wait_insync']['retries'] == 4
+
+
+def test_deadline():
+    clock = Clock()
+    status = get_status(['PENDING'] * 10)
+    with mock.patch('nodereg.propagation.monotonic', clock.monotonic), \
+            mock.patch('nodereg.propagation.sleep', clock.sleep):
+        tracker = ChangeTracker(status, timeout=5)
+        assert not tracker.track()
+    assert clock.sleeps == [1, 2, 2]
+    assert tracker.latency is None
+
+
+def test_background():
+    status = get_status([])
+    status.status = 'INSYNC'
+    tracker = ChangeTracker(status)
+    tracker.start().join()
+    assert tracker.wait(0)
@@ -0,0 +1,186 @@
+import os
+import subprocess
+from unittest import mock
+
+import pytest
+
+from nodereg.run import Registrator
+
+
+def get_node():
+    return {
+        'metadata': {
+            'instance-id': 'i-123',
+            'local-ipv4': '10.0.0.123',
+        },
+        'region': 'eu-west-1',
+        'tags': {
+            'Role': 'master',
+        },
+    }
+
+
+def get_socket():
+    # never change the hostname of the machine running the tests
+    socket = mock.Mock()
+    socket.gethostname.return_value = 'localhost'
+    socket.sethostname.side_effect = PermissionError
+    return socket
+
+
+def share_host_uts(tmpdir):
+    tmpdir.join('root', 'proc', '1', 'ns').ensure(dir=True)
+    os.symlink(
+        os.readlink('/proc/self/ns/uts'),
+        str(tmpdir.join('root', 'proc', '1', 'ns', 'uts')),
+    )
+
+
+def write_config(tmpdir):
+    config_file = tmpdir.join('custom.yaml')
+    config_file.write('\n'.join([
+        'base:',
+        '  ami_build_tag: is_ami_build',
+        '  chroot_path: %s' % tmpdir.join('root'),
+        '  enabled_modules: [hostname]',
+        '  state_dir: /var/lib/nodereg',
+        '  journal: yes',
+        '  pipelined: yes',
+    ]))
+    return str(config_file)
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.run.Registrator._get_node_metadata')
+@mock.patch('nodereg.modules.hostname.socket', new=get_socket())
+def test_run(get_node_metadata, subprocess_run, tmpdir):
+    get_node_metadata.return_value = get_node()
+    registrator = Registrator(write_config(tmpdir))
+    registrator.run()
+    subprocess_run.assert_called_once_with(
+        [
+            'chroot',
+            str(tmpdir.join('root')),
+            'hostnamectl',
+            'set-hostname',
+            'master0-123',
+        ],
+        check=True,
+        stdout=-1,
+    )
+    report = registrator.context.tracer.report()
+    assert report['calls']['module.hostname']['count'] == 1
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.run.Registrator._get_node_metadata')
+@mock.patch('nodereg.modules.hostname.socket', new=get_socket())
+def test_converged_module_skipped(get_node_metadata, subprocess_run, tmpdir):
+    # hostnamectl runs whenever the module runs, as sethostname is denied
+    share_host_uts(tmpdir)
+    get_node_metadata.return_value = get_node()
+    config_file = write_config(tmpdir)
+    Registrator(config_file).run()
+    assert tmpdir.join('root', 'var', 'lib', 'nodereg', 'journal.json').check()
+    subprocess_run.reset_mock()
+
+    Registrator(config_file).run()
+    subprocess_run.assert_not_called()
+
+    Registrator(config_file).run(force=True)
+    assert subprocess_run.called
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.run.Registrator._get_node_metadata')
+@mock.patch('nodereg.modules.hostname.socket', new=get_socket())
+def test_forced_run_recorded(get_node_metadata, subprocess_run, tmpdir):
+    share_host_uts(tmpdir)
+    get_node_metadata.return_value = get_node()
+    config_file = write_config(tmpdir)
+    Registrator(config_file).run(force=True)
+    assert tmpdir.join('root', 'var', 'lib', 'nodereg', 'journal.json').check()
+    subprocess_run.reset_mock()
+
+    Registrator(config_file).run()
+    subprocess_run.assert_not_called()
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.run.Registrator._get_node_metadata')
+@mock.patch('nodereg.modules.hostname.socket', new=get_socket())
+def test_failed_actions_retried(get_node_metadata, subprocess_run, tmpdir):
+    get_node_metadata.return_value = get_node()
+    subprocess_run.side_effect = subprocess.CalledProcessError(1, 'hostnamectl')
+    config_file = write_config(tmpdir)
+    with pytest.raises(subprocess.CalledProcessError):
+        Registrator(config_file).run()
+
+    subprocess_run.side_effect = None
+    Registrator(config_file).run()
+    assert subprocess_run.call_count == 2
+
+
+def stop_after(registrator, cycles):
+    timeouts = []
+
+    def wait(timeout=None):
+        timeouts.append(timeout)
+        if len(timeouts) == cycles:
+            registrator._stopping = True
+        return True
+
+    registrator._wakeup = mock.MagicMock()
+    registrator._wakeup.wait.side_effect = wait
+    return timeouts
+
+
+@mock.patch('signal.signal')
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.run.Registrator._get_node_metadata')
+@mock.patch('nodereg.modules.hostname.socket', new=get_socket())
+def test_daemon(get_node_metadata, subprocess_run, signal_signal, tmpdir):
+    get_node_metadata.return_value = get_node()
+    registrator = Registrator(write_config(tmpdir))
+    timeouts = stop_after(registrator, 3)
+    registrator.daemon()
+    assert timeouts == [300, 300, 300]
+    # converged in the first cycle, only reconciled afterwards
+    assert subprocess_run.call_count == 1
+
+
+@mock.patch('signal.signal')
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.run.Registrator._get_node_metadata')
+@mock.patch('nodereg.modules.hostname.socket', new=get_socket())
+def test_daemon_metadata_error(
+    get_node_metadata,
+    subprocess_run,
+    signal_signal,
+    tmpdir,
+):
+    get_node_metadata.side_effect = [
+        get_node(),
+        Exception('401 Client Error: Unauthorized'),
+        get_node(),
+    ]
+    registrator = Registrator(write_config(tmpdir))
+    timeouts = stop_after(registrator, 3)
+    registrator.daemon()
+    assert timeouts == [300, 300, 300]
+    assert get_node_metadata.call_count == 3
+
+
+@mock.patch('signal.signal')
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.run.Registrator._get_node_metadata')
+@mock.patch('nodereg.modules.hostname.socket', new=get_socket())
+def test_ami_build(get_node_metadata, subprocess_run, signal_signal, tmpdir):
+    node = get_node()
+    node['tags']['is_ami_build'] = 'true'
+    get_node_metadata.return_value = node
+    registrator = Registrator(write_config(tmpdir))
+    timeouts = stop_after(registrator, 1)
+    registrator.run()
+    assert timeouts == [None]
+    subprocess_run.assert_not_called()
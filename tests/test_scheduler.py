@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from nodereg.scheduler import Scheduler
+
+
+def test_dependency_results():
+    scheduler = Scheduler()
+    scheduler.add('hostname', lambda: 'master0-123', [])
+    scheduler.add(
+        'hosted_zone',
+        lambda hostname: hostname + '.k8s.com.',
+        ['hostname'],
+    )
+    scheduler.add('tinycert', lambda fqdn: fqdn.upper(), ['hosted_zone'])
+    results = scheduler.run()
+    assert results == {
+        'hostname': 'master0-123',
+        'hosted_zone': 'master0-123.k8s.com.',
+        'tinycert': 'MASTER0-123.K8S.COM.',
+    }
+
+
+def test_independent_tasks_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    scheduler = Scheduler(max_workers=2)
+    scheduler.add('hostname', barrier.wait, [])
+    scheduler.add('etcd', barrier.wait, [])
+    # would raise BrokenBarrierError if the tasks ran one after another
+    scheduler.run()
+
+
+def test_missing_dependency():
+    scheduler = Scheduler()
+    scheduler.add('hosted_zone', lambda hostname: hostname, ['hostname'])
+    with pytest.raises(Exception) as e_info:
+        scheduler.run()
+    assert str(e_info.value) == 'Dependency module hostname is not enabled'
+
+
+def test_dependency_cycle():
+    scheduler = Scheduler()
+    scheduler.add('a', lambda b: b, ['b'])
+    scheduler.add('b', lambda a: a, ['a'])
+    with pytest.raises(Exception) as e_info:
+        scheduler.run()
+    assert 'cycle' in str(e_info.value)
+
+
+def test_failure_skips_dependents():
+    called = []
+
+    def fail():
+        raise ValueError('boom')
+
+    scheduler = Scheduler()
+    scheduler.add('hostname', fail, [])
+    scheduler.add('hosted_zone', called.append, ['hostname'])
+    with pytest.raises(ValueError):
+        scheduler.run()
+    assert called == []
+
+
+def test_order():
+    scheduler = Scheduler()
+    scheduler.add('tinycert', lambda fqdn: fqdn, ['hosted_zone'])
+    scheduler.add('etcd', lambda: None, [])
+    scheduler.add('hosted_zone', lambda hostname: hostname, ['hostname'])
+    scheduler.add('hostname', lambda: 'master0-123', [])
+    order = scheduler.order()
+    assert order.index('hostname') < order.index('hosted_zone')
+    assert order.index('hosted_zone') < order.index('tinycert')
+
+
+def test_prefetch_starts_before_dependencies_finish():
+    events = []
+    dependency_released = threading.Event()
+
+    def hostname():
+        dependency_released.wait(5)
+        events.append('hostname')
+        return 'master0-123'
+
+    def prefetch():
+        events.append('prefetch')
+        dependency_released.set()
+
+    scheduler = Scheduler(max_workers=2)
+    scheduler.add('hostname', hostname, [])
+    scheduler.add(
+        'hosted_zone',
+        lambda hostname: events.append('hosted_zone'),
+        ['hostname'],
+        prefetch=prefetch,
+    )
+    scheduler.run()
+    assert events == ['prefetch', 'hostname', 'hosted_zone']
+
+
+def test_failed_prefetch_is_ignored():
+    def prefetch():
+        raise ValueError('boom')
+
+    scheduler = Scheduler()
+    scheduler.add('tinycert', lambda: 'done', [], prefetch=prefetch)
+    assert scheduler.run() == {'tinycert': 'done'}
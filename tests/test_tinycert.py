@@ -1,7 +1,16 @@
+import json
+import os
+import stat
+import time
+from datetime import datetime, timedelta, timezone
 from os import path
 from unittest import mock
 
-from nodereg.modules import TinyCert
+import pytest
+import requests
+
+from nodereg.context import RunContext
+from nodereg.modules.tinycert import CachedSession, CertIndex, TinyCert
 
 
 def get_node():
@@ -64,7 +73,7 @@ class CertDB:
             'id': cert_id,
             'name': safe_csr['CN'],
             'status': 'good',
-            'expires': 987654321,
+            'expires': 4102444800,
         }
         details = {
             'id': cert_id,
@@ -82,17 +91,15 @@ class CertDB:
         }
 
 
-@mock.patch('builtins.open', new_callable=mock.mock_open)
-@mock.patch('nodereg.modules.tinycert.makedirs')
-@mock.patch('nodereg.modules.tinycert.path')
+@mock.patch('nodereg.modules.tinycert.FileWriter')
+@mock.patch('nodereg.modules.tinycert.os_path')
 @mock.patch('subprocess.run')
-@mock.patch('nodereg.modules.tinycert.Session')
+@mock.patch('nodereg.modules.tinycert.CachedSession')
 def test_missing_ca(
     tinycert_session,
     subprocess_run,
     os_path,
-    os_makedirs,
-    builtins_open,
+    file_writer,
 ):
     node = get_node()
     config = get_config()
@@ -106,8 +113,8 @@ def test_missing_ca(
     tinycert_session().ca.details.side_effect = cert_db.ca_details
     tinycert_session().ca.get.side_effect = cert_db.ca_get
     os_path.join.return_value = ca_file
-    os_path.dirname.return_value = config['ca_path']
     os_path.isfile.return_value = False
+    file_writer().write.return_value = True
 
     tinycert_module = TinyCert(node, config, False)
     tinycert_module.run('')
@@ -117,10 +124,11 @@ def test_missing_ca(
         ca_details['CN'].lower() + '.pem',
     )
     os_path.isfile.assert_called_once_with(ca_file)
-    os_path.dirname.assert_called_once_with(ca_file)
-    os_makedirs.assert_called_with(config['ca_path'], exist_ok=True)
-    builtins_open.assert_called_once_with(ca_file, 'w')
-    builtins_open().write.assert_called_once_with(cert_db.ca_get(config['ca_id'])['pem'])
+    file_writer().write.assert_called_once_with(
+        ca_file,
+        cert_db.ca_get(config['ca_id'])['pem'],
+        None,
+    )
     subprocess_run.assert_called_once_with(
         ['update-ca-certificates'],
         check=True,
@@ -129,9 +137,9 @@ def test_missing_ca(
 
 
 @mock.patch('builtins.open', new_callable=mock.mock_open)
-@mock.patch('nodereg.modules.tinycert.path')
+@mock.patch('nodereg.modules.tinycert.os_path')
 @mock.patch('subprocess.run')
-@mock.patch('nodereg.modules.tinycert.Session')
+@mock.patch('nodereg.modules.tinycert.CachedSession')
 def test_present_ca(
     tinycert_session,
     subprocess_run,
@@ -164,11 +172,11 @@ def test_present_ca(
     subprocess_run.assert_not_called()
 
 
-@mock.patch('nodereg.modules.tinycert.Session')
+@mock.patch('nodereg.modules.tinycert.CachedSession')
 @mock.patch('nodereg.modules.tinycert.TinyCert._ensure_ca')
-@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_certificate')
+@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_certificates')
 def test_generate_node_certificate(
-    ensure_certificate,
+    ensure_certificates,
     ensure_ca,
     tinycert_session,
 ):
@@ -202,16 +210,16 @@ def test_generate_node_certificate(
         csr,
     )
     tinycert_session().cert.details.assert_called_once_with(1001)
-    assert ensure_certificate.called
+    assert ensure_certificates.called
 
 
-@mock.patch('nodereg.modules.tinycert.Session')
+@mock.patch('nodereg.modules.tinycert.CachedSession')
 @mock.patch('nodereg.modules.tinycert.TinyCert._ensure_ca')
-@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_certificate')
+@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_certificates')
 @mock.patch('nodereg.modules.tinycert.TinyCert._generate_certificate')
 def test_find_node_certificate(
     generate_certificate,
-    ensure_certificate,
+    ensure_certificates,
     ensure_ca,
     tinycert_session,
 ):
@@ -225,13 +233,13 @@ def test_find_node_certificate(
         'id': 1001,
         'name': fqdn,
         'status': 'good',
-        'expires': 987654321,
+        'expires': 4102444800,
     }
     cert_details = {
         'id': 1001,
         'CN': fqdn,
         'status': 'good',
-        'Alt': [{'DNS': fqdn}],
+        'Alt': [{'DNS': fqdn}, {'DNS': 'abc'}, {'IP': '10.0.0.123'}],
         'hash_alg': 'SHA256',
     }
     for field in ['C', 'L', 'O', 'OU', 'ST']:
@@ -247,20 +255,161 @@ def test_find_node_certificate(
     tinycert_session().cert.list.assert_called_once_with(ca_details['id'])
     tinycert_session().cert.details.assert_called_once_with(1001)
     generate_certificate.assert_not_called()
-    assert ensure_certificate.called
+    assert ensure_certificates.called
+
+
+@pytest.mark.parametrize('cert_summary, alt', [
+    # the node IP address changed
+    ({'expires': 4102444800}, [{'DNS': 'abc.acme.com'}, {'DNS': 'abc'}]),
+    ({'expires': 987654321}, [
+        {'DNS': 'abc.acme.com'},
+        {'DNS': 'abc'},
+        {'IP': '10.0.0.123'},
+    ]),
+    ({'status': 'revoked'}, [
+        {'DNS': 'abc.acme.com'},
+        {'DNS': 'abc'},
+        {'IP': '10.0.0.123'},
+    ]),
+])
+@mock.patch('nodereg.modules.tinycert.CachedSession')
+@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_ca')
+@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_certificates')
+@mock.patch('nodereg.modules.tinycert.TinyCert._generate_certificate')
+def test_stale_node_certificate(
+    generate_certificate,
+    ensure_certificates,
+    ensure_ca,
+    tinycert_session,
+    cert_summary,
+    alt,
+):
+    config = get_config(node_certificate=True)
+    fqdn = 'abc.acme.com'
+    ensure_ca.return_value = CertDB().ca_details(config['ca_id'])
+    cert_summary = dict({'id': 1001, 'name': fqdn}, **cert_summary)
+    tinycert_session().cert.list.return_value = [cert_summary]
+    tinycert_session().cert.details.return_value = {'id': 1001, 'Alt': alt}
+    generate_certificate.return_value = {'id': 1002}
 
+    TinyCert(get_node(), config, False).run(fqdn)
 
-@mock.patch('builtins.open', new_callable=mock.mock_open)
-@mock.patch('nodereg.modules.tinycert.makedirs')
-@mock.patch('nodereg.modules.tinycert.path.isfile')
-@mock.patch('nodereg.modules.tinycert.Session')
+    generate_certificate.assert_called_once_with(
+        tinycert_session(),
+        ensure_ca.return_value,
+        fqdn,
+    )
+    ensure_certificates.assert_called_once_with(
+        tinycert_session(),
+        [(1002, True)],
+        fqdn,
+    )
+
+
+@mock.patch('nodereg.modules.tinycert.pki')
+@mock.patch('nodereg.modules.tinycert.os_path.isfile')
+def test_plan_stale_certificate(os_path_isfile, tinycert_pki):
+    config = get_config(node_certificate=True)
+    os_path_isfile.return_value = True
+    tinycert_pki.lifetime.return_value = None
+    tinycert_pki.check_certificate.return_value = True
+    tinycert_module = TinyCert(get_node(), config, False)
+    plan = tinycert_module._plan_certificate(
+        mock.Mock(),
+        1001,
+        True,
+        'abc.acme.com',
+    )
+    assert [missing for _, _, missing in plan['files']] == [False, False]
+    tinycert_pki.check_certificate.assert_called_once_with(
+        '/tmp/certs/node.pem',
+        '/tmp/certs/node-key.pem',
+        7 * 24 * 3600,
+        dns_names=['abc.acme.com', 'abc'],
+        ip_addresses=['10.0.0.123'],
+    )
+
+    # e.g. expires within min_validity or misses the node IP address
+    tinycert_pki.check_certificate.return_value = False
+    plan = tinycert_module._plan_certificate(
+        mock.Mock(),
+        1001,
+        True,
+        'abc.acme.com',
+    )
+    assert [missing for _, _, missing in plan['files']] == [True, True]
+
+
+@mock.patch('nodereg.modules.tinycert.pki')
+def test_fingerprint_expiry(tinycert_pki):
+    config = get_config(node_certificate=True)
+    tinycert_module = TinyCert(get_node(), config, False)
+    tinycert_pki.is_available.return_value = True
+    tinycert_pki.lifetime.return_value = None
+    expires_at = datetime.now(timezone.utc) + timedelta(days=30)
+    tinycert_pki.not_valid_after.return_value = expires_at
+    fingerprint = tinycert_module.fingerprint('abc.acme.com')
+    renew_at = expires_at - timedelta(days=7)
+    assert fingerprint['renew_at'] == renew_at.isoformat()
+    tinycert_pki.not_valid_after.assert_called_once_with(
+        '/tmp/certs/node.pem',
+    )
+
+    tinycert_pki.not_valid_after.return_value = (
+        datetime.now(timezone.utc) + timedelta(days=3)
+    )
+    assert tinycert_module.fingerprint('abc.acme.com') is None
+    tinycert_pki.not_valid_after.return_value = None
+    assert tinycert_module.fingerprint('abc.acme.com') is None
+
+
+@mock.patch('nodereg.modules.tinycert.pki')
+def test_short_lifetime_certificate(tinycert_pki):
+    config = get_config(node_certificate=True)
+    tinycert_module = TinyCert(get_node(), config, False)
+    tinycert_pki.is_available.return_value = True
+    tinycert_pki.check_certificate.return_value = True
+    # a CA issuing certificates for less than min_validity
+    tinycert_pki.lifetime.return_value = timedelta(days=4)
+    expires_at = datetime.now(timezone.utc) + timedelta(days=3)
+    tinycert_pki.not_valid_after.return_value = expires_at
+    fingerprint = tinycert_module.fingerprint('abc.acme.com')
+    renew_at = expires_at - timedelta(days=2)
+    assert fingerprint['renew_at'] == renew_at.isoformat()
+
+    assert tinycert_module._check_certificate(
+        '/tmp/certs/node.pem',
+        '/tmp/certs/node-key.pem',
+        'abc.acme.com',
+    )
+    tinycert_pki.check_certificate.assert_called_once_with(
+        '/tmp/certs/node.pem',
+        '/tmp/certs/node-key.pem',
+        2 * 24 * 3600,
+        dns_names=['abc.acme.com', 'abc'],
+        ip_addresses=['10.0.0.123'],
+    )
+
+    cert = {'id': 1002, 'expires': time.time() + 3 * 24 * 3600}
+    with mock.patch.object(tinycert_module, '_get_cert_index') as cert_index:
+        cert_index().sans.return_value = [
+            {'DNS': 'abc.acme.com'},
+            {'DNS': 'abc'},
+            {'IP': '10.0.0.123'},
+        ]
+        assert tinycert_module._is_usable(1001, cert, 'abc.acme.com')
+    tinycert_pki.lifetime.assert_called_with('/tmp/certs/node.pem')
+
+
+@mock.patch('nodereg.modules.tinycert.FileWriter')
+@mock.patch('nodereg.modules.tinycert.os_path.isfile')
+@mock.patch('nodereg.modules.tinycert.CachedSession')
 @mock.patch('nodereg.modules.tinycert.TinyCert._ensure_ca')
 def test_ensure_certificates(
     ensure_ca,
     tinycert_session,
     os_path_isfile,
-    os_makedirs,
-    builtins_open,
+    file_writer,
 ):
     node = get_node()
     config = get_config(certificates=[1001])
@@ -292,13 +441,407 @@ def test_ensure_certificates(
     tinycert_module.run('')
 
     os_path_isfile.assert_any_call(cert_file)
-    builtins_open.assert_any_call(cert_file, 'w')
-    builtins_open().write.assert_any_call(
+    file_writer().write.assert_any_call(
+        cert_file,
         cert_db.cert_get(cert_details['id'], 'cert')['pem'],
+        None,
     )
 
     os_path_isfile.assert_any_call(key_file)
-    builtins_open.assert_any_call(key_file, 'w')
-    builtins_open().write.assert_any_call(
+    file_writer().write.assert_any_call(
+        key_file,
         cert_db.cert_get(cert_details['id'], 'key.dec')['pem'],
+        0o600,
+    )
+    assert tinycert_module.outputs == [cert_file, key_file]
+
+    # the outputs of the previous run are not carried over
+    tinycert_module.run('')
+    assert tinycert_module.outputs == [cert_file, key_file]
+
+
+@mock.patch('nodereg.modules.tinycert.CachedSession')
+@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_ca')
+@mock.patch('nodereg.modules.tinycert.TinyCert._ensure_certificates')
+@mock.patch('nodereg.modules.tinycert.TinyCert._generate_certificate')
+def test_prefetch_node_certificate(
+    generate_certificate,
+    ensure_certificates,
+    ensure_ca,
+    tinycert_session,
+):
+    node = get_node()
+    config = get_config(node_certificate=True)
+    cert_db = CertDB()
+    ca_details = cert_db.ca_details(config['ca_id'])
+    fqdn = 'abc.acme.com'
+    cert_summary = {
+        'id': 1001,
+        'name': fqdn,
+        'status': 'good',
+        'expires': 4102444800,
+    }
+
+    ensure_ca.return_value = ca_details
+    tinycert_session().cert.list.return_value = [cert_summary]
+    tinycert_session().cert.details.return_value = {
+        'id': 1001,
+        'Alt': [{'DNS': fqdn}, {'DNS': 'abc'}, {'IP': '10.0.0.123'}],
+    }
+    tinycert_session.reset_mock()
+
+    context = RunContext()
+    context.publish('fqdn', fqdn)
+    tinycert_module = TinyCert(node, config, False, context)
+    tinycert_module.prefetch()
+    tinycert_module.run(fqdn)
+
+    tinycert_session().connect.assert_called_once_with(
+        config['email'],
+        config['passphrase'],
+    )
+    ensure_ca.assert_called_once_with(tinycert_session())
+    tinycert_session().cert.list.assert_called_once_with(ca_details['id'])
+    generate_certificate.assert_not_called()
+    ensure_certificates.assert_called_once_with(
+        tinycert_session(),
+        [(1001, True)],
+        fqdn,
     )
+
+    # the next cycle does not reuse the prefetched session
+    tinycert_module.run(fqdn)
+    assert tinycert_session().connect.call_count == 2
+
+
+def get_cert_db(count, match_id, match_name):
+    cert_db = CertDB()
+    for cert_id in range(count):
+        name = match_name if cert_id == match_id else 'other%s' % cert_id
+        alt = [{'DNS': name}]
+        if cert_id == match_id:
+            alt = [{'DNS': 'abc.acme.com'}]
+        cert_db.certs.append((
+            {'id': cert_id, 'name': name, 'status': 'good'},
+            {'id': cert_id, 'CN': name, 'Alt': alt},
+        ))
+    return cert_db
+
+
+def test_find_cert_by_san_concurrently():
+    config = get_config()
+    config['concurrency'] = 3
+    cert_db = get_cert_db(20, 12, 'renamed.acme.com')
+    session = mock.Mock()
+    session.cert.list.side_effect = cert_db.cert_list
+    session.cert.details.side_effect = cert_db.cert_details
+
+    tinycert_module = TinyCert(get_node(), config, False)
+    cert = tinycert_module._find_cert_by_san(
+        session,
+        1000,
+        {'DNS': 'abc.acme.com'},
+    )
+    assert cert['id'] == 12
+    assert session.cert.details.call_count <= 15
+
+
+def test_find_cert_by_san_named_first():
+    config = get_config()
+    config['concurrency'] = 1
+    cert_db = get_cert_db(20, 19, 'abc.acme.com')
+    session = mock.Mock()
+    session.cert.list.side_effect = cert_db.cert_list
+    session.cert.details.side_effect = cert_db.cert_details
+
+    tinycert_module = TinyCert(get_node(), config, False)
+    cert = tinycert_module._find_cert_by_san(
+        session,
+        1000,
+        {'DNS': 'abc.acme.com'},
+    )
+    assert cert['id'] == 19
+    session.cert.details.assert_called_once_with(19)
+
+
+def test_indexed_certificates(tmpdir):
+    config = get_config()
+    cert_db = get_cert_db(20, 12, 'renamed.acme.com')
+    session = mock.Mock()
+    session.cert.list.side_effect = cert_db.cert_list
+    session.cert.details.side_effect = cert_db.cert_details
+
+    tinycert_module = TinyCert(get_node(), config, False, RunContext())
+    assert tinycert_module._find_cert_by_san(
+        session,
+        1000,
+        {'DNS': 'missing'},
+    ) is None
+    assert session.cert.details.call_count == 20
+    cert = tinycert_module._find_cert_by_san(
+        session,
+        1000,
+        {'DNS': 'other3'},
+    )
+    assert cert['id'] == 3
+    assert session.cert.details.call_count == 20
+
+    context = RunContext(str(tmpdir))
+    tinycert_module = TinyCert(get_node(), config, False, context)
+    tinycert_module._find_cert_by_san(session, 1000, {'DNS': 'missing'})
+    session.cert.details.reset_mock()
+    cert_db.certs.pop(3)
+    cert_db.certs.append((
+        {'id': 20, 'name': 'new', 'status': 'good'},
+        {'id': 20, 'CN': 'new', 'Alt': [{'DNS': 'other3'}]},
+    ))
+    tinycert_module = TinyCert(get_node(), config, False, context)
+    cert = tinycert_module._find_cert_by_san(
+        session,
+        1000,
+        {'DNS': 'other3'},
+    )
+    assert cert['id'] == 20
+    session.cert.details.assert_called_once_with(20)
+
+
+def test_cert_index_newest_first():
+    cert_index = CertIndex(None)
+    cert_index.update(1000, {
+        3: [{'DNS': 'abc.acme.com'}],
+        20: [{'DNS': 'abc.acme.com'}, {'IP': '10.0.0.123'}],
+        7: [{'DNS': 'abc.acme.com'}],
+    })
+    assert cert_index.find(1000, {'DNS': 'abc.acme.com'}) == 20
+    assert cert_index.sans(1000, 20)[1] == {'IP': '10.0.0.123'}
+    assert cert_index.sans(1000, 21) == []
+
+
+@mock.patch('nodereg.modules.tinycert.CachedSession')
+@mock.patch('nodereg.modules.tinycert.pki')
+def test_certificates_up_to_date(tinycert_pki, tinycert_session, tmpdir):
+    config = get_config(node_certificate=True, certificates=[1001])
+    config['certificates_path'] = str(tmpdir)
+    tmpdir.join('host.pem').write('CERT')
+    tmpdir.join('host-key.pem').write('KEY')
+    context = RunContext(str(tmpdir))
+    context.publish('fqdn', 'abc.acme.com.')
+    tmpdir.join('tinycert-files.json').write(json.dumps({
+        'cas': {'1000': '/tmp/ca/acme.com.pem'},
+        'certs': {'1001': ['/tmp/certs/a.pem', '/tmp/certs/a-key.pem']},
+    }))
+    tinycert_pki.check_certificate.return_value = True
+    tinycert_pki.lifetime.return_value = None
+
+    tinycert_module = TinyCert(get_node(), config, False, context)
+    tinycert_module.prefetch()
+    tinycert_module.run('abc.acme.com.')
+
+    tinycert_session.assert_not_called()
+    tinycert_pki.check_certificate.assert_any_call(
+        str(tmpdir.join('node.pem')),
+        str(tmpdir.join('node-key.pem')),
+        7 * 24 * 3600,
+        dns_names=['abc.acme.com.', 'abc'],
+        ip_addresses=['10.0.0.123'],
+    )
+    assert '/tmp/certs/a-key.pem' in tinycert_module.outputs
+
+    tinycert_pki.check_certificate.return_value = False
+    tinycert_module = TinyCert(get_node(), config, False, context)
+    with mock.patch.object(tinycert_module, '_ensure_ca'), \
+            mock.patch.object(tinycert_module, '_find_cert_by_san'), \
+            mock.patch.object(tinycert_module, '_is_usable'), \
+            mock.patch.object(tinycert_module, '_ensure_certificates'):
+        tinycert_module.run('abc.acme.com.')
+    tinycert_session().connect.assert_called_once_with(
+        config['email'],
+        config['passphrase'],
+    )
+
+
+def test_ensure_certificates_concurrently(tmpdir):
+    config = get_config()
+    config['certificates_path'] = str(tmpdir)
+    session = mock.Mock()
+    session.cert.details.side_effect = lambda cert_id: {
+        'id': cert_id,
+        'CN': 'Cert %s' % cert_id,
+    }
+    session.cert.get.side_effect = lambda cert_id, what: {
+        'pem': '%s %s' % (cert_id, what),
+    }
+
+    tinycert_module = TinyCert(get_node(), config, False)
+    with mock.patch.object(tinycert_module, '_write_file') as write_file:
+        tinycert_module._ensure_certificates(
+            session,
+            [(1001, True), (1002, False), (1003, False)],
+        )
+    assert [call[0] for call in write_file.call_args_list] == [
+        (str(tmpdir.join('node.pem')), '1001 cert', None),
+        (str(tmpdir.join('node-key.pem')), '1001 key.dec', 0o600),
+        (str(tmpdir.join('cert-1002.pem')), '1002 cert', None),
+        (str(tmpdir.join('cert-1002-key.pem')), '1002 key.dec', 0o600),
+        (str(tmpdir.join('cert-1003.pem')), '1003 cert', None),
+        (str(tmpdir.join('cert-1003-key.pem')), '1003 key.dec', 0o600),
+    ]
+    assert tmpdir.join('host.pem').readlink() == str(tmpdir.join('node.pem'))
+
+    def get_pem(cert_id, what):
+        if what == 'key.dec':
+            raise Exception('TinyCert error')
+        return {'pem': what}
+
+    session.cert.get.side_effect = get_pem
+    tinycert_module = TinyCert(get_node(), config, False)
+    with mock.patch.object(tinycert_module, '_write_file') as write_file:
+        with pytest.raises(Exception):
+            tinycert_module._ensure_certificates(session, [(1004, True)])
+    write_file.assert_not_called()
+
+
+def get_ca_session():
+    session = mock.Mock()
+    session.ca.details.side_effect = lambda ca_id: {
+        'id': ca_id,
+        'CN': 'CA %s' % ca_id,
+    }
+    session.ca.get.side_effect = lambda ca_id: {
+        'pem': 'CA %s PEM\n' % ca_id,
+    }
+    return session
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.tinycert.pki.subject_hash')
+def test_install_cas(subject_hash, subprocess_run, tmpdir):
+    config = get_config()
+    config['ca_path'] = str(tmpdir)
+    config['ca_ids'] = [1000, 2000]
+    config['ca_bundle'] = str(tmpdir.join('ca-certificates.crt'))
+    tmpdir.join('ca-certificates.crt').write('SYSTEM CA PEM')
+    tmpdir.join('ca-2000.pem').write('CA 2000 PEM\n')
+    os.symlink('other-ca.pem', str(tmpdir.join('aaaa0000.0')))
+    subject_hash.return_value = 'aaaa0000'
+    session = get_ca_session()
+
+    tinycert_module = TinyCert(get_node(), config, False)
+    ca_details = tinycert_module._ensure_ca(session)
+
+    assert ca_details['id'] == 1000
+    session.ca.get.assert_called_once_with(1000)
+    subject_hash.assert_called_once_with(b'CA 1000 PEM\n')
+    assert tmpdir.join('ca-certificates.crt').read() == (
+        'SYSTEM CA PEM\nCA 1000 PEM\n'
+    )
+    assert tmpdir.join('aaaa0000.1').readlink() == 'ca-1000.pem'
+    subprocess_run.assert_not_called()
+    assert tinycert_module._get_files()['cas'] == {
+        '1000': str(tmpdir.join('ca-1000.pem')),
+        '2000': str(tmpdir.join('ca-2000.pem')),
+    }
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.tinycert.pki.subject_hash')
+def test_install_cas_without_hash(subject_hash, subprocess_run, tmpdir):
+    config = get_config()
+    config['ca_path'] = str(tmpdir)
+    config['ca_bundle'] = str(tmpdir.join('ca-certificates.crt'))
+    tmpdir.join('ca-certificates.crt').write('SYSTEM CA PEM\n')
+    subject_hash.return_value = None
+
+    tinycert_module = TinyCert(get_node(), config, False)
+    tinycert_module._ensure_ca(get_ca_session())
+
+    assert tmpdir.join('ca-certificates.crt').read() == 'SYSTEM CA PEM\n'
+    subprocess_run.assert_called_once_with(
+        ['update-ca-certificates'],
+        check=True,
+        stdout=-1,
+    )
+
+
+@mock.patch('subprocess.run')
+@mock.patch('nodereg.modules.tinycert.pki.subject_hash')
+def test_install_cas_symlinked_bundle(subject_hash, subprocess_run, tmpdir):
+    config = get_config()
+    config['ca_path'] = str(tmpdir)
+    config['ca_bundle'] = str(tmpdir.join('ca-certificates.crt'))
+    tmpdir.join('tls-ca-bundle.pem').write('SYSTEM CA PEM\n')
+    os.symlink('tls-ca-bundle.pem', config['ca_bundle'])
+    subject_hash.return_value = 'aaaa0000'
+
+    tinycert_module = TinyCert(get_node(), config, False)
+    tinycert_module._ensure_ca(get_ca_session())
+
+    assert tmpdir.join('ca-certificates.crt').readlink() == 'tls-ca-bundle.pem'
+    assert tmpdir.join('tls-ca-bundle.pem').read() == 'SYSTEM CA PEM\n'
+    subject_hash.assert_not_called()
+    subprocess_run.assert_called_once_with(
+        ['update-ca-certificates'],
+        check=True,
+        stdout=-1,
+    )
+
+
+def get_api_response(token):
+    def post(url, headers, data):
+        response = mock.Mock()
+        if url.endswith('/connect'):
+            response.json.return_value = {'token': token}
+        elif 'token=%s&' % token in data:
+            response.json.return_value = []
+        else:
+            response.status_code = 401
+            response.raise_for_status.side_effect = requests.HTTPError(
+                response=response,
+            )
+        return response
+    return post
+
+
+@mock.patch('requests.post')
+def test_cached_session(requests_post, tmpdir):
+    cache_file = str(tmpdir.join('tinycert-session.json'))
+    requests_post.side_effect = get_api_response('token1')
+
+    session = CachedSession('test_key', cache_file)
+    session.connect('test@test.com', 'test_passphrase')
+    assert session.ca.list() == []
+    assert requests_post.call_count == 2
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+
+    session = CachedSession('test_key', cache_file)
+    session.connect('test@test.com', 'test_passphrase')
+    assert session.ca.list() == []
+    assert requests_post.call_count == 3
+
+    session = CachedSession('test_key', cache_file)
+    session.connect('other@test.com', 'test_passphrase')
+    assert requests_post.call_count == 4
+
+
+@mock.patch('requests.post')
+def test_cached_session_rejected(requests_post, tmpdir):
+    tmpdir.join('tinycert-session.json').write(json.dumps({
+        'email': 'test@test.com',
+        'token': 'token1',
+    }))
+    requests_post.side_effect = get_api_response('token2')
+
+    session = CachedSession(
+        'test_key',
+        str(tmpdir.join('tinycert-session.json')),
+    )
+    session.connect('test@test.com', 'test_passphrase')
+    requests_post.assert_not_called()
+    assert session.ca.list() == []
+    assert requests_post.call_count == 3
+    assert json.loads(tmpdir.join('tinycert-session.json').read()) == {
+        'email': 'test@test.com',
+        'token': 'token2',
+    }
+    calls = session.tracer.report()['calls']
+    assert calls['tinycert.relogin']['retries'] == 1
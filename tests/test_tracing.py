@@ -0,0 +1,81 @@
+import json
+import threading
+
+import pytest
+
+from nodereg.tracing import Tracer
+
+
+def test_nested_spans():
+    tracer = Tracer()
+    with tracer.span('module.hosted_zone'):
+        with tracer.span('route53.get_zone'):
+            pass
+        with tracer.span('route53.wait_insync') as span:
+            span.retry()
+            span.retry()
+    report = tracer.report()
+    module_span = report['span']['children'][0]
+    assert module_span['name'] == 'module.hosted_zone'
+    assert [c['name'] for c in module_span['children']] == [
+        'route53.get_zone',
+        'route53.wait_insync',
+    ]
+    assert module_span['duration'] >= 0
+    assert report['calls']['route53.wait_insync']['retries'] == 2
+    assert report['calls']['route53.get_zone']['count'] == 1
+
+
+def test_spans_from_threads_attach_to_root():
+    tracer = Tracer()
+
+    def work():
+        with tracer.span('module.etcd'):
+            pass
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    with tracer.span('module.hostname'):
+        pass
+    names = [c['name'] for c in tracer.report()['span']['children']]
+    assert sorted(names) == ['module.etcd', 'module.hostname']
+
+
+def test_failed_span():
+    tracer = Tracer()
+    with pytest.raises(ValueError):
+        with tracer.span('tinycert.connect'):
+            raise ValueError('boom')
+    report = tracer.report()
+    assert report['calls']['tinycert.connect']['errors'] == 1
+    assert 'boom' in report['span']['children'][0]['error']
+
+
+def test_write_report(tmpdir):
+    tracer = Tracer()
+    with tracer.span('exec.hostnamectl'):
+        pass
+    report_file = str(tmpdir.join('reports', 'boot.json'))
+    tracer.write_report(report_file)
+    with open(report_file) as _file:
+        report = json.load(_file)
+    assert report['calls']['exec.hostnamectl']['count'] == 1
+
+
+def test_wrapped_spans_from_threads():
+    tracer = Tracer()
+
+    def work():
+        with tracer.span('tinycert.cert.details'):
+            pass
+
+    with tracer.span('module.tinycert'):
+        thread = threading.Thread(target=tracer.wrap(work))
+    thread.start()
+    thread.join()
+    module_span = tracer.report()['span']['children'][0]
+    assert module_span['name'] == 'module.tinycert'
+    assert [c['name'] for c in module_span['children']] == [
+        'tinycert.cert.details',
+    ]